@@ -20,20 +20,30 @@ import base64
 import json
 import copy
 import math
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from io import BytesIO
 import scripts.utils as utils
 import scripts.metadata as metadata
 import scripts.civitai as civitai
+from scripts.journal import Journal
 from os.path import exists
 from datetime import datetime as dt
 from datetime import date
 from pathlib import Path
 from collections import deque
+from urllib.parse import urlsplit, unquote
 from PIL.PngImagePlugin import PngImageFile, PngInfo
 from torch.cuda import get_device_name, device_count
 from scripts.server import ArtServer
-from scripts.sdi import SDI
+from scripts.sdi import SDI, ProgressMonitor
+from scripts.sdclient import SDClient
+from scripts.scheduler import Scheduler
+from scripts.supervisor import Supervisor
+from scripts.capabilities import Capabilities
+from scripts.gallery import GalleryIndex
+from scripts.thumbnails import ThumbnailCache
+from scripts.events import EventBus
 
 # environment setup
 cwd = os.getcwd()
@@ -53,28 +63,42 @@ print_lock = threading.Lock()
 
 
 # worker thread executes specified shell command
-class Worker(threading.Thread):
-    def __init__(self, command, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+# a single job; run() executes on the owning GPU worker's executor
+# and returns the job outcome, which the controller receives via a future
+class Worker:
+    def __init__(self, command, worker, output_buffer=None):
         self.command = command
-        self.callback = callback
+        # prepare() settles values in command in place; this is what gets re-queued if the job fails
+        self.original_command = copy.deepcopy(command)
+        self.worker = worker
+        self.output_buffer = output_buffer
+        # set if prepare() was started ahead of time on the controller's prepare pool
+        self.prepare_future = None
 
-        # grab the worker info from the args
-        self.worker = args[0]
 
-        # grab the output buffer
-        self.output_buffer = None
-        if len(args) > 1:
-            self.output_buffer = args[1]
+    # runs the job start to finish; the prep work may have already been done
+    # ahead of time (see Controller.prefetch_work)
+    def run(self):
+        if self.prepare_future != None:
+            # wait for prefetched prep work to finish if it hasn't already
+            self.prepare_future.result()
+        else:
+            self.prepare()
+        return self.execute()
 
 
-    def run(self):
+    # CPU/disk-side work that doesn't need the GPU: settles random values, expands wildcards,
+    # reads & encodes input images and builds the API payload
+    # safe to run while the GPU is still busy with the previous job
+    def prepare(self):
         command = ''
         original_filename = ''
         original_exif = {}
         original_iptc = {}
         original_command = {}
         process_mode = False
+        payload = {}
+        use_controlnet = False
 
         if not int(self.command.get('seed')) > 0:
             self.command['seed'] = -1
@@ -186,20 +210,6 @@ class Worker(threading.Thread):
                     # update command with random styles
                     self.command['styles'] = styles
 
-            # check if a model change is needed
-            if self.command.get('ckpt_file') != '' and (self.command.get('ckpt_file') != self.worker['sdi_instance'].model_loaded):
-                self.worker['sdi_instance'].load_model(self.command.get('ckpt_file'))
-                while self.worker['sdi_instance'].options_change_in_progress:
-                    # wait for model change to complete
-                    time.sleep(0.25)
-            elif self.command.get('ckpt_file') == '':
-                # revert to default config.txt model if necessary
-                if control.config.get('ckpt_file') != '' and control.default_model_validated and (control.config.get('ckpt_file') != self.worker['sdi_instance'].model_loaded):
-                    self.worker['sdi_instance'].load_model(control.config.get('ckpt_file'))
-                    while self.worker['sdi_instance'].options_change_in_progress:
-                        # wait for model change to complete
-                        time.sleep(0.25)
-
             if self.command.get('prompt').strip() == '.':
                 self.command['prompt'] = ''
             else:
@@ -443,7 +453,7 @@ class Worker(threading.Thread):
                   "denoising_strength": self.command.get('strength'),
                   "prompt": str(self.command.get('prompt')),
                   "seed": self.command.get('seed'),
-                  "batch_size": self.command.get('batch_size'),     # gpu makes this many at once
+                  "batch_size": self.request_batch_size(),          # gpu makes this many at once
                   "n_iter": self.command.get('samples'),            # number of iterations to run
                   "steps": self.command.get('steps'),
                   "cfg_scale": self.command.get('scale'),
@@ -464,7 +474,7 @@ class Worker(threading.Thread):
                   "scheduler": str(self.command.get('scheduler')),
                   "prompt": str(self.command.get('prompt')),
                   "seed": self.command.get('seed'),
-                  "batch_size": self.command.get('batch_size'),     # gpu makes this many at once
+                  "batch_size": self.request_batch_size(),          # gpu makes this many at once
                   "n_iter": self.command.get('samples'),            # number of iterations to run
                   "steps": self.command.get('steps'),
                   "cfg_scale": self.command.get('scale'),
@@ -634,6 +644,38 @@ class Worker(threading.Thread):
                         self.print("Using default output directory instead...")
                         self.command['output_dir'] = ''
 
+        self.payload = payload
+        self.use_controlnet = use_controlnet
+        self.use_adetailer = use_adetailer
+        self.process_mode = process_mode
+        self.original_exif = original_exif
+        self.original_iptc = original_iptc
+        self.original_command = original_command
+
+
+    # loads the required model, makes the SD request(s) and saves the output
+    def execute(self):
+        payload = self.payload
+        use_controlnet = self.use_controlnet
+        use_adetailer = self.use_adetailer
+        process_mode = self.process_mode
+        original_exif = self.original_exif
+        original_iptc = self.original_iptc
+        original_command = self.original_command
+
+        if not process_mode:
+            # check if a model change is needed
+            if self.command.get('ckpt_file') != '' and (self.command.get('ckpt_file') != self.worker['sdi_instance'].model_loaded):
+                self.worker['sdi_instance'].load_model(self.command.get('ckpt_file'))
+                # wait for model change to complete
+                self.worker['sdi_instance'].wait_for_options_change()
+            elif self.command.get('ckpt_file') == '':
+                # revert to default config.txt model if necessary
+                if control.config.get('ckpt_file') != '' and control.default_model_validated and (control.config.get('ckpt_file') != self.worker['sdi_instance'].model_loaded):
+                    self.worker['sdi_instance'].load_model(control.config.get('ckpt_file'))
+                    # wait for model change to complete
+                    self.worker['sdi_instance'].wait_for_options_change()
+
         # !MODE = process enters here:
         command = utils.create_command(self.command, self.command.get('prompt_file'), self.worker['id'])
         if not process_mode:
@@ -642,6 +684,7 @@ class Worker(threading.Thread):
             self.print("starting job #" + str(self.worker['jobs_done']+1) + ": batch processing...")
 
         start_time = time.time()
+        self.job_number = self.worker['jobs_done']+1
         self.worker['job_start_time'] = start_time
         self.worker['job_prompt_info'] = self.command
 
@@ -651,11 +694,17 @@ class Worker(threading.Thread):
         if "cuda:" in self.worker['id']:
             gpu_id = self.worker['id'].replace('cuda:', '')
         else:
-            gpu_id = self.worker['id']
+            gpu_id = self.worker['id'].replace(':', '-')
 
+        # output images are kept in memory; this is only written to for debugging (DEBUG_SAVE_SAMPLES)
         #samples_dir = os.path.join(output_dir, "gpu_" + str(gpu_id))
         samples_dir = output_dir + '/' + "gpu_" + str(gpu_id)
 
+        # images SD returns, by filename; a later image w/ the same name replaces an earlier one
+        images = {}
+        # discard anything left over from a previous failed job
+        self.worker['sdi_instance'].take_output_images()
+
         #self.worker['sdi_instance'].last_job_success = True
         if control.config.get('debug_test_mode') and not process_mode:
             # simulate SD work
@@ -676,8 +725,12 @@ class Worker(threading.Thread):
                         self.worker['sdi_instance'].do_txt2img(payload, samples_dir)
                     else:
                         self.worker['sdi_instance'].do_txt2img(payload, samples_dir)
-                while self.worker['sdi_instance'].busy and self.worker['sdi_instance'].isRunning:
-                    time.sleep(0.25)
+                self.worker['sdi_instance'].wait_until_idle()
+                self.collect_images(images)
+
+        sd_width = 0
+        sd_height = 0
+        originals = []
 
         # upscale here if requested
         if (self.worker['sdi_instance'].last_job_success or process_mode) and self.worker['sdi_instance'].isRunning:
@@ -703,7 +756,7 @@ class Worker(threading.Thread):
                     new_files = []
                     if not process_mode:
                         # upscale all newly-generated images for non-process mode
-                        new_files = os.listdir(samples_dir)
+                        new_files = list(images.values())
                     else:
                         # if process mode, upscale the designated image
                         new_files.append(self.command.get('input_image'))
@@ -722,14 +775,14 @@ class Worker(threading.Thread):
                             else:
                                 self.worker['sdi_instance'].log('processing ' + self.command.get('input_image') + '...')
                         for file in new_files:
-                            encoded = None
+                            img_payload = None
                             if not process_mode:
-                                encoded = base64.b64encode(open(os.path.join(samples_dir, file), "rb").read())
+                                img_payload = file.payload()
                             else:
                                 # this whole process_mode thread is pretty hacky...
                                 encoded = base64.b64encode(open(self.command.get('input_image'), "rb").read())
-                            encodedString = str(encoded, encoding='utf-8')
-                            img_payload = 'data:image/png;base64,' + encodedString
+                                encodedString = str(encoded, encoding='utf-8')
+                                img_payload = 'data:image/png;base64,' + encodedString
                             if use_upscale:
                                 if self.command['upscale_model'] != 'sd' and self.command['upscale_model'] != 'ultimate':
                                     # normal upscale
@@ -749,7 +802,11 @@ class Worker(threading.Thread):
                                         #"upscale_first": false,
                                         "image": img_payload
                                     }
-                                    self.worker['sdi_instance'].do_upscale(payload, samples_dir)
+                                    # we already know the seeds of images we generated
+                                    seed = None
+                                    if not process_mode:
+                                        seed = file.seed
+                                    self.worker['sdi_instance'].do_upscale(payload, samples_dir, seed)
                                 else:
                                     # SD upscale uses img2img
                                     # use whatever params we can find in original image
@@ -866,9 +923,8 @@ class Worker(threading.Thread):
 
                                     if sd_model != '' and (sd_model != self.worker['sdi_instance'].model_loaded):
                                         self.worker['sdi_instance'].load_model(sd_model)
-                                        while self.worker['sdi_instance'].options_change_in_progress:
-                                            # wait for model change to complete
-                                            time.sleep(0.25)
+                                        # wait for model change to complete
+                                        self.worker['sdi_instance'].wait_for_options_change()
 
                                     payload = {
                                       "init_images": [img_payload],
@@ -959,278 +1015,308 @@ class Worker(threading.Thread):
                                 payload["alwayson_scripts"].update(ad_payload)
                                 self.worker['sdi_instance'].do_img2img(payload, samples_dir)
 
-                            while self.worker['sdi_instance'].busy and self.worker['sdi_instance'].isRunning:
-                                time.sleep(0.25)
+                            self.worker['sdi_instance'].wait_until_idle()
+                            self.collect_images(images)
 
                         # remove originals if upscaled version present
                         if not process_mode:
-                            new_files = os.listdir(samples_dir)
-                            for f in new_files:
-                                if (".png" in f):
-                                    basef = f.replace(".png", "")
-                                    if basef[-2:] == "_u":
-                                        # this is an upscaled image, delete the original
-                                        # or save it in /original if desired
-                                        if exists(samples_dir + "/" + basef[:-2] + ".png"):
-                                            if self.command['upscale_keep_org'] == 'yes':
-                                                # move the original to /original
-                                                orig_dir = output_dir + "/original"
-                                                Path(orig_dir).mkdir(parents=True, exist_ok=True)
-                                                os.replace(samples_dir + "/" + basef[:-2] + ".png", \
-                                                    orig_dir + "/" + basef[:-2] + ".png")
-                                            else:
-                                                os.remove(samples_dir + "/" + basef[:-2] + ".png")
-
-
-        # find the new image(s) that SD created: re-name, process, and move them
-        if self.worker['sdi_instance'].last_job_success and self.worker['sdi_instance'].isRunning:
+                            for f in list(images.keys()):
+                                basef = f.replace(".png", "")
+                                if basef[-2:] == "_u":
+                                    # this is an upscaled image, drop the original
+                                    # or save it in /original if desired (when finalizing)
+                                    if basef[:-2] + ".png" in images:
+                                        original = images.pop(basef[:-2] + ".png")
+                                        if self.command['upscale_keep_org'] == 'yes':
+                                            originals.append(original)
+
+
+        success = self.worker['sdi_instance'].last_job_success
+        self.worker['work_state'] = ""
+        finalize_future = None
+        if success and self.worker['sdi_instance'].isRunning:
             # only if we're not shutting down
-            self.worker['work_state'] = "+exif data"
-            if control.config.get('debug_test_mode'):
-                # simulate metadata work
-                work_time = round(random.uniform(1, 2), 2)
-                time.sleep(work_time)
-            else:
-                new_files = []
-                if exists(samples_dir):
-                    new_files = os.listdir(samples_dir)
-                nf_count = 0
-                for f in new_files:
-                    if (".png" in f):
-                        # save just the essential prompt params to metadata
-                        meta_prompt = command.split(" --prompt ",1)[1]
-                        meta_prompt = meta_prompt.split(" --outdir ",1)[0]
-
-                        if 'seed_' in f:
-                            # grab seed from filename
-                            # filename = seed_3542762265.png or seed_3542762265_u.png
-                            actual_seed = f.replace('seed_', '')
-                            actual_seed = actual_seed.replace('_u', '')
-                            actual_seed = actual_seed.split('.', 1)[0]
-
-                            # replace the seed in the command with the actual seed used
-                            pleft = meta_prompt.split(" --seed ",1)[0]
-                            pright = meta_prompt.split(" --seed ",1)[1].strip()
-                            meta_prompt = pleft + " --seed " + actual_seed
-
-                        upscale_text = ""
-                        if self.command['use_upscale'] == 'yes':
-                            upscale_text = " (upscaled "
-                            if self.command['upscale_model'] == 'sd':
-                                upscale_text += 'via SD upscale: to ' + str(sd_width) + 'x' + str(sd_height) + ' @ ' + str(self.command.get('upscale_sd_strength')) + ' strength)'
-                            elif self.command['upscale_model'] == 'ultimate':
-                                upscale_text += 'via SD ultimate upscale: ' + str(self.command.get('upscale_amount')) + 'x using ' + self.command['upscale_ult_model'] + ' @ ' + str(self.command.get('upscale_sd_strength')) + ' strength)'
-                            else:
-                                upscale_text += str(self.command['upscale_amount']) + "x via " + self.command['upscale_model'] + ")"
-
-                        ad_text = ""
-                        if use_adetailer:
-                            ad_text = " (ADetailer applied: "
-                            ad_text += str(self.command.get('adetailer_model')) + ' @ ' + str(self.command.get('adetailer_strength')) + ' strength)'
+            # hand the new image(s) off to the post-processing pool so that this
+            # GPU can start on its next job while they're being saved
+            self.final_command = command
+            self.output_dir = output_dir
+            self.images = list(images.values())
+            self.originals = originals
+            self.start_time = start_time
+            self.sd_width = sd_width
+            self.sd_height = sd_height
+            finalize_future = control.submit_finalize(self)
 
+        exec_time = time.time() - start_time
+        if not success:
+            self.print("job #" + str(self.job_number) + " failed after " + str(round(exec_time, 2)) + " seconds.")
+        return {'success' : success, 'exec_time' : exec_time, 'finalize' : finalize_future}
+
+
+    # takes the new image(s) that SD created: re-names, processes, and saves them
+    # runs on the controller's post-processing pool after the GPU has moved on
+    def finalize(self):
+        command = self.final_command
+        output_dir = self.output_dir
+        sd_width = self.sd_width
+        sd_height = self.sd_height
+        use_adetailer = self.use_adetailer
+        process_mode = self.process_mode
+        original_exif = self.original_exif
+        original_iptc = self.original_iptc
+
+        if control.config.get('debug_test_mode'):
+            # simulate metadata work
+            work_time = round(random.uniform(1, 2), 2)
+            time.sleep(work_time)
+        else:
+            # keep the non-upscaled originals if requested
+            for original in self.originals:
+                orig_dir = output_dir + "/original"
+                Path(orig_dir).mkdir(parents=True, exist_ok=True)
+                original.save_png(orig_dir + "/" + original.filename)
+
+            for image in self.images:
+                f = image.filename
+                # save just the essential prompt params to metadata
+                meta_prompt = command.split(" --prompt ",1)[1]
+                meta_prompt = meta_prompt.split(" --outdir ",1)[0]
+
+                if 'seed_' in f:
+                    # grab seed from filename
+                    # filename = seed_3542762265.png or seed_3542762265_u.png
+                    actual_seed = f.replace('seed_', '')
+                    actual_seed = actual_seed.replace('_u', '')
+                    actual_seed = actual_seed.split('.', 1)[0]
+
+                    # replace the seed in the command with the actual seed used
+                    pleft = meta_prompt.split(" --seed ",1)[0]
+                    pright = meta_prompt.split(" --seed ",1)[1].strip()
+                    meta_prompt = pleft + " --seed " + actual_seed
+
+                upscale_text = ""
+                if self.command['use_upscale'] == 'yes':
+                    upscale_text = " (upscaled "
+                    if self.command['upscale_model'] == 'sd':
+                        upscale_text += 'via SD upscale: to ' + str(sd_width) + 'x' + str(sd_height) + ' @ ' + str(self.command.get('upscale_sd_strength')) + ' strength)'
+                    elif self.command['upscale_model'] == 'ultimate':
+                        upscale_text += 'via SD ultimate upscale: ' + str(self.command.get('upscale_amount')) + 'x using ' + self.command['upscale_ult_model'] + ' @ ' + str(self.command.get('upscale_sd_strength')) + ' strength)'
+                    else:
+                        upscale_text += str(self.command['upscale_amount']) + "x via " + self.command['upscale_model'] + ")"
 
-                        pngImage = PngImageFile(samples_dir + "/" + f)
-                        im = pngImage.convert('RGB')
-                        exif = None
-                        if not process_mode:
-                            exif = im.getexif()
-                            exif[0x9286] = meta_prompt
-                            exif[0x9c9c] = meta_prompt.encode('utf16')
-                            exif[0x0131] = "https://github.com/rbbrdckybk/dream-factory"
-                        else:
-                            exif = original_exif
-                        exif[0x9c9d] = ('AI art' + upscale_text + ad_text).encode('utf16')
-
-                        newfilename = ''
-                        if self.command['filename'] != '':
-                            # user specified custom filename format
-
-                            model = self.command.get('ckpt_file')
-                            model = model.split('[', 1)[0].strip()
-                            if '\\' in model:
-                                model = model.rsplit('\\', 1)[1].strip()
-                            if '/' in model:
-                                model = model.rsplit('/', 1)[1].strip()
-                            if '.' in model:
-                                model = model.rsplit('.', 1)[0].strip()
-
-                            cn_model = ''
-                            if self.command.get('controlnet_model') != '':
-                                cn_model = self.command.get('controlnet_model')
-                                cn_model = cn_model.split('[', 1)[0].strip()
-                                if '.' in cn_model:
-                                    cn_model = cn_model.rsplit('.', 1)[0].strip()
-
-                            cn_img = ''
-                            if self.command.get('controlnet_input_image') != '':
-                                cn_img = self.command.get('controlnet_input_image')
-                                cn_img = utils.filename_from_abspath(cn_img)[:-4]
-
-                            input_img = ''
-                            if self.command.get('input_image') != '':
-                                input_img = self.command.get('input_image')
-                                input_img = utils.filename_from_abspath(input_img)[:-4]
-
-                            hr_model = ''
-                            if self.command.get('highres_ckpt_file') != '':
-                                hr_model = self.command.get('highres_ckpt_file')
-                                hr_model = hr_model.split('[', 1)[0].strip()
-                                if '\\' in hr_model:
-                                    hr_model = hr_model.rsplit('\\', 1)[1].strip()
-                                if '/' in hr_model:
-                                    hr_model = hr_model.rsplit('/', 1)[1].strip()
-                                if '.' in hr_model:
-                                    hr_model = hr_model.rsplit('.', 1)[0].strip()
-
-                            ad_model = ''
-                            if self.command.get('adetailer_model') != '':
-                                ad_model = self.command.get('adetailer_model')
-                                ad_model = ad_model.split('[', 1)[0].strip()
-                                if '\\' in ad_model:
-                                    ad_model = ad_model.rsplit('\\', 1)[1].strip()
-                                if '/' in ad_model:
-                                    ad_model = ad_model.rsplit('/', 1)[1].strip()
-                                if '.' in ad_model:
-                                    ad_model = ad_model.rsplit('.', 1)[0].strip()
-
-                            styles = ''
-                            style_count = 0
-                            if len(self.command.get('styles')) > 0:
-                                for style in self.command.get('styles'):
-                                    if style_count > 0:
-                                        styles += '_'
-                                    styles += style.replace('Style: ', '').strip()
-                                    style_count += 1
-
-                            first_lora = ''
-                            if '<lora:' in self.command.get('prompt').lower():
-                                lp = self.command.get('prompt').lower().split('<lora:', 1)[1]
-                                if '>' in lp:
-                                    first_lora = lp.split('>', 1)[0]
-                                if '\\' in first_lora:
-                                    first_lora = first_lora.rsplit('\\', 1)[1]
-                                if '/' in first_lora:
-                                    first_lora = first_lora.rsplit('/', 1)[1]
-                                if ':' in first_lora:
-                                    first_lora = first_lora.split(':', 1)[0]
-                                first_lora = utils.slugify(first_lora)
-
-                            newfilename = self.command['filename']
-                            if not process_mode:
-                                try:
-                                    newfilename = re.sub('<prompt>', self.command.get('prompt'), newfilename, flags=re.IGNORECASE)
-                                    newfilename = re.sub('<neg-prompt>', self.command.get('neg_prompt'), newfilename, flags=re.IGNORECASE)
-                                except:
-                                    pass
-                                newfilename = re.sub('<scale>', str(self.command.get('scale')), newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<strength>', str(self.command.get('strength')), newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<seed>', str(self.command.get('seed')), newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<steps>', str(self.command.get('steps')), newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<width>', str(self.command.get('width')), newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<height>', str(self.command.get('height')), newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<sampler>', self.command.get('sampler'), newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<scheduler>', self.command.get('scheduler'), newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<model>', model, newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<cn-img>', cn_img, newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<cn-model>', cn_model, newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<hr-model>', hr_model, newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<styles>', styles, newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<lora>', first_lora, newfilename, flags=re.IGNORECASE)
-                            else:
-                                # these are only applicable to upscale process jobs
-                                newfilename = re.sub('<upscale-model>', self.command.get('upscale_model'), newfilename, flags=re.IGNORECASE)
-                                newfilename = re.sub('<upscale-sd-strength>', str(self.command.get('upscale_sd_strength')), newfilename, flags=re.IGNORECASE)
-
-                            newfilename = re.sub('<date>', dt.now().strftime('%Y%m%d'), newfilename, flags=re.IGNORECASE)
-                            newfilename = re.sub('<time>', dt.now().strftime('%H%M%S'), newfilename, flags=re.IGNORECASE)
-                            newfilename = re.sub('<date-year>', dt.now().strftime('%Y'), newfilename, flags=re.IGNORECASE)
-                            newfilename = re.sub('<date-month>', dt.now().strftime('%m'), newfilename, flags=re.IGNORECASE)
-                            newfilename = re.sub('<date-day>', dt.now().strftime('%d'), newfilename, flags=re.IGNORECASE)
-                            newfilename = re.sub('<input-img>', input_img, newfilename, flags=re.IGNORECASE)
-                            if str(self.command.get('adetailer_strength')) != '':
-                                newfilename = re.sub('<ad-strength>', str(self.command.get('adetailer_strength')), newfilename, flags=re.IGNORECASE)
-                            if ad_model != '':
-                                newfilename = re.sub('<ad-model>', ad_model, newfilename, flags=re.IGNORECASE)
-
-                            # remove all unrecognized variables
-                            #opening_braces = '<'
-                            #closing_braces = '>'
-                            #non_greedy_wildcard = '.*?'
-                            #re.sub(f'[{opening_braces}]{non_greedy_wildcard}[{closing_braces}]', '', newfilename)
-
-                            # limit filename length
-                            newfilename = newfilename[:200]
-
-                            # make the final name filesystem-safe
-                            newfilename = utils.slugify(newfilename)
-
-                            x = 0
-                            testname = newfilename
-                            while exists(output_dir + "/" + testname + ".jpg"):
-                                testname = newfilename + '-' + str(x)
-                                x += 1
-                            newfilename = testname
-                        else:
-                            # use default filename format
-                            newfilename = dt.now().strftime('%Y%m%d-%H%M%S-') + str(nf_count)
-                            nf_count += 1
+                ad_text = ""
+                if use_adetailer:
+                    ad_text = " (ADetailer applied: "
+                    ad_text += str(self.command.get('adetailer_model')) + ' @ ' + str(self.command.get('adetailer_strength')) + ' strength)'
 
-                        quality = control.config.get('jpg_quality')
-                        #output_fn = output_dir + "/" + newfilename + ".jpg"
-                        output_fn = os.path.join(output_dir, newfilename + ".jpg")
-                        if process_mode and self.command.get('output_dir') != '':
-                            output_fn =os.path.join(self.command.get('output_dir'), newfilename + ".jpg")
 
+                im = image.decode().convert('RGB')
+                exif = None
+                if not process_mode:
+                    exif = im.getexif()
+                    exif[0x9286] = meta_prompt
+                    exif[0x9c9c] = meta_prompt.encode('utf16')
+                    exif[0x0131] = "https://github.com/rbbrdckybk/dream-factory"
+                else:
+                    exif = original_exif
+                exif[0x9c9d] = ('AI art' + upscale_text + ad_text).encode('utf16')
+
+                newfilename = ''
+                if self.command['filename'] != '':
+                    # user specified custom filename format
+
+                    model = self.command.get('ckpt_file')
+                    model = model.split('[', 1)[0].strip()
+                    if '\\' in model:
+                        model = model.rsplit('\\', 1)[1].strip()
+                    if '/' in model:
+                        model = model.rsplit('/', 1)[1].strip()
+                    if '.' in model:
+                        model = model.rsplit('.', 1)[0].strip()
+
+                    cn_model = ''
+                    if self.command.get('controlnet_model') != '':
+                        cn_model = self.command.get('controlnet_model')
+                        cn_model = cn_model.split('[', 1)[0].strip()
+                        if '.' in cn_model:
+                            cn_model = cn_model.rsplit('.', 1)[0].strip()
+
+                    cn_img = ''
+                    if self.command.get('controlnet_input_image') != '':
+                        cn_img = self.command.get('controlnet_input_image')
+                        cn_img = utils.filename_from_abspath(cn_img)[:-4]
+
+                    input_img = ''
+                    if self.command.get('input_image') != '':
+                        input_img = self.command.get('input_image')
+                        input_img = utils.filename_from_abspath(input_img)[:-4]
+
+                    hr_model = ''
+                    if self.command.get('highres_ckpt_file') != '':
+                        hr_model = self.command.get('highres_ckpt_file')
+                        hr_model = hr_model.split('[', 1)[0].strip()
+                        if '\\' in hr_model:
+                            hr_model = hr_model.rsplit('\\', 1)[1].strip()
+                        if '/' in hr_model:
+                            hr_model = hr_model.rsplit('/', 1)[1].strip()
+                        if '.' in hr_model:
+                            hr_model = hr_model.rsplit('.', 1)[0].strip()
+
+                    ad_model = ''
+                    if self.command.get('adetailer_model') != '':
+                        ad_model = self.command.get('adetailer_model')
+                        ad_model = ad_model.split('[', 1)[0].strip()
+                        if '\\' in ad_model:
+                            ad_model = ad_model.rsplit('\\', 1)[1].strip()
+                        if '/' in ad_model:
+                            ad_model = ad_model.rsplit('/', 1)[1].strip()
+                        if '.' in ad_model:
+                            ad_model = ad_model.rsplit('.', 1)[0].strip()
+
+                    styles = ''
+                    style_count = 0
+                    if len(self.command.get('styles')) > 0:
+                        for style in self.command.get('styles'):
+                            if style_count > 0:
+                                styles += '_'
+                            styles += style.replace('Style: ', '').strip()
+                            style_count += 1
+
+                    first_lora = ''
+                    if '<lora:' in self.command.get('prompt').lower():
+                        lp = self.command.get('prompt').lower().split('<lora:', 1)[1]
+                        if '>' in lp:
+                            first_lora = lp.split('>', 1)[0]
+                        if '\\' in first_lora:
+                            first_lora = first_lora.rsplit('\\', 1)[1]
+                        if '/' in first_lora:
+                            first_lora = first_lora.rsplit('/', 1)[1]
+                        if ':' in first_lora:
+                            first_lora = first_lora.split(':', 1)[0]
+                        first_lora = utils.slugify(first_lora)
+
+                    newfilename = self.command['filename']
+                    if not process_mode:
                         try:
-                            im.save(output_fn, exif=exif, quality=quality)
+                            newfilename = re.sub('<prompt>', self.command.get('prompt'), newfilename, flags=re.IGNORECASE)
+                            newfilename = re.sub('<neg-prompt>', self.command.get('neg_prompt'), newfilename, flags=re.IGNORECASE)
                         except:
-                            self.print("OS error when attempting to save output image!")
-
-                        iptc_append = False
-                        if process_mode:
-                            # re-attach original iptc info
-                            metadata.attach_iptc_info(output_fn, original_iptc)
-                            if self.command.get('iptc_append'):
-                                iptc_append = True
-
-                        # add IPTC metadata if necesary
-                        if (self.command.get('iptc_title') != ''
-                                or self.command.get('iptc_description') != ''
-                                or self.command.get('iptc_keywords') != []
-                                or self.command.get('iptc_copyright') != ''):
-
-                            if not iptc_append:
-                                metadata.write_iptc_info(output_fn,
-                                    self.command.get('iptc_title'),
-                                    self.command.get('iptc_description'),
-                                    self.command.get('iptc_keywords'),
-                                    self.command.get('iptc_copyright'))
-                            else:
-                                metadata.write_iptc_info_append(output_fn,
-                                    self.command.get('iptc_title'),
-                                    self.command.get('iptc_description'),
-                                    self.command.get('iptc_keywords'),
-                                    self.command.get('iptc_copyright'))
+                            pass
+                        newfilename = re.sub('<scale>', str(self.command.get('scale')), newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<strength>', str(self.command.get('strength')), newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<seed>', str(self.command.get('seed')), newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<steps>', str(self.command.get('steps')), newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<width>', str(self.command.get('width')), newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<height>', str(self.command.get('height')), newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<sampler>', self.command.get('sampler'), newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<scheduler>', self.command.get('scheduler'), newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<model>', model, newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<cn-img>', cn_img, newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<cn-model>', cn_model, newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<hr-model>', hr_model, newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<styles>', styles, newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<lora>', first_lora, newfilename, flags=re.IGNORECASE)
+                    else:
+                        # these are only applicable to upscale process jobs
+                        newfilename = re.sub('<upscale-model>', self.command.get('upscale_model'), newfilename, flags=re.IGNORECASE)
+                        newfilename = re.sub('<upscale-sd-strength>', str(self.command.get('upscale_sd_strength')), newfilename, flags=re.IGNORECASE)
+
+                    newfilename = re.sub('<date>', dt.now().strftime('%Y%m%d'), newfilename, flags=re.IGNORECASE)
+                    newfilename = re.sub('<time>', dt.now().strftime('%H%M%S'), newfilename, flags=re.IGNORECASE)
+                    newfilename = re.sub('<date-year>', dt.now().strftime('%Y'), newfilename, flags=re.IGNORECASE)
+                    newfilename = re.sub('<date-month>', dt.now().strftime('%m'), newfilename, flags=re.IGNORECASE)
+                    newfilename = re.sub('<date-day>', dt.now().strftime('%d'), newfilename, flags=re.IGNORECASE)
+                    newfilename = re.sub('<input-img>', input_img, newfilename, flags=re.IGNORECASE)
+                    if str(self.command.get('adetailer_strength')) != '':
+                        newfilename = re.sub('<ad-strength>', str(self.command.get('adetailer_strength')), newfilename, flags=re.IGNORECASE)
+                    if ad_model != '':
+                        newfilename = re.sub('<ad-model>', ad_model, newfilename, flags=re.IGNORECASE)
+
+                    # remove all unrecognized variables
+                    #opening_braces = '<'
+                    #closing_braces = '>'
+                    #non_greedy_wildcard = '.*?'
+                    #re.sub(f'[{opening_braces}]{non_greedy_wildcard}[{closing_braces}]', '', newfilename)
+
+                    # limit filename length
+                    newfilename = newfilename[:200]
+
+                    # make the final name filesystem-safe
+                    newfilename = utils.slugify(newfilename)
+                    numbered = False
+                else:
+                    # use default filename format
+                    newfilename = dt.now().strftime('%Y%m%d-%H%M%S-')
+                    numbered = True
+
+                quality = control.config.get('jpg_quality')
+                save_dir = output_dir
+                if process_mode and self.command.get('output_dir') != '':
+                    save_dir = self.command.get('output_dir')
+                # other jobs may be saving to the same folder at the same time
+                newfilename = control.reserve_filename(save_dir, newfilename, numbered)
+                #output_fn = output_dir + "/" + newfilename + ".jpg"
+                output_fn = os.path.join(save_dir, newfilename + ".jpg")
 
-                        if exists(samples_dir + "/" + f):
-                            os.remove(samples_dir + "/" + f)
+                try:
+                    im.save(output_fn, exif=exif, quality=quality)
+                except:
+                    self.print("OS error when attempting to save output image!")
+                control.release_filename(output_fn)
+
+                iptc_append = False
+                if process_mode:
+                    # re-attach original iptc info
+                    metadata.attach_iptc_info(output_fn, original_iptc)
+                    if self.command.get('iptc_append'):
+                        iptc_append = True
+
+                # add IPTC metadata if necesary
+                if (self.command.get('iptc_title') != ''
+                        or self.command.get('iptc_description') != ''
+                        or self.command.get('iptc_keywords') != []
+                        or self.command.get('iptc_copyright') != ''):
+
+                    if not iptc_append:
+                        metadata.write_iptc_info(output_fn,
+                            self.command.get('iptc_title'),
+                            self.command.get('iptc_description'),
+                            self.command.get('iptc_keywords'),
+                            self.command.get('iptc_copyright'))
+                    else:
+                        metadata.write_iptc_info_append(output_fn,
+                            self.command.get('iptc_title'),
+                            self.command.get('iptc_description'),
+                            self.command.get('iptc_keywords'),
+                            self.command.get('iptc_copyright'))
+
+                # add it to the gallery index
+                if control.gallery_index != None:
+                    details = ''
+                    try:
+                        details = exif[0x9c9c].decode('utf16')
+                    except (KeyError, TypeError):
+                        pass
+                    control.gallery_index.add(output_fn, details, exif[0x9c9d].decode('utf16'))
+                # and make its gallery thumbnail in the background
+                if control.thumbnails != None:
+                    control.thumbnails.submit(output_fn)
 
+        self.print("finished job #" + str(self.job_number) + " in " + str(round(time.time() - self.start_time, 2)) + " seconds.")
 
-        self.worker['work_state'] = ""
-        # remove the samples dir to flush any unfinished work
-        try:
-            # os.rmdir only removes empty directories
-            #os.rmdir(samples_dir)
-            shutil.rmtree(samples_dir)
-        except OSError as e:
-            pass
 
-        exec_time = time.time() - start_time
-        if self.worker['sdi_instance'].last_job_success:
-            self.print("finished job #" + str(self.worker['jobs_done']+1) + " in " + str(round(exec_time, 2)) + " seconds.")
-        else:
-            self.print("job #" + str(self.worker['jobs_done']+1) + " failed after " + str(round(exec_time, 2)) + " seconds.")
-        self.callback(self.worker)
+    # collects the images this worker's SD instance has returned since the last call
+    def collect_images(self, images):
+        for image in self.worker['sdi_instance'].take_output_images():
+            images[image.filename] = image
+
+
+    # number of images to generate at once; larger than the job's batch size
+    # when several identical queued jobs were merged into this one
+    def request_batch_size(self):
+        if self.command.get('coalesced', 1) > 1:
+            return int(self.command.get('batch_size')) * self.command.get('coalesced')
+        return self.command.get('batch_size')
 
 
     def print(self, text):
@@ -1241,6 +1327,7 @@ class Worker(threading.Thread):
         # also write to buffer for webserver use
         if self.output_buffer != None:
             self.output_buffer.append(out_txt + '\n')
+            control.publish('log', out_txt + '\n')
 
 
 # controller manages worker thread(s) and user input
@@ -1254,47 +1341,42 @@ class Controller:
         self.prompt_manager = None
         self.input_manager = None
         self.output_buffer = deque([], maxlen=300)
-        self.work_queue = deque()
+        self.events = EventBus()                    # pushes changes to the web UI
+        self.work_queue = utils.WorkQueue()
         self.upscale_work_queue = deque()           # higher-priority queue for upscales, never cleared
         self.workers = []
         self.work_done = False
         self.is_paused = False
         self.loops = 0
-        self.orig_work_queue_size = 0
         self.jobs_done = 0
         self.total_jobs_done = 0
         self.repeat_jobs = False
         self.server = None
+        self.journal = None
+        self.journal_resume_checked = False
+        self.gallery_index = None
+        self.thumbnails = None
         self.server_startup_time = time.time()
         self.shutting_down = False
         self.sdi_ports_assigned = 0
         #self.sdi_setup_request_made = False        # made this worker-level
-        self.sdi_sampler_request_made = False
-        self.sdi_scheduler_request_made = False
+        self.capabilities = Capabilities(self)      # what SD has available (samplers, models, etc)
+        self.prompt_file_revalidate = False         # set when the prompt file needs re-checking against new capabilities
         self.sdi_samplers = None
         self.sdi_schedulers = None                  # this is a dict: [label name] = api name
         self.models_filename = 'model-triggers.txt'
         self.model_trigger_words = None
-        self.sdi_model_request_made = False
         self.sdi_models = None                      # 2023-05-30 changed to list of dicts
-        self.sdi_hypernetwork_request_made = False
         self.sdi_hypernetworks = None               # 2023-05-30 changed to list of dicts
-        self.sdi_lora_request_made = False
         self.sdi_loras = None                       # replaced self.loras with this, list of dicts
-        self.sdi_VAE_request_made = False
         self.sdi_VAEs = None                        # list of dicts
-        self.sdi_style_request_made = False
         self.sdi_styles = None                      # list of dicts
         self.embeddings = []                        # 2023-05-30 changed to list of dicts
         self.poses = []                             # [ path, [filename, str(WxH img dimensions), str(preview ext: '', 'jpg', 'png')] ]
-        self.sdi_upscaler_request_made = False
         self.sdi_upscalers = None
         self.sdi_controlnet_available = False
-        self.sdi_controlnet_request_made = False
-        self.sdi_controlnet_pre_request_made = False
         self.sdi_controlnet_models = None
         self.sdi_controlnet_preprocessors = None
-        self.sdi_script_request_made = False
         self.sdi_txt2img_scripts = None
         self.sdi_img2img_scripts = None
         self.sdi_ultimate_upscale_available = False
@@ -1310,16 +1392,71 @@ class Controller:
         self.model_index = 0
         self.highres_models = []
         self.highres_model_index = 0
+        # set whenever something happens that may let the main loop dispatch new work
+        self.dispatch_event = threading.Event()
+        # for preparing workers' next jobs while their GPUs are busy
+        self.prepare_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prepare')
+        # for JPEG encoding/EXIF/IPTC work on finished images, off the GPU workers' threads
+        self.finalize_pool = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='finalize')
+        self.finalize_lock = threading.Lock()
+        self.filenames_in_use = set()               # output images that are about to be saved
+        self.finalize_pending = 0
+        self.finalize_peak = 0
 
         # read config options
         self.init_config()
 
-        if self.config['sd_location'] == '':
+        if self.config['sd_location'] == '' and len(self.config['sd_attach_urls']) == 0 and len(self.config['remote_sd_instances']) == 0:
             print('\nERROR: path to stable diffusion not specified in config file! ')
             print('Make sure to set \'SD_LOCATION =\' in your config.txt with the path to your Automatic1111 SD repo installation!')
             print('\nExiting...')
             exit(0)
 
+        # GPU workers block when this many finished jobs are already waiting to be saved
+        self.finalize_slots = threading.BoundedSemaphore(max(1, self.config['finalize_max_pending']))
+
+        # makes all HTTP requests to SD instances, on a single event loop thread
+        self.sd_client = SDClient(self.config['sd_connect_timeout'], self.config['sd_read_timeout'])
+
+        # polls GPUs for generation progress (steps, it/s, ETA)
+        self.progress_monitor = ProgressMonitor(self, max(1, self.config['progress_poll_interval']))
+        if self.config['progress_poll_interval'] > 0:
+            self.progress_monitor.start()
+
+        # restarts SD instances that crash or hang, and re-queues the jobs they were running
+        self.supervisor = Supervisor(self, max(1, self.config['supervisor_interval']), self.config['supervisor_job_timeout'], \
+            self.config['supervisor_max_restarts'], self.config['supervisor_backoff'])
+        if self.config['supervisor_interval'] > 0:
+            self.supervisor.start()
+
+        # matches queued jobs to workers that already have the right model loaded
+        self.scheduler = Scheduler(self, self.config['scheduler_lookahead'], self.config['scheduler_tail_hold'])
+
+        # on-disk record of work in progress, for resuming after a crash/restart
+        try:
+            self.journal = Journal()
+        except Exception as e:
+            self.journal = None
+            print('*** WARNING: unable to open job journal (' + str(e) + '); interrupted work will not be resumable! ***')
+        else:
+            upscales = self.journal.get_upscales()
+            for work in upscales:
+                self.upscale_work_queue.append(work)
+            if len(upscales) > 0:
+                self.print("re-queued " + str(len(upscales)) + " unfinished gallery upscale job(s) from last session...")
+
+        # index of gallery images and their metadata, so the gallery doesn't re-read every image
+        try:
+            self.gallery_index = GalleryIndex()
+        except Exception as e:
+            self.gallery_index = None
+            print('*** WARNING: unable to open gallery index (' + str(e) + '); gallery refreshes will be slower! ***')
+        else:
+            self.gallery_index.scan([self.config.get('output_location'), self.config.get('gallery_user_folder')])
+
+        # small versions of gallery images (0 = gallery shows full-size images)
+        if self.config['gallery_thumb_size'] > 0:
+            self.thumbnails = ThumbnailCache(size=self.config['gallery_thumb_size'], max_mb=self.config['gallery_thumb_cache_mb'])
 
         # start the webserver if enabled
         if self.config.get('webserver_use'):
@@ -1337,6 +1474,7 @@ class Controller:
         if not self.config.get('debug_test_mode'):
             # initialize GPU(s)
             self.init_gpu_workers()
+            self.init_remote_workers()
         else:
             # create some dummy devices for testing
             self.init_dummy_workers()
@@ -1347,6 +1485,10 @@ class Controller:
         #self.read_loras()          # 2023-05-30 API call now available for this
         self.init_controlnet()
 
+        # use what SD had available last time until an SD instance is up
+        if len(self.workers) > 0 and self.workers[0].get('sdi_instance') != None:
+            self.capabilities.load(self.workers[0]['sdi_instance'])
+
 
     # clean up empty output dirs
     def clean_output_subdirs(self, directory):
@@ -1904,6 +2046,8 @@ class Controller:
             'webserver_auth_password' : 'password',
             'gallery_max_images' : 100,
             'gallery_refresh' : 30,
+            'gallery_thumb_size' : 384,
+            'gallery_thumb_cache_mb' : 500,
             'gallery_user_folder' : '',
             'gallery_user_folder_alias' : '',
             'gallery_current' : 'recent',
@@ -1941,7 +2085,22 @@ class Controller:
 
             'sd_location' : "",
             'sd_port' : 7861,
-            'gpu_init_stagger' : 1
+            'gpu_init_stagger' : 1,
+            'scheduler_lookahead' : 20,
+            'scheduler_tail_hold' : False,
+            'resume_interrupted_work' : True,
+            'coalesce_max_batch' : 0,
+            'finalize_max_pending' : 8,
+            'sd_connect_timeout' : 10,
+            'sd_read_timeout' : 900,
+            'debug_save_samples' : False,
+            'progress_poll_interval' : 1,
+            'sd_attach_urls' : [],
+            'remote_sd_instances' : [],
+            'supervisor_interval' : 15,
+            'supervisor_job_timeout' : 1800,
+            'supervisor_max_restarts' : 3,
+            'supervisor_backoff' : 600
         }
 
         file = utils.TextFile(self.config_file)
@@ -1976,6 +2135,35 @@ class Controller:
                         if value != '':
                             self.config.update({'use_gpu_devices' : value})
 
+                    elif command == 'sd_attach_urls':
+                        # comma-separated list, one per GPU; blank entries mean start a new instance
+                        urls = []
+                        for url in value.split(','):
+                            url = url.strip().rstrip('/')
+                            if url != '' and not url.startswith('http'):
+                                url = 'http://' + url
+                            urls.append(url)
+                        while len(urls) > 0 and urls[-1] == '':
+                            urls.pop()
+                        self.config.update({'sd_attach_urls' : urls})
+
+                    elif command == 'remote_sd_instances':
+                        # comma-separated list of SD instances on other machines, w/ optional user:password@
+                        remotes = []
+                        for url in value.split(','):
+                            url = url.strip().rstrip('/')
+                            if url == '':
+                                continue
+                            if not url.startswith('http'):
+                                url = 'http://' + url
+                            parts = urlsplit(url)
+                            auth = None
+                            if parts.username != None:
+                                auth = (unquote(parts.username), unquote(parts.password or ''))
+                                url = parts.scheme + '://' + parts.netloc.rsplit('@', 1)[1] + parts.path
+                            remotes.append({'url' : url, 'auth' : auth})
+                        self.config.update({'remote_sd_instances' : remotes})
+
                     elif command == 'sd_location':
                         if value != '':
                             self.config.update({'sd_location' : value})
@@ -1996,6 +2184,21 @@ class Controller:
                         else:
                             self.config.update({'gpu_init_stagger' : int(value)})
 
+                    elif command == 'scheduler_lookahead':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'SCHEDULER_LOOKAHEAD' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'scheduler_lookahead' : int(value)})
+
+                    elif command == 'scheduler_tail_hold':
+                        if value == 'yes' or value == 'no':
+                            if value == 'yes':
+                                self.config.update({'scheduler_tail_hold' : True})
+                            else:
+                                self.config.update({'scheduler_tail_hold' : False})
+
                     elif command == 'webserver_use':
                         if value == 'yes' or value == 'no':
                             if value == 'yes':
@@ -2056,6 +2259,22 @@ class Controller:
                         else:
                             self.config.update({'gallery_refresh' : int(value)})
 
+                    elif command == 'gallery_thumb_size':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'GALLERY_THUMB_SIZE' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'gallery_thumb_size' : int(value)})
+
+                    elif command == 'gallery_thumb_cache_mb':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'GALLERY_THUMB_CACHE_MB' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'gallery_thumb_cache_mb' : int(value)})
+
                     elif command == 'gallery_user_folder':
                         if value != '':
                             self.config.update({'gallery_user_folder' : value})
@@ -2125,6 +2344,92 @@ class Controller:
                             else:
                                 self.config.update({'auto_use_refiner' : False})
 
+                    elif command == 'coalesce_max_batch':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'COALESCE_MAX_BATCH' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'coalesce_max_batch' : int(value)})
+
+                    elif command == 'sd_connect_timeout':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'SD_CONNECT_TIMEOUT' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'sd_connect_timeout' : max(1, int(value))})
+
+                    elif command == 'sd_read_timeout':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'SD_READ_TIMEOUT' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'sd_read_timeout' : int(value)})
+
+                    elif command == 'progress_poll_interval':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'PROGRESS_POLL_INTERVAL' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'progress_poll_interval' : int(value)})
+
+                    elif command == 'supervisor_interval':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'SUPERVISOR_INTERVAL' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'supervisor_interval' : int(value)})
+
+                    elif command == 'supervisor_job_timeout':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'SUPERVISOR_JOB_TIMEOUT' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'supervisor_job_timeout' : int(value)})
+
+                    elif command == 'supervisor_max_restarts':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'SUPERVISOR_MAX_RESTARTS' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'supervisor_max_restarts' : int(value)})
+
+                    elif command == 'supervisor_backoff':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'SUPERVISOR_BACKOFF' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'supervisor_backoff' : int(value)})
+
+                    elif command == 'finalize_max_pending':
+                        try:
+                            int(value)
+                        except:
+                            print("*** WARNING: specified 'FINALIZE_MAX_PENDING' is not a valid number; it will be ignored!")
+                        else:
+                            self.config.update({'finalize_max_pending' : int(value)})
+
+                    elif command == 'debug_save_samples':
+                        if value == 'yes' or value == 'no':
+                            if value == 'yes':
+                                self.config.update({'debug_save_samples' : True})
+                            else:
+                                self.config.update({'debug_save_samples' : False})
+
+                    elif command == 'resume_interrupted_work':
+                        if value == 'yes' or value == 'no':
+                            if value == 'yes':
+                                self.config.update({'resume_interrupted_work' : True})
+                            else:
+                                self.config.update({'resume_interrupted_work' : False})
+
                     elif command == 'debug_test_mode':
                         if value == 'yes' or value == 'no':
                             if value == 'yes':
@@ -2308,24 +2613,31 @@ class Controller:
     # resizes the output_buffer
     def resize_buffer(self, new_length):
         self.output_buffer = deque([], maxlen=new_length)
+        self.publish('buffer')
 
 
     def pause(self):
         if not self.is_paused:
             self.is_paused = True
             self.print("Pause requested; workers will finish current work and then wait...")
+            self.publish('pause', {'paused' : True})
+            self.notify_dispatcher()
 
 
     def unpause(self):
         if self.is_paused:
             self.is_paused = False
             self.print("Un-pausing; workers will resume working...")
+            self.publish('pause', {'paused' : False})
+            self.notify_dispatcher()
 
 
     def shutdown(self):
         if not self.shutting_down:
             self.shutting_down = True
             self.print("Server shutdown requested; cleaning up and shutting down...")
+            # end any open web UI event streams so the webserver can stop
+            self.events.close()
             if self.server != None:
                 # stop the webserver if it's running
                 self.server.stop()
@@ -2333,6 +2645,25 @@ class Controller:
             # clean up gpu sd instance threads
             for worker in self.workers:
                 worker['sdi_instance'].cleanup()
+                if 'executor' in worker:
+                    worker['executor'].shutdown(wait=False)
+
+            # no point preparing jobs that will never run
+            self.prepare_pool.shutdown(wait=False, cancel_futures=True)
+
+            # finish saving any images that have already been generated
+            if self.finalize_pending > 0:
+                self.print("waiting for " + str(self.finalize_pending) + " job(s) to finish saving...")
+            self.finalize_pool.shutdown(wait=True)
+            self.sd_client.close()
+
+            # write any buffered job completions to disk
+            if self.journal != None:
+                self.journal.flush()
+            if self.gallery_index != None:
+                self.gallery_index.close()
+            if self.thumbnails != None:
+                self.thumbnails.shutdown()
 
             # clean up temp directory
             temp = os.path.join('server', 'temp')
@@ -2344,14 +2675,23 @@ class Controller:
 
             self.is_paused = True
             self.work_done = True
+            self.notify_dispatcher()
 
 
     # adds a GPU to the list of workers
     def add_gpu_worker(self, id, name, dummy = False):
         sdi_gpu_id = id.replace('cuda:', '')
         sdi_port = self.config['sd_port'] + self.sdi_ports_assigned
+        # GPUs are matched to SD_ATTACH_URLS in order
+        attach_url = ''
+        if self.sdi_ports_assigned < len(self.config['sd_attach_urls']):
+            attach_url = self.config['sd_attach_urls'][self.sdi_ports_assigned]
         self.sdi_ports_assigned += 1
 
+        if not dummy and attach_url == '' and self.config['sd_location'] == '':
+            self.print("no SD instance to attach to for device '" + id + "' and no SD_LOCATION to start one from; removing it as a GPU candidate...")
+            return
+
         if not dummy:
             self.workers.append({'id': id, \
                 'name': name, \
@@ -2361,7 +2701,9 @@ class Controller:
                 'job_start_time': float(0), \
                 'sdi_setup_request_made' : False, \
                 'idle': True, \
-                'sdi_instance': SDI(sdi_gpu_id, sdi_port, self.config['sd_location'], self, id) \
+                'executor': ThreadPoolExecutor(max_workers=1, thread_name_prefix='worker-' + id.replace(':', '-')), \
+                'prefetch': None, \
+                'sdi_instance': SDI(sdi_gpu_id, sdi_port, self.config['sd_location'], self, id, attach_url) \
             })
         else:
             # TODO fix dummy workers to work in sim mode
@@ -2396,6 +2738,10 @@ class Controller:
                 if name != '':
                     self.add_gpu_worker(worker, name)
 
+        elif self.config['use_gpu_devices'].lower() == "none":
+            # no local GPUs; only remote SD instances will be used
+            pass
+
         elif ',' in self.config['use_gpu_devices']:
             # we're specifying multiple GPUs
             gpus = self.config['use_gpu_devices'].split(',')
@@ -2432,6 +2778,31 @@ class Controller:
                     self.add_gpu_worker(worker, name)
 
 
+    # adds a worker for an SD instance running on another machine
+    def add_remote_worker(self, index, url, auth = None):
+        id = 'remote:' + str(index)
+        self.workers.append({'id': id, \
+            'name': urlsplit(url).netloc, \
+            'work_state': "", \
+            'jobs_done': 0, \
+            'job_prompt_info': '', \
+            'job_start_time': float(0), \
+            'sdi_setup_request_made' : False, \
+            'idle': True, \
+            'executor': ThreadPoolExecutor(max_workers=1, thread_name_prefix='worker-remote-' + str(index)), \
+            'prefetch': None, \
+            'sdi_instance': SDI('remote-' + str(index), 0, '', self, id, url, True, auth) \
+        })
+        self.print("initialized worker '" + id + "': " + url)
+
+
+    # build a list of workers for remote SD instances (REMOTE_SD_INSTANCES)
+    def init_remote_workers(self):
+        for i in range(len(self.config['remote_sd_instances'])):
+            remote = self.config['remote_sd_instances'][i]
+            self.add_remote_worker(i, remote['url'], remote['auth'])
+
+
     # build a list of dummy workers for debugging/testing
     def init_dummy_workers(self):
         worker_list = []
@@ -2463,7 +2834,7 @@ class Controller:
     def get_idle_gpu_worker(self):
         for worker in self.workers:
             if ':' in worker["id"]:
-                if worker["id"].split(':' ,1)[0] == 'cuda':
+                if worker["id"].split(':' ,1)[0] in ('cuda', 'remote'):
                     # this is a gpu worker
                     if worker['sdi_instance'].ready and not worker['sdi_instance'].busy:
                         # the worker has been initialized and isn't performing tasks
@@ -2475,6 +2846,16 @@ class Controller:
         return None
 
 
+    # returns a list of all idle gpu workers
+    def get_idle_gpu_workers(self):
+        idle = []
+        for worker in self.workers:
+            if ':' in worker["id"] and worker["id"].split(':' ,1)[0] in ('cuda', 'remote'):
+                if worker['sdi_instance'].ready and not worker['sdi_instance'].busy and worker["idle"]:
+                    idle.append(worker)
+        return idle
+
+
     # returns the current number of working workers
     def num_workers_working(self):
         working = 0
@@ -2484,91 +2865,429 @@ class Controller:
         return working
 
 
+    # wakes up the main loop so it can re-check for idle workers/new work;
+    # call this whenever a worker frees up or new work arrives
+    def notify_dispatcher(self):
+        self.dispatch_event.set()
+
+
+    # blocks the main loop until notify_dispatcher() is called
+    # the timeout is only a safety net for state changes nobody signals
+    def wait_for_dispatch(self, timeout=1.0):
+        self.dispatch_event.wait(timeout)
+
+
+    # blocks until all workers have finished their current jobs
+    def wait_for_workers(self):
+        while (self.num_workers_working() > 0 or self.finalize_pending > 0) and not self.work_done:
+            self.dispatch_event.clear()
+            if self.num_workers_working() > 0 or self.finalize_pending > 0:
+                self.wait_for_dispatch()
+
+
     # start a new worker thread
-    def do_work(self, worker, command):
+    # job is a prefetched Worker whose prep work has already been started, if any
+    def do_work(self, worker, command, job = None):
         worker['idle'] = False
-        thread = Worker(command, self.work_done_callback, worker, self.output_buffer)
-        thread.start()
+        if self.journal != None and command.get('job_seq') != None:
+            self.journal.set_position(command.get('job_seqs', [command.get('job_seq')])[-1])
+        if job == None:
+            job = Worker(command, worker, self.output_buffer)
+        else:
+            # may have been prefetched for a different worker
+            job.worker = worker
+        self.publish('job_started', {'worker' : worker['id'], 'job' : worker['jobs_done']+1, 'queue' : len(self.work_queue)})
+        future = worker['executor'].submit(job.run)
+        future.add_done_callback(lambda f: self.work_done_callback(worker, command, f, job.original_command))
+
+
+    # called (on the worker's executor thread) when a job's GPU work finishes
+    # original is the job as it was before Worker.prepare() changed it
+    def work_done_callback(self, worker, command, future, original = None):
+        finalize = None
+        success = False
+        if future.exception() != None:
+            self.print("job #" + str(worker['jobs_done']+1) + " on " + worker['id'] + " failed with an unexpected error: " + str(future.exception()))
+        else:
+            finalize = future.result().get('finalize')
+            success = future.result().get('success')
+            if success:
+                self.scheduler.job_done(worker, command, future.result().get('exec_time'))
+                worker['sdi_instance'].restarts = 0
+        if worker.pop('requeue', False) and not success:
+            # this worker's SD instance failed while running the job (see release_worker)
+            if original == None:
+                original = command
+            if self.supervisor.retry_job(original):
+                self.print("re-queueing job #" + str(worker['jobs_done']+1) + " from " + worker['id'] + " (attempt " + str(original.get('retries') + 1) + ")...")
+                if original.get('prompt') == 'df_gallery_upscale':
+                    self.upscale_work_queue.appendleft(original)
+                else:
+                    self.work_queue.appendleft(original)
+                worker['idle'] = True
+                worker['work_state'] = ""
+                worker['job_start_time'] = 0
+                worker['job_prompt_info'] = ''
+                self.publish('queue', {'length' : len(self.work_queue), 'total' : self.work_queue_total()})
+                self.publish('worker', {'worker' : worker['id']})
+                self.notify_dispatcher()
+                return
+            self.print("job #" + str(worker['jobs_done']+1) + " from " + worker['id'] + " has failed too many times; skipping it!")
+        # coalesced jobs count as each of the queued jobs they replaced
+        count = command.get('coalesced', 1)
+        # set this worker back to idle; its output may still be being saved
+        worker['idle'] = True
+        worker['work_state'] = ""
+        worker['jobs_done'] += count
+        worker['job_start_time'] = 0
+        worker['job_prompt_info'] = ''
+        self.publish('worker', {'worker' : worker['id']})
+        if finalize == None:
+            self.job_finished(command)
+        else:
+            finalize.add_done_callback(lambda f: self.job_finished(command))
+        self.notify_dispatcher()
+
+
+    # takes a worker whose SD instance has crashed or hung out of service (called by the
+    # supervisor); the job it was running is put back on the queue by work_done_callback
+    def release_worker(self, worker):
+        if not worker['idle']:
+            worker['requeue'] = True
+        worker['sdi_instance'].stop()
+        self.publish('worker', {'worker' : worker['id']})
+        self.notify_dispatcher()
+
+
+    # called once a job is completely done, including saving its output
+    def job_finished(self, command):
+        count = command.get('coalesced', 1)
+        # runs on both the post-processing pool and the GPU workers' executors
+        with self.finalize_lock:
+            self.jobs_done += count
+            self.total_jobs_done += count
+        self.publish('job_finished', {'jobs_done' : self.jobs_done, 'total_jobs_done' : self.total_jobs_done})
+        if self.journal != None:
+            if command.get('prompt') == 'df_gallery_upscale':
+                self.journal.remove_upscale(command.get('input_image'))
+            elif command.get('job_seq') != None:
+                for seq in command.get('job_seqs', [command.get('job_seq')]):
+                    self.journal.job_finished(command.get('prompt_file'), seq)
+
+
+    # queues a job's output images to be saved on the post-processing pool
+    # blocks the calling GPU worker while too many are already waiting, so that
+    # unsaved images can't pile up without limit if the CPU falls behind
+    # returns the future, or None if we're shutting down
+    def submit_finalize(self, job):
+        while not self.finalize_slots.acquire(timeout=1.0):
+            if self.shutting_down:
+                return None
+        with self.finalize_lock:
+            self.finalize_pending += 1
+            if self.finalize_pending > self.finalize_peak:
+                self.finalize_peak = self.finalize_pending
+        try:
+            future = self.finalize_pool.submit(job.finalize)
+        except RuntimeError:
+            # pool has been shut down
+            self.finalize_done(None)
+            return None
+        future.add_done_callback(self.finalize_done)
+        return future
+
+
+    # returns name, or name w/ a number added, such that dir/name.jpg isn't taken; the name
+    # is held until release_filename() so jobs being saved at the same time can't both use it
+    # numbered = True always adds a number (0, 1, ...); otherwise only if name is taken (-0, -1, ...)
+    def reserve_filename(self, dir, name, numbered = False):
+        with self.finalize_lock:
+            x = 0
+            testname = name
+            if numbered:
+                testname = name + '0'
+                x = 1
+            while exists(os.path.join(dir, testname + '.jpg')) or os.path.join(dir, testname + '.jpg') in self.filenames_in_use:
+                if numbered:
+                    testname = name + str(x)
+                else:
+                    testname = name + '-' + str(x)
+                x += 1
+            self.filenames_in_use.add(os.path.join(dir, testname + '.jpg'))
+            return testname
+
+
+    # call once an image reserved w/ reserve_filename() has been written (or failed to be)
+    def release_filename(self, filename):
+        with self.finalize_lock:
+            self.filenames_in_use.discard(filename)
+
+
+    # called (on the post-processing pool) when a job's output has been saved
+    def finalize_done(self, future):
+        if future != None and future.exception() != None:
+            self.print("error while saving job output: " + str(future.exception()))
+        with self.finalize_lock:
+            self.finalize_pending -= 1
+        self.finalize_slots.release()
+        self.notify_dispatcher()
 
 
-    # callback for worker threads when finished
-    def work_done_callback(self, *args):
-        self.jobs_done += 1
-        self.total_jobs_done += 1
-        # args[0] contains worker data; set this worker back to idle
-        args[0]['idle'] = True
-        args[0]['work_state'] = ""
-        args[0]['jobs_done'] += 1
-        args[0]['job_start_time'] = 0
-        args[0]['job_prompt_info'] = ''
+    # returns the total number of HTTP connections opened to SD instances, and the
+    # number of requests that re-used an already-open connection
+    def connection_stats(self):
+        opened = 0
+        reused = 0
+        for worker in self.workers:
+            if 'sdi_instance' in worker:
+                o, r = worker['sdi_instance'].connection_stats()
+                opened += o
+                reused += r
+        return opened, reused
+
+
+    # one-line summary of the post-processing queue for the status panel
+    def finalize_status(self):
+        with self.finalize_lock:
+            return "Images waiting to be saved: " + str(self.finalize_pending) + " (peak " + str(self.finalize_peak) + ")"
+
+
+    # while GPUs are busy, pull each one's next job from the queue and start preparing
+    # its payload so that it can be sent to SD as soon as the current job finishes
+    def prefetch_work(self):
+        if self.shutting_down:
+            return
+        for worker in self.workers:
+            if len(self.work_queue) == 0:
+                break
+            if 'prefetch' in worker and worker['prefetch'] == None and not worker['idle'] and worker['sdi_instance'].ready:
+                new_work = self.scheduler.next_job_for(worker)
+                if new_work == None:
+                    # the rest of the queue is better left to faster GPUs
+                    continue
+                new_work = self.coalesce_work(new_work)
+                job = Worker(new_work, worker, self.output_buffer)
+                job.prepare_future = self.prepare_pool.submit(job.prepare)
+                worker['prefetch'] = job
+
+
+    # returns True if there's a prefetched job this worker can run: its own, or
+    # another worker's once the queue is empty (so that no work is left stranded)
+    def has_prefetched_work(self, worker):
+        if worker.get('prefetch') != None:
+            return True
+        if len(self.work_queue) == 0:
+            for w in self.workers:
+                if w.get('prefetch') != None and self.scheduler.can_take_prefetched(worker, w):
+                    return True
+        return False
+
+
+    # True if any worker is holding a prefetched job it hasn't started yet; these still
+    # count as work left to do, even once the work queue is empty
+    def prefetched_work_pending(self):
+        for w in self.workers:
+            if w.get('prefetch') != None:
+                return True
+        return False
+
+
+    # removes and returns a prefetched job for this worker (see has_prefetched_work)
+    def take_prefetched_work(self, worker):
+        job = worker.get('prefetch')
+        if job != None:
+            worker['prefetch'] = None
+            return job
+        for w in self.workers:
+            if w.get('prefetch') != None and self.scheduler.can_take_prefetched(worker, w):
+                job = w['prefetch']
+                w['prefetch'] = None
+                return job
+        return None
+
+
+    # average seconds GPUs sit idle between generation requests, or -1 if unknown
+    def avg_idle_gap(self):
+        total = 0.0
+        count = 0
+        for worker in self.workers:
+            if 'sdi_instance' in worker:
+                total += worker['sdi_instance'].idle_gap_total
+                count += worker['sdi_instance'].idle_gap_count
+        if count > 0:
+            return total / count
+        return -1
+
+
+    # returns True if a job can safely be merged with identical jobs into a single
+    # batched SD request; anything that's randomized per job can't be
+    def is_coalescable(self, job):
+        if not isinstance(job, utils.WorkItem) or job.get('mode') != 'standard':
+            return False
+        try:
+            if int(job.get('seed')) > 0 or int(job.get('batch_size')) < 1:
+                return False
+        except:
+            return False
+        for key in ['scale', 'strength', 'steps']:
+            if '-' in str(job.get(key)):
+                return False
+        if len(job.get('styles')) > 0 and job.get('styles')[0].startswith('random'):
+            return False
+        if '__' in job.get('prompt') or '__' in job.get('neg_prompt'):
+            # wildcards are picked per job
+            return False
+        return True
+
+
+    # merges queued jobs that differ from job only by their (random) seed and position in
+    # the queue into job, as one request w/ a larger batch size; looks as far ahead in the
+    # queue as the scheduler does, so identical jobs needn't be next to each other
+    # disabled unless COALESCE_MAX_BATCH is set
+    def coalesce_work(self, job):
+        limit = self.config['coalesce_max_batch']
+        if limit <= 1 or not self.is_coalescable(job):
+            return job
+
+        batch_size = int(job.get('batch_size'))
+        # job may already be a merged one (e.g. re-queued after its GPU failed)
+        seqs = list(job.get('job_seqs', [job.get('job_seq')]))
+        merged_count = len(seqs)
+        window = max(1, self.config['scheduler_lookahead'])
+        with self.work_queue.lock:
+            matches = []
+            for i in range(min(len(self.work_queue), window)):
+                next_job = self.work_queue[i]
+                next_seqs = next_job.get('job_seqs', [next_job.get('job_seq')])
+                if batch_size * (len(seqs) + len(next_seqs)) > limit:
+                    continue
+                if self.is_coalescable(next_job) and job.same_as(next_job, ['job_seq', 'job_seqs', 'coalesced', 'seed', 'retries']):
+                    matches.append(i)
+                    seqs.extend(next_seqs)
+            for i in reversed(matches):
+                del self.work_queue[i]
+
+        if len(seqs) == merged_count:
+            return job
+        # batch_size is left alone so that image metadata reflects the original jobs;
+        # Worker multiplies it by the number of merged jobs when making the request
+        merged = job.copy()
+        merged['job_seqs'] = seqs
+        merged['coalesced'] = len(seqs)
+        return merged
 
 
     def clear_work_queue(self):
         self.print("clearing work queue...")
         self.work_queue.clear()
+        for worker in self.workers:
+            if 'prefetch' in worker:
+                worker['prefetch'] = None
         self.loops = 0
         self.jobs_done = 0
-        self.orig_work_queue_size = 0
+        self.publish('queue', {'length' : 0, 'total' : 0})
+
+
+    # returns the total number of jobs in the current work queue (including those already done)
+    # standard mode queues are expanded lazily, so this may grow as directories are expanded
+    def work_queue_total(self):
+        return self.work_queue.total
 
 
     # build a work queue with the specified prompt and style files
-    def init_work_queue(self):
-
-        # check for a multiple models scenario
-        # BK 2023-10-30
-        check_main = False
-        if len(self.highres_models) > 0:
-            # we have multiple high-res models, iterate through all of them
-            # before switching main model
-            if self.highres_model_index < len(self.highres_models)-1:
-                self.highres_model_index += 1
+    # resume is the journal state of an interrupted run of this prompt file, if any
+    def init_work_queue(self, resume = None):
+        mode = self.prompt_manager.config.get('mode')
+        if resume != None and (mode == 'random' or resume['mode'] != mode):
+            resume = None
+
+        if resume != None:
+            # pick up the model rotation where the interrupted run left off
+            self.loops = resume['loops']
+            self.model_index = resume['model_index']
+            self.highres_model_index = resume['highres_model_index']
+            if self.highres_model_index >= 0 and self.highres_model_index < len(self.highres_models):
+                self.prompt_manager.config['highres_ckpt_file'] = self.highres_models[self.highres_model_index]
+            if self.model_index >= 0 and self.model_index < len(self.models):
+                self.prompt_manager.config['ckpt_file'] = self.models[self.model_index]
+            self.prompt_manager.config_changed()
+
+        else:
+            # check for a multiple models scenario
+            # BK 2023-10-30
+            check_main = False
+            if len(self.highres_models) > 0:
+                # we have multiple high-res models, iterate through all of them
+                # before switching main model
+                if self.highres_model_index < len(self.highres_models)-1:
+                    self.highres_model_index += 1
+                else:
+                    self.highres_model_index = 0
+                    check_main = True
+                new_model = self.highres_models[self.highres_model_index]
+                self.prompt_manager.config['highres_ckpt_file'] = new_model
+                self.prompt_manager.config_changed()
             else:
-                self.highres_model_index = 0
                 check_main = True
-            new_model = self.highres_models[self.highres_model_index]
-            self.prompt_manager.config['highres_ckpt_file'] = new_model
-        else:
-            check_main = True
 
-        if check_main and len(self.models) > 0:
-            # a models list was preserved, need to switch to next ckpt
-            # move to next model
-            if self.model_index < len(self.models)-1:
-                self.model_index += 1
+            if check_main and len(self.models) > 0:
+                # a models list was preserved, need to switch to next ckpt
+                # move to next model
+                if self.model_index < len(self.models)-1:
+                    self.model_index += 1
+                else:
+                    self.model_index = 0
+                new_model = self.models[self.model_index]
+                self.prompt_manager.config['ckpt_file'] = new_model
+                self.prompt_manager.config_changed()
             else:
-                self.model_index = 0
-            new_model = self.models[self.model_index]
-            self.prompt_manager.config['ckpt_file'] = new_model
-        else:
-            if self.model_index < 0:
-                # handle start case when both are at -1 and main won't be checked
-                self.model_index = 0
+                if self.model_index < 0:
+                    # handle start case when both are at -1 and main won't be checked
+                    self.model_index = 0
 
         # process mode
-        if self.prompt_manager.config.get('mode') == 'process':
-            self.work_queue = self.prompt_manager.build_process_work()
-            self.orig_work_queue_size = len(self.work_queue)
+        if mode == 'process':
+            self.work_queue = utils.WorkQueue(self.prompt_manager.build_process_work())
 
         # random mode; queue up a few random prompts
-        elif self.prompt_manager.config.get('mode') == 'random':
-            for i in range(self.config['random_queue_size']):
-                #work = "Test work item #" + str(i+1)
-                work = self.prompt_manager.config.copy()
-                work['prompt'] = self.prompt_manager.pick_random()
-                work['prompt_file'] = self.prompt_file
-                self.work_queue.append(work)
-
-        # standard mode, grab all possible combos
+        elif mode == 'random':
+            self.work_queue = utils.WorkQueue(self.random_work(self.config['random_queue_size']), self.config['random_queue_size'])
+
+        # standard mode, combos are expanded as workers ask for them
         else:
             self.work_queue = self.prompt_manager.build_combinations()
-            self.orig_work_queue_size = len(self.work_queue)
+
+        # skip the jobs that have already been done
+        if resume != None:
+            self.work_queue.set_skip(resume['finished'])
+            self.jobs_done = resume.get('jobs_done', len(resume['finished']))
+            if not resume.get('reloaded', False):
+                self.print("resuming interrupted work: " + str(self.jobs_done) + " job(s) were already done before the last shutdown (re-load this prompt file from the control panel to start over)")
+
+        # record progress so this run can be resumed if interrupted
+        if self.journal != None:
+            if mode == 'random':
+                self.journal.stop_recording()
+            else:
+                self.journal.start_run(self.prompt_file, mode, self.loops, self.model_index, self.highres_model_index, resume != None)
 
         self.print("queued " + str(len(self.work_queue)) + " work items.")
+        self.publish('queue', {'length' : len(self.work_queue), 'total' : self.work_queue_total()})
+
+
+    # generator for random mode work items
+    def random_work(self, count):
+        for i in range(count):
+            work = self.prompt_manager.new_work_item()
+            work['prompt'] = self.prompt_manager.pick_random()
+            work['prompt_file'] = self.prompt_file
+            yield work
 
 
     # loads a new prompt file
     # note that new_file is an absolute path reference
-    def new_prompt_file(self, new_file):
+    # resume is where to pick up from (see init_work_queue), if not from the journal
+    def new_prompt_file(self, new_file, resume = None):
         # if we haven't validated models/etc, defer loading
         if not self.default_model_validated:
             self.print("Waiting for model initialization to finish before loading requested prompt file...")
@@ -2593,7 +3312,40 @@ class Controller:
             self.prompt_manager.handle_config()
             self.input_manager = utils.InputManager(self.prompt_manager.config.get('random_input_image_dir'))
 
-            self.init_work_queue()
+            # offer to resume if this file was interrupted last session
+            # (only for the first prompt file loaded after startup)
+            if resume == None and self.journal != None and not self.journal_resume_checked:
+                self.journal_resume_checked = True
+                if self.config['resume_interrupted_work']:
+                    resume = self.journal.get_resume_state(new_file)
+
+            self.init_work_queue(resume)
+        self.notify_dispatcher()
+
+
+    # re-loads the current prompt file so that it's validated against SD's latest models/
+    # samplers/schedulers, picking up where it left off: jobs that are done or running
+    # aren't queued again (prefetched jobs are, since they were prepared w/ the old config)
+    def revalidate_prompt_file(self):
+        if self.prompt_file == '' or self.prompt_manager == None or not self.default_model_validated:
+            return
+        self.print("SD's available models/samplers/schedulers have changed; re-checking the current prompt file...")
+        taken = self.work_queue.taken()
+        for worker in self.workers:
+            if worker.get('prefetch') != None:
+                command = worker['prefetch'].command
+                for seq in command.get('job_seqs', [command.get('job_seq')]):
+                    taken.discard(seq)
+        resume = {
+            'mode' : self.prompt_manager.config.get('mode'),
+            'loops' : self.loops,
+            'model_index' : self.model_index,
+            'highres_model_index' : self.highres_model_index,
+            'finished' : taken,
+            'jobs_done' : self.jobs_done,
+            'reloaded' : True
+        }
+        self.new_prompt_file(self.prompt_file, resume)
 
 
     # sets a new active editor file
@@ -2830,7 +3582,7 @@ class Controller:
                     if not found:
                         # queue the actual upscale
                         prompt_manager = utils.PromptManager(self, False)
-                        work = prompt_manager.config.copy()
+                        work = prompt_manager.new_work_item()
                         work['prompt_file'] = ''
                         work['mode'] = 'process'
                         work['input_image'] = actual_path
@@ -2843,9 +3595,12 @@ class Controller:
                         work['filename'] = '<input-img>'
                         work['prompt'] = 'df_gallery_upscale'
                         self.upscale_work_queue.append(work.copy())
+                        if self.journal != None:
+                            self.journal.add_upscale(work)
                         response = actual_file + " queued for upscaling!"
                         if self.is_paused:
                             self.is_paused = False
+                        self.notify_dispatcher()
                     else:
                         response = actual_file + " is already queued for upscaling!"
                 else:
@@ -2975,6 +3730,7 @@ class Controller:
                 self.config['ckpt_file'] = ''
                 self.print("*** WARNING: config.txt file command PF_CKPT_FILE value (" + model + ") doesn't match any server values; ignoring it! ***")
         self.default_model_validated = True
+        self.notify_dispatcher()
 
 
     def check_default_upscaler(self):
@@ -3101,6 +3857,13 @@ class Controller:
             print(out_txt)
         # also write to buffer for webserver use
         self.output_buffer.append(out_txt + '\n')
+        self.publish('log', out_txt + '\n')
+
+
+    # lets any web UI pages that are listening know something has changed
+    # (see ArtGeneratorWebService.GET)
+    def publish(self, type, data = ''):
+        self.events.publish(type, data)
 
 
     # returns how many worker inits are happening right now,
@@ -3108,12 +3871,23 @@ class Controller:
     def current_active_inits(self):
         active_inits = 0
         for worker in self.workers:
-            if worker['sdi_instance'].init and not worker['sdi_instance'].ready:
+            if worker['sdi_instance'].init and not worker['sdi_instance'].ready and not worker['sdi_instance'].boot_failed:
                 # we started init but it isn't ready, therefore in process of init
                 active_inits += 1
         return active_inits
 
 
+    # one-line summary of how long each GPU's SD instance took to start, for the status panel
+    def boot_time_status(self):
+        times = []
+        for worker in self.workers:
+            if worker['sdi_instance'].ready and worker['sdi_instance'].boot_time > 0:
+                times.append(str(worker['id']) + ': ' + str(round(worker['sdi_instance'].boot_time)) + 's')
+        if len(times) == 0:
+            return ''
+        return 'GPU startup times: ' + ', '.join(times)
+
+
 # entry point
 if __name__ == '__main__':
 
@@ -3142,12 +3916,16 @@ if __name__ == '__main__':
         exit()
 
     # main work loop
+    # sleeps until something signals the dispatcher (worker freed, new work queued, etc)
     while not control.work_done:
+        control.dispatch_event.clear()
+
         # check for un-initialized workers
         for worker in control.workers:
             if not worker['sdi_instance'].init:
                 if control.current_active_inits() < control.config['gpu_init_stagger']:
                     # init this worker as long as we're not already at the init limit
+                    # (returns right away; the worker becomes ready in the background)
                     worker['sdi_instance'].initialize()
 
         # do background civitai hash/lookup work
@@ -3173,6 +3951,11 @@ if __name__ == '__main__':
             control.civitai_new_stage = False
             control.civitai_startup()
 
+        if control.prompt_file_revalidate:
+            # SD's models/samplers/schedulers have changed since the prompt file was loaded
+            control.prompt_file_revalidate = False
+            control.revalidate_prompt_file()
+
         # check for idle workers
         worker = control.get_idle_gpu_worker()
         skip = False
@@ -3185,82 +3968,13 @@ if __name__ == '__main__':
                 worker['sdi_setup_request_made'] = True
                 skip = True
 
-            if not control.sdi_sampler_request_made:
-                # get available samplers from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_samplers()
-                control.sdi_sampler_request_made = True
-                skip = True
-
-            if not control.sdi_scheduler_request_made:
-                # get available schedulers from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_schedulers()
-                control.sdi_scheduler_request_made = True
-                skip = True
-
-            if not control.sdi_model_request_made:
-                # get available models from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_models()
-                control.sdi_model_request_made = True
-                skip = True
-
-            if not control.sdi_hypernetwork_request_made:
-                # get available hypernetworks from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_hypernetworks()
-                control.sdi_hypernetwork_request_made = True
-                skip = True
-
-            if not control.sdi_lora_request_made:
-                # get available loras from the server
-                # when the first worker is ready
-                #worker['sdi_instance'].update_server_loras()
-                worker['sdi_instance'].get_server_loras()
-                control.sdi_lora_request_made = True
-                skip = True
-
-            if not control.sdi_VAE_request_made:
-                # get available VAEs from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_VAEs()
-                control.sdi_VAE_request_made = True
-                skip = True
-
-            if not control.sdi_style_request_made:
-                # get available styles from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_styles()
-                control.sdi_style_request_made = True
-                skip = True
-
-            if not control.sdi_script_request_made:
-                # get available scripts from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_scripts()
-                control.sdi_script_request_made = True
-                skip = True
+            if not control.capabilities.requested:
+                # query SD for available samplers, models, LoRAs, etc when the first worker
+                # is ready; these all go out at once and are handled in the background
+                control.capabilities.refresh(worker['sdi_instance'])
 
-            if not control.sdi_upscaler_request_made:
-                # get available upscalers from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_upscalers()
-                control.sdi_upscaler_request_made = True
-                skip = True
-
-            if not control.sdi_controlnet_request_made and control.sdi_controlnet_available:
-                # get available controlnet models from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_controlnet_models()
-                control.sdi_controlnet_request_made = True
-                skip = True
-
-            if not control.sdi_controlnet_pre_request_made and control.sdi_controlnet_available:
-                # get available controlnet modules from the server
-                # when the first worker is ready
-                worker['sdi_instance'].get_server_controlnet_modules()
-                control.sdi_controlnet_pre_request_made = True
+            if not control.capabilities.ready:
+                # no cached capabilities to go on; wait for SD's answers before starting work
                 skip = True
 
             # worker is idle, start some work
@@ -3277,10 +3991,25 @@ if __name__ == '__main__':
                     # check for gallery upscale jobs in the queue
                     new_work = control.upscale_work_queue.popleft()
                     control.do_work(worker, new_work)
+                elif control.has_prefetched_work(worker):
+                    # next job was already prepared while this worker was busy
+                    job = control.take_prefetched_work(worker)
+                    control.do_work(worker, job.command, job)
                 elif len(control.work_queue) > 0:
                     # get a new prompt or setting directive from the queue
-                    new_work = control.work_queue.popleft()
-                    control.do_work(worker, new_work)
+                    # the scheduler may hand it to a different idle worker that already has the right model loaded
+                    worker, new_work = control.scheduler.next_job(worker)
+                    if new_work != None:
+                        new_work = control.coalesce_work(new_work)
+                        control.do_work(worker, new_work)
+                    else:
+                        # what's left is being held for faster GPUs (see Scheduler.tail_job);
+                        # sleep until one of them frees up
+                        control.wait_for_dispatch()
+                elif control.prefetched_work_pending() and not (control.prompt_manager != None and control.prompt_manager.config.get('mode') == 'random'):
+                    # the last jobs are prepared and waiting for the workers that will run them
+                    # (see Scheduler.can_take_prefetched); the run isn't over until they've started
+                    control.wait_for_dispatch()
                 else:
                     # if we're in random prompts mode, re-fill the queue
                     if control.prompt_manager != None and control.prompt_manager.config.get('mode') == 'random':
@@ -3307,6 +4036,10 @@ if __name__ == '__main__':
                                 should_stop = True
 
                         if should_stop:
+                            # nothing left to resume for this prompt file
+                            if control.journal != None and control.prompt_file != '':
+                                control.journal.end_run(control.prompt_file)
+
                             # check if user specified a prompt file to load upon completion
                             if control.prompt_manager != None and control.prompt_manager.config.get('next_prompt_file') != "":
                                 fname = utils.filename_from_abspath(control.prompt_manager.config.get('next_prompt_file'))
@@ -3318,8 +4051,7 @@ if __name__ == '__main__':
                                 # no more jobs, wait for all workers to finish
                                 if control.jobs_done > 0:
                                     control.print('No more work in queue; waiting for all workers to finish...')
-                                while control.num_workers_working() > 0:
-                                    time.sleep(.05)
+                                control.wait_for_workers()
                                 if control.jobs_done > 0:
                                     control.print('All work done; pausing server - add some more work via the control panel!')
                                 else:
@@ -3330,10 +4062,13 @@ if __name__ == '__main__':
                             control.jobs_done = 0
                             control.init_work_queue()
             else:
-                time.sleep(.1)
+                control.wait_for_dispatch()
 
         else:
-            time.sleep(.05)
+            # all workers are busy; get their next jobs ready in the meantime
+            if not control.is_paused and control.default_model_validated:
+                control.prefetch_work()
+            control.wait_for_dispatch()
 
     print('\nShutting down...')
     if control and control.total_jobs_done > 0:
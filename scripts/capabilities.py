@@ -0,0 +1,192 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+import os
+import time
+import json
+import threading
+from pathlib import Path
+from scripts.sdi import SDIRequest
+from scripts.sdclient import SDResponse, SDClientError
+
+
+# for capability queries; a failed query is passed to the callback as None instead of
+# failing the SD instance's current request (see SDI.request_done)
+class CapabilityRequest(SDIRequest):
+    async def fetch(self):
+        try:
+            return await SDIRequest.fetch(self)
+        except SDClientError:
+            return None
+
+
+# what SD has available for use (samplers, models, LoRAs, etc)
+# the lists are saved to disk so that on the next start they can be used right away,
+# before any SD instance is up; once the first one is, they're all re-queried at once
+# in the background and anything that has changed is updated
+class Capabilities:
+    # name, API endpoint, SDI response handler, only queried if ControlNet is installed
+    QUERIES = [
+        ('samplers', '/sdapi/v1/samplers', 'sampler_response', False),
+        ('schedulers', '/sdapi/v1/schedulers', 'scheduler_response', False),
+        ('models', '/sdapi/v1/sd-models', 'model_response', False),
+        ('hypernetworks', '/sdapi/v1/hypernetworks', 'hypernetwork_response', False),
+        ('loras', '/sdapi/v1/loras', 'lora_response', False),
+        ('vaes', '/sdapi/v1/sd-vae', 'VAE_response', False),
+        ('styles', '/sdapi/v1/prompt-styles', 'style_response', False),
+        ('scripts', '/sdapi/v1/scripts', 'script_response', False),
+        ('upscalers', '/sdapi/v1/upscalers', 'upscaler_response', False),
+        ('controlnet_models', '/controlnet/model_list', 'controlnet_model_response', True),
+        ('controlnet_modules', '/controlnet/module_list', 'controlnet_module_response', True)
+    ]
+
+    # lists that prompt files are validated against
+    REVALIDATE = ['models', 'samplers', 'schedulers']
+
+    def __init__(self, control_ref, filename = os.path.join('cache', 'sd-capabilities.json')):
+        self.control_ref = control_ref
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.key = ''
+        self.cached = {}            # name: raw response, as loaded from disk
+        self.received = {}          # name: raw response, from SD this run
+        self.pending = 0
+        self.requested = False      # have we queried SD yet?
+        self.ready = False          # do we have every list (from the cache or SD)?
+
+
+    # identifies the SD installation the cache was built from: its location, the git
+    # commit it's checked out at, and its installed extensions
+    def fingerprint(self):
+        sd_location = self.control_ref.config.get('sd_location')
+        if sd_location == '':
+            # only attached/remote instances; all we know is where they are
+            urls = []
+            for worker in self.control_ref.workers:
+                if worker.get('sdi_instance') != None:
+                    urls.append(worker['sdi_instance'].url)
+            return ', '.join(urls)
+
+        key = os.path.abspath(sd_location)
+        try:
+            git_dir = os.path.join(sd_location, '.git')
+            with open(os.path.join(git_dir, 'HEAD'), 'r') as f:
+                head = f.read().strip()
+            if head.startswith('ref:'):
+                ref = os.path.join(git_dir, head.split(':', 1)[1].strip())
+                if os.path.exists(ref):
+                    with open(ref, 'r') as f:
+                        head = f.read().strip()
+            key += '@' + head
+        except OSError:
+            pass
+        try:
+            extensions = sorted(os.listdir(os.path.join(sd_location, 'extensions')))
+            key += ' [' + ', '.join(extensions) + ']'
+        except OSError:
+            pass
+        return key
+
+
+    # the queries that apply to this setup
+    def queries(self):
+        queries = []
+        for query in self.QUERIES:
+            if not query[3] or self.control_ref.sdi_controlnet_available:
+                queries.append(query)
+        return queries
+
+
+    # loads the saved lists, if they're from the same SD installation, and hands them to
+    # the same handlers that would have processed SD's responses
+    def load(self, sdi):
+        self.key = self.fingerprint()
+        try:
+            with open(self.filename, 'r', encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if data.get('key') != self.key:
+            self.control_ref.print('SD installation has changed since capabilities were cached; they\'ll be re-queried...')
+            return False
+
+        lists = data.get('lists', {})
+        for name, endpoint, handler, controlnet in self.queries():
+            if name not in lists:
+                return False
+        self.control_ref.print('using SD capabilities cached on ' + time.strftime('%Y-%m-%d %H:%M', time.localtime(data.get('saved', 0))) + ' until an SD instance is ready...')
+        try:
+            for name, endpoint, handler, controlnet in self.queries():
+                getattr(sdi, handler)(SDResponse(200, lists[name].encode('utf-8')), False)
+        except Exception as e:
+            self.control_ref.print('*** WARNING: unable to use cached SD capabilities (' + str(e) + '); they\'ll be re-queried! ***')
+            return False
+        self.cached = lists
+        self.ready = True
+        return True
+
+
+    # queries an SD instance for everything at once, in the background
+    def refresh(self, sdi):
+        queries = self.queries()
+        self.requested = True
+        with self.lock:
+            self.pending = len(queries)
+        for name, endpoint, handler, controlnet in queries:
+            if CapabilityRequest(sdi, 'GET', endpoint, callback=self.handle, callback_args=(sdi, name, handler)).start() == None:
+                self.query_done()
+
+
+    # callback for each query; runs on the SD client's callback pool
+    # lists that are the same as the cached ones have already been applied, so are skipped
+    def handle(self, response, sdi, name, handler):
+        try:
+            if response == None:
+                raise SDClientError('no response')
+            response.raise_for_status()
+            if self.cached.get(name) != response.text:
+                getattr(sdi, handler)(response, False)
+            with self.lock:
+                self.received[name] = response.text
+        except Exception as e:
+            sdi.log('*** unable to get ' + name.replace('_', ' ') + ' from SD (' + str(e) + ')! ***', True)
+        self.query_done()
+
+
+    # once all queries are back, updates the cache if anything has changed
+    def query_done(self):
+        with self.lock:
+            self.pending -= 1
+            if self.pending > 0:
+                return
+            changed = []
+            for name in self.received:
+                if self.cached.get(name) != self.received[name]:
+                    changed.append(name.replace('_', ' '))
+            lists = dict(self.cached)
+            lists.update(self.received)
+
+        if len(self.cached) > 0:
+            if len(changed) > 0:
+                self.control_ref.print('SD capabilities have changed since they were cached (' + ', '.join(changed) + '); cache updated...')
+            else:
+                self.control_ref.print('cached SD capabilities are up to date...')
+        if len(changed) > 0:
+            self.save(lists)
+        self.cached = lists
+        self.ready = True
+        # a loaded prompt file was validated against the old lists; have the main
+        # loop re-load it (once, and only if something it's checked against changed)
+        for name in self.REVALIDATE:
+            if name.replace('_', ' ') in changed:
+                self.control_ref.prompt_file_revalidate = True
+        self.control_ref.notify_dispatcher()
+
+
+    def save(self, lists):
+        try:
+            Path(os.path.dirname(self.filename)).mkdir(parents=True, exist_ok=True)
+            with open(self.filename, 'w', encoding="utf-8") as f:
+                json.dump({'key' : self.key, 'saved' : time.time(), 'lists' : lists}, f)
+        except OSError as e:
+            self.control_ref.print('*** WARNING: unable to save SD capabilities cache (' + str(e) + ')! ***')
@@ -263,6 +263,7 @@ class BackgroundWorker():
         self.control_ref.print('Finished background civitai.com lookups for ' + str(count) + ' uncached ' + desc + '...')
         self.control_ref.civitai_startup_stage += 1
         self.control_ref.civitai_new_stage = True
+        self.control_ref.notify_dispatcher()
         self.working = False
 
 
@@ -281,6 +282,7 @@ class BackgroundWorker():
         self.control_ref.print('Finished background hash calculations for ' + str(count) + ' uncached ' + desc + '...')
         self.control_ref.civitai_startup_stage += 1
         self.control_ref.civitai_new_stage = True
+        self.control_ref.notify_dispatcher()
         self.working = False
 
     # for debugging
@@ -0,0 +1,83 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+import json
+import threading
+from collections import deque
+
+
+# formats a server-sent event; multi-line data is split across data: fields
+def sse(type, data = '', id = None):
+    buffer = ''
+    if id != None:
+        buffer += 'id: ' + str(id) + '\n'
+    buffer += 'event: ' + type + '\n'
+    if not isinstance(data, str):
+        data = json.dumps(data)
+    for line in data.split('\n'):
+        buffer += 'data: ' + line + '\n'
+    return buffer + '\n'
+
+
+# things that have happened that the web UI wants to know about (log lines, jobs starting
+# and finishing, pause state, etc), so that pages can be pushed changes instead of polling
+# events are numbered; the most recent are kept so a browser that reconnects can pick up
+# where it left off
+class EventBus:
+    def __init__(self, history = 500, max_listeners = 10):
+        self.changed = threading.Condition()
+        self.events = deque([], maxlen=history)
+        self.last_id = 0
+        self.listeners = 0
+        self.max_listeners = max_listeners
+        self.closed = False
+
+
+    def publish(self, type, data = ''):
+        with self.changed:
+            self.last_id += 1
+            self.events.append((self.last_id, type, data))
+            self.changed.notify_all()
+
+
+    # each listener ties up a webserver thread, so there's a limit
+    # returns False if we're at it (the page should poll instead)
+    def subscribe(self):
+        with self.changed:
+            if self.closed or self.listeners >= self.max_listeners:
+                return False
+            self.listeners += 1
+            return True
+
+
+    def unsubscribe(self):
+        with self.changed:
+            self.listeners -= 1
+
+
+    # True if every event after since is still available
+    def has(self, since):
+        with self.changed:
+            if since > self.last_id:
+                return False
+            return len(self.events) == 0 or self.events[0][0] <= since + 1
+
+
+    # waits up to timeout seconds for events after since
+    # returns a list of (id, type, data), which is empty if nothing happened
+    def wait(self, since, timeout):
+        with self.changed:
+            if self.last_id <= since and not self.closed:
+                self.changed.wait(timeout)
+            new = []
+            for event in self.events:
+                if event[0] > since:
+                    new.append(event)
+            return new
+
+
+    # ends all listeners' streams (at shutdown)
+    def close(self):
+        with self.changed:
+            self.closed = True
+            self.changed.notify_all()
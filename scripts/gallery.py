@@ -0,0 +1,392 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import scripts.utils as utils
+from pathlib import Path
+
+
+# builds the gallery display strings for an image from its EXIF prompt details
+# and upscale/ADetailer info
+# returns a dict w/ keys: params, short_prompt, prompt, neg_prompt, param_string, upscale_info
+def describe_image(details, upscale_info):
+    info = upscale_info
+    params = utils.extract_params_from_command(details)
+    param_string = ''
+
+    neg_prompt = params['neg_prompt']
+    if neg_prompt != "":
+        neg_prompt = neg_prompt.replace('<', '&lt;').replace('>', '&gt;')
+        neg_prompt = "negative prompt: " + neg_prompt
+
+    short_prompt = params['prompt']
+    if len(params['prompt']) > 302:
+        short_prompt = params['prompt'][:300] + '...'
+
+    prompt = ''
+    if params['prompt'] != '' or params['steps'] != '':
+        if params['prompt'] == '':
+            prompt = '(no prompt)'
+        else:
+            prompt = params['prompt'].replace('<', '&lt;').replace('>', '&gt;')
+
+        if params['width'] != '':
+            if 'highres_scale_factor' in params and params['highres_scale_factor'] != '':
+                calc_width = round(float(params['highres_scale_factor']) * float(params['width']))
+                calc_height = round(float(params['highres_scale_factor']) * float(params['height']))
+                param_string += 'size: ' + str(calc_width) + 'x' + str(calc_height)
+            else:
+                param_string += 'size: ' + str(params['width']) + 'x' + str(params['height'])
+
+        if params['input_image'] != "":
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'init image: ' + params['input_image'] + '  |  strength: ' + str(params['strength'])
+
+        if params['ckpt_file'] != '':
+            if param_string != '':
+                param_string += '  |  '
+            # remove the hash from the string
+            model = str(params['ckpt_file'])
+            model = model.split('[', 1)[0].strip()
+            param_string += 'model: ' + model
+
+        if params['tiling'] == 'yes':
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'seamless tiling enabled'
+
+        if params['controlnet_input_image'] != '' and (params['controlnet_model'] != '' or 'reference' in params['controlnet_pre']):
+            if param_string != '':
+                param_string += '  |  '
+            # remove the hash from the model string
+            model = str(params['controlnet_model'])
+            model = model.split('[', 1)[0].strip()
+            param_string += 'ControlNet enabled: ' + params['controlnet_input_image'] + ' (' + model + ')'
+            if params['controlnet_controlmode'] == 'prompt':
+                param_string += ' (favor prompt)'
+            elif params['controlnet_controlmode'] == 'controlnet':
+                param_string += ' (favor ControlNet)'
+            if params['controlnet_pixelperfect'] == 'yes':
+                param_string += ' (pixel perfect)'
+
+        if params['adetailer_model'] != '':
+            if param_string != '':
+                param_string += '  |  '
+            # remove the hash from the model string
+            model = str(params['adetailer_model'])
+            model = model.split('[', 1)[0].strip()
+            param_string += 'ADetailer enabled ' + ' (' + model + ')'
+
+        if params['sampler'] != '':
+            sampler_full_name = str(params['sampler'])
+            if 'scheduler' in params and params['scheduler'] != '' and params['scheduler'].lower() != 'automatic':
+                sampler_full_name += ' ' + str(params['scheduler'])
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'sampler: ' + sampler_full_name
+
+        if params['steps'] != '':
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'steps: ' + str(params['steps'])
+
+        if params['scale'] != '':
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'scale: ' + str(params['scale'])
+
+        if params['clip_skip'] != '':
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'CLIP skip: ' + str(params['clip_skip'])
+
+        if params['vae'] != '':
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'VAE: ' + str(params['vae'])
+
+        if 'refiner_ckpt_file' in params and params['refiner_ckpt_file'] != '':
+            if param_string != '':
+                param_string += '  |  '
+            model = str(params['refiner_ckpt_file'])
+            model = model.split('[', 1)[0].strip()
+            param_string += 'refiner: ' + model
+            if 'refiner_switch' in params and params['refiner_switch'] != '':
+                param_string += ' (switch at ' + str(params['refiner_switch']) + ')'
+
+        if params['styles'] != '':
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'style(s): ' + str(params['styles'].replace('Style: ', ''))
+
+        show_denoise = False
+        if 'highres_scale_factor' in params and params['highres_scale_factor'] != '' and params['width'] != '':
+            show_denoise = True
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'highres fix applied: ' + str(params['highres_scale_factor']) + 'x scaling on ' + str(params['width']) + 'x' + str(params['height'])
+
+        if 'highres_ckpt_file' in params and params['highres_ckpt_file'] != '':
+            show_denoise = True
+            if param_string != '':
+                param_string += '  |  '
+            model = str(params['highres_ckpt_file'])
+            model = model.split('[', 1)[0].strip()
+            param_string += 'HR fix model: ' + model
+
+        if 'highres_upscaler' in params and params['highres_upscaler'] != '':
+            show_denoise = True
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'HR fix upscaler: ' + str(params['highres_upscaler'])
+
+        if 'highres_sampler' in params and params['highres_sampler'] != '':
+            show_denoise = True
+            hr_sampler_full_name = str(params['highres_sampler'])
+            if 'highres_scheduler' in params and params['highres_scheduler'] != '' and params['highres_scheduler'].lower() != 'automatic':
+                hr_sampler_full_name += ' ' + str(params['highres_scheduler'])
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'HR fix sampler: ' + hr_sampler_full_name
+
+        if 'highres_steps' in params and params['highres_steps'] != '':
+            show_denoise = True
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'HR fix steps: ' + str(params['highres_steps'])
+
+        if show_denoise and params['strength'] != '':
+            param_string += '  |  '
+            param_string += 'HR fix denoising: ' + str(params['strength'])
+
+        if params['seed'] != '':
+            if param_string != '':
+                param_string += '  |  '
+            param_string += 'seed: ' + str(params['seed'])
+
+        ad_info = upscale_info
+        if '(upscaled' in upscale_info:
+            upscale_info = upscale_info.split('(upscaled', 1)[1]
+            if '(ADetailer' in upscale_info:
+                upscale_info = upscale_info.split('(ADetailer', 1)[0]
+            upscale_info = upscale_info.replace(')', '').strip()
+            upscale_info = "upscaled " + upscale_info
+            if param_string != '':
+                param_string += '  |  '
+            param_string += upscale_info
+
+        if '(ADetailer' in ad_info:
+            ad_info = ad_info.split('(ADetailer', 1)[1]
+            ad_info = ad_info.replace(')', '').strip()
+            ad_info = "ADetailer " + ad_info
+            if param_string != '':
+                param_string += '  |  '
+            param_string += ad_info
+
+    return {
+        'params' : params,
+        'short_prompt' : short_prompt,
+        'prompt' : prompt,
+        'neg_prompt' : neg_prompt,
+        'param_string' : param_string,
+        'upscale_info' : info
+    }
+
+
+# reads an image's EXIF and returns its gallery display strings (see describe_image)
+def read_image_entry(path):
+    exif = utils.read_exif_from_image(path)
+    details = ""
+    upscale_info = ""
+    if exif != None:
+        try:
+            details = exif[0x9c9c].decode('utf16')
+            upscale_info = exif[0x9c9d].decode('utf16')
+        except KeyError as e:
+            pass
+    return describe_image(details, upscale_info)
+
+
+# on-disk index of gallery images and their display strings, keyed by path, so that
+# gallery refreshes don't have to re-read and re-parse the EXIF of every image
+# entries are re-read if an image's mtime or size changes
+class GalleryIndex:
+    def __init__(self, filename = os.path.join('cache', 'gallery.db')):
+        self.lock = threading.Lock()
+        self.scan_thread = None
+        self.closed = False
+        Path(os.path.dirname(filename)).mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS images (
+            path TEXT PRIMARY KEY,
+            mtime REAL,
+            size INTEGER,
+            params TEXT,
+            short_prompt TEXT,
+            prompt TEXT,
+            neg_prompt TEXT,
+            param_string TEXT,
+            upscale_info TEXT)""")
+        self.db.commit()
+
+
+    def key(self, path):
+        return os.path.abspath(path)
+
+
+    def store(self, path, stat, entry):
+        with self.lock:
+            if self.closed:
+                return
+            self.db.execute("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", \
+                (self.key(path), stat.st_mtime, stat.st_size, json.dumps(entry['params']), entry['short_prompt'], \
+                entry['prompt'], entry['neg_prompt'], entry['param_string'], entry['upscale_info']))
+            self.db.commit()
+
+
+    # records a newly-written image, w/ the EXIF prompt details and upscale info it was saved with
+    def add(self, path, details, upscale_info):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        self.store(path, stat, describe_image(details, upscale_info))
+
+
+    # returns the display strings (see describe_image) for each of the given images, in order
+    # images that aren't indexed yet (or have changed since) are read and added
+    def entries(self, paths):
+        rows = {}
+        keys = [self.key(p) for p in paths]
+        with self.lock:
+            if self.closed:
+                return [read_image_entry(p) for p in paths]
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i+500]
+                query = "SELECT * FROM images WHERE path IN (" + ','.join('?' * len(chunk)) + ")"
+                for row in self.db.execute(query, chunk):
+                    rows[row[0]] = row
+
+        entries = []
+        for path, key in zip(paths, keys):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                entries.append(describe_image('', ''))
+                continue
+            row = rows.get(key)
+            if row != None and row[1] == stat.st_mtime and row[2] == stat.st_size:
+                entries.append({
+                    'params' : json.loads(row[3]),
+                    'short_prompt' : row[4],
+                    'prompt' : row[5],
+                    'neg_prompt' : row[6],
+                    'param_string' : row[7],
+                    'upscale_info' : row[8]
+                })
+            else:
+                entry = read_image_entry(path)
+                self.store(path, stat, entry)
+                entries.append(entry)
+        return entries
+
+
+    # indexes any existing images in (and below) the given dirs, and forgets indexed
+    # images that no longer exist; runs in the background
+    def scan(self, dirs):
+        if self.scan_thread != None and self.scan_thread.is_alive():
+            return
+        self.scan_thread = threading.Thread(target=self.do_scan, args=(dirs,), name='gallery-scan', daemon=True)
+        self.scan_thread.start()
+
+
+    def do_scan(self, dirs):
+        with self.lock:
+            indexed = {}
+            for row in self.db.execute("SELECT path, mtime, size FROM images"):
+                indexed[row[0]] = (row[1], row[2])
+
+        for dir in dirs:
+            if dir == '' or not os.path.isdir(dir):
+                continue
+            for root, subdirs, files in os.walk(dir):
+                for f in files:
+                    if not f.lower().endswith('.jpg'):
+                        continue
+                    path = os.path.join(root, f)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    if indexed.get(self.key(path)) != (stat.st_mtime, stat.st_size):
+                        self.store(path, stat, read_image_entry(path))
+
+        gone = []
+        for key in indexed:
+            if not os.path.exists(key):
+                gone.append((key,))
+        if len(gone) > 0:
+            with self.lock:
+                if self.closed:
+                    return
+                self.db.executemany("DELETE FROM images WHERE path = ?", gone)
+                self.db.commit()
+
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.db.close()
+
+
+# remembers recent versions of the gallery (the ids and mtimes of the images in it, in
+# display order) so that browsers can be sent just what has changed since the version
+# they last saw, instead of the whole thing
+class GalleryHistory:
+    def __init__(self, max_versions = 16):
+        self.lock = threading.Lock()
+        self.max_versions = max_versions
+        self.versions = OrderedDict()
+
+
+    # records a version of the gallery; returns its tag
+    # items is a list of (id, mtime) in display order
+    def record(self, location, items):
+        h = hashlib.sha1(location.encode('utf-8'))
+        for id, mtime in items:
+            h.update((id + ':' + str(mtime) + '\n').encode('utf-8'))
+        tag = h.hexdigest()[:16]
+        with self.lock:
+            self.versions[tag] = (location, items)
+            self.versions.move_to_end(tag)
+            while len(self.versions) > self.max_versions:
+                self.versions.popitem(last=False)
+        return tag
+
+
+    # returns (removed ids, added (id, id of the item it follows) pairs) to get from
+    # version tag to the given items, or None if we don't have that version anymore
+    # (or it's from a different location); changed images count as removed and re-added
+    def changes(self, tag, location, items):
+        with self.lock:
+            old = self.versions.get(tag)
+        if old == None or old[0] != location:
+            return None
+        old_items = set(old[1])
+        new_items = set(items)
+        removed = [id for id, mtime in old[1] if (id, mtime) not in new_items]
+        added = []
+        previous = ''
+        for item in items:
+            if item not in old_items:
+                added.append((item[0], previous))
+            previous = item[0]
+        return removed, added
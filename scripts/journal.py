@@ -0,0 +1,187 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+
+# on-disk record of work in progress so that an interrupted prompt file can
+# be resumed after a crash/restart instead of starting over from the beginning
+# finished jobs are buffered in memory and written in batches
+class Journal:
+    def __init__(self, filename = os.path.join('cache', 'journal.db'), batch_size = 20, batch_seconds = 10):
+        self.lock = threading.Lock()
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.pending = []
+        self.last_flush = time.time()
+        self.run_file = ''
+        self.position = None
+
+        Path(os.path.dirname(filename)).mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS runs (
+            prompt_file TEXT PRIMARY KEY,
+            file_hash TEXT,
+            mode TEXT,
+            loops INTEGER,
+            model_index INTEGER,
+            highres_model_index INTEGER,
+            position INTEGER,
+            updated REAL)""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS finished (
+            prompt_file TEXT,
+            job_seq INTEGER,
+            PRIMARY KEY (prompt_file, job_seq))""")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS upscales (
+            input_image TEXT PRIMARY KEY,
+            work TEXT,
+            added REAL)""")
+        self.db.commit()
+
+
+    # returns a hash of the prompt file contents
+    def hash_file(self, filename):
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+
+    # returns the saved state for an unfinished run of this prompt file, or None
+    # if there isn't one or the file has changed since it was recorded
+    # state is a dict w/ keys: mode, loops, model_index, highres_model_index, position, finished
+    def get_resume_state(self, prompt_file):
+        with self.lock:
+            row = self.db.execute("SELECT file_hash, mode, loops, model_index, highres_model_index, position FROM runs WHERE prompt_file = ?", (prompt_file,)).fetchone()
+            if row == None:
+                return None
+            try:
+                if row[0] != self.hash_file(prompt_file):
+                    return None
+            except OSError:
+                return None
+            finished = set()
+            for r in self.db.execute("SELECT job_seq FROM finished WHERE prompt_file = ?", (prompt_file,)):
+                finished.add(r[0])
+            return {
+                'mode' : row[1],
+                'loops' : row[2],
+                'model_index' : row[3],
+                'highres_model_index' : row[4],
+                'position' : row[5],
+                'finished' : finished
+            }
+
+
+    # records the start of a new pass through a prompt file
+    # when resuming, finished jobs are kept; otherwise they're cleared
+    def start_run(self, prompt_file, mode, loops, model_index, highres_model_index, resume = False):
+        self.flush()
+        with self.lock:
+            try:
+                file_hash = self.hash_file(prompt_file)
+            except OSError:
+                file_hash = ''
+            position = 0
+            if resume:
+                row = self.db.execute("SELECT position FROM runs WHERE prompt_file = ?", (prompt_file,)).fetchone()
+                if row != None:
+                    position = row[0]
+            else:
+                self.db.execute("DELETE FROM finished WHERE prompt_file = ?", (prompt_file,))
+            self.db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", \
+                (prompt_file, file_hash, mode, loops, model_index, highres_model_index, position, time.time()))
+            self.db.commit()
+            self.run_file = prompt_file
+            self.position = position
+
+
+    # records the furthest position dispatched in the current run
+    def set_position(self, position):
+        with self.lock:
+            self.position = position
+
+
+    # records a finished job in the current run
+    def job_finished(self, prompt_file, job_seq):
+        with self.lock:
+            if self.run_file == '' or prompt_file != self.run_file:
+                # job from a prompt file that's no longer loaded
+                return
+            self.pending.append((self.run_file, job_seq))
+            flush = len(self.pending) >= self.batch_size or time.time() - self.last_flush >= self.batch_seconds
+        if flush:
+            self.flush()
+
+
+    # writes buffered job completions to disk
+    def flush(self):
+        with self.lock:
+            if len(self.pending) > 0:
+                self.db.executemany("INSERT OR IGNORE INTO finished VALUES (?, ?)", self.pending)
+                self.pending = []
+            if self.run_file != '' and self.position != None:
+                self.db.execute("UPDATE runs SET position = MAX(position, ?), updated = ? WHERE prompt_file = ?", (self.position, time.time(), self.run_file))
+            self.db.commit()
+            self.last_flush = time.time()
+
+
+    # removes all records for a prompt file (all work done, or the user started over)
+    def end_run(self, prompt_file):
+        with self.lock:
+            self.pending = [p for p in self.pending if p[0] != prompt_file]
+            self.db.execute("DELETE FROM finished WHERE prompt_file = ?", (prompt_file,))
+            self.db.execute("DELETE FROM runs WHERE prompt_file = ?", (prompt_file,))
+            self.db.commit()
+            if self.run_file == prompt_file:
+                self.run_file = ''
+                self.position = None
+
+
+    # stops recording completions (e.g. for random mode, which can't be resumed)
+    def stop_recording(self):
+        self.flush()
+        with self.lock:
+            self.run_file = ''
+            self.position = None
+
+
+    # persists a queued gallery upscale job
+    def add_upscale(self, work):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO upscales VALUES (?, ?, ?)", (work.get('input_image'), json.dumps(dict(work), default=str), time.time()))
+            self.db.commit()
+
+
+    # removes a gallery upscale job once it's done
+    def remove_upscale(self, input_image):
+        with self.lock:
+            self.db.execute("DELETE FROM upscales WHERE input_image = ?", (input_image,))
+            self.db.commit()
+
+
+    # returns all unfinished gallery upscale jobs, oldest first
+    def get_upscales(self):
+        upscales = []
+        with self.lock:
+            for r in self.db.execute("SELECT work FROM upscales ORDER BY added"):
+                try:
+                    upscales.append(json.loads(r[0]))
+                except ValueError:
+                    pass
+        return upscales
+
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            self.db.close()
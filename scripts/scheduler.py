@@ -0,0 +1,367 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+import time
+import threading
+from datetime import timedelta
+
+
+# picks which queued job goes to which idle GPU worker
+# jobs are matched to workers that already have the needed model loaded so that
+# multi-model prompt files don't cause constant checkpoint swaps between GPUs
+# as the queue runs out, expensive jobs go to the fastest GPUs (see tail_job) so
+# that a slow GPU doesn't end up being the last one still working
+class Scheduler:
+    def __init__(self, control_ref, lookahead = 20, tail_hold = False):
+        self.control_ref = control_ref
+        # how far past the head of the work queue we'll look for a better match
+        self.lookahead = lookahead
+        # near the end of the queue, leave a slow GPU idle rather than give it a job
+        # that a faster (busy) GPU would finish sooner
+        self.tail_hold = tail_hold
+        self.lock = threading.Lock()
+        self.swaps_avoided = 0
+        self.swaps_forced = 0
+        # measured speed of each worker, in job cost units (see job_cost) per second
+        self.rates = {}
+
+
+    # converts a job setting to a number; ranges (e.g. steps = 20-30) count as their midpoint
+    def number(self, value, default):
+        try:
+            if isinstance(value, str) and '-' in value.strip()[1:]:
+                low, high = value.strip().split('-', 1)
+                return (float(low) + float(high)) / 2
+            return float(value)
+        except (TypeError, ValueError):
+            return default
+
+
+    # rough amount of GPU work a job represents: pixels x sampling steps for every image
+    # it makes, plus the same for the highres fix pass if it has one
+    def job_cost(self, job):
+        width = self.number(job.get('width'), 512)
+        height = self.number(job.get('height'), 512)
+        steps = self.number(job.get('steps'), 20)
+        images = self.number(job.get('batch_size'), 1) * self.number(job.get('samples'), 1) * job.get('coalesced', 1)
+        cost = width * height * steps
+        if job.get('highres_fix') == 'yes':
+            scale = self.number(job.get('highres_scale_factor'), 2.0)
+            cost += width * height * scale * scale * self.number(job.get('highres_steps'), steps)
+        return max(1.0, cost * max(1, images))
+
+
+    # updates a worker's measured speed after it finishes a job
+    def job_done(self, worker, job, exec_time):
+        if exec_time <= 0 or job.get('prompt') == 'df_gallery_upscale' or job.get('mode') == 'process':
+            # these don't have a meaningful cost
+            return
+        rate = self.job_cost(job) / exec_time
+        with self.lock:
+            old = self.rates.get(worker['id'])
+            if old == None:
+                self.rates[worker['id']] = rate
+            else:
+                self.rates[worker['id']] = old + 0.3 * (rate - old)
+
+
+    # a worker's measured speed; workers that haven't finished a job yet are assumed
+    # to be average, or None if no worker has
+    def rate(self, worker):
+        rate = self.rates.get(worker['id'])
+        if rate == None and len(self.rates) > 0:
+            rate = sum(self.rates.values()) / len(self.rates)
+        return rate
+
+
+    # estimated seconds until a worker is done with the job it's working on (and its
+    # prefetched next job, if any)
+    def time_remaining(self, worker, include_prefetch = True):
+        rate = self.rate(worker)
+        if rate == None or worker['idle']:
+            return 0
+        remaining = 0
+        job = worker.get('job_prompt_info')
+        if job != None and job != '' and worker['job_start_time'] > 0:
+            remaining = max(0, self.job_cost(job) / rate - (time.time() - worker['job_start_time']))
+        if include_prefetch and worker.get('prefetch') != None:
+            remaining += self.job_cost(worker['prefetch'].command) / rate
+        return remaining
+
+
+    # True if an idle worker should take the job another (busy) worker has prefetched,
+    # rather than leave it for that worker to run once it's free (only matters w/ tail_hold)
+    def can_take_prefetched(self, worker, owner):
+        if not self.tail_hold or owner.get('prefetch') == None:
+            return True
+        rate = self.rate(worker)
+        owner_rate = self.rate(owner)
+        if rate == None or owner_rate == None:
+            return True
+        cost = self.job_cost(owner['prefetch'].command)
+        return self.time_remaining(owner, False) + cost / owner_rate >= cost / rate
+
+
+    # workers that are up and able to take jobs
+    def ready_workers(self):
+        workers = []
+        for worker in self.control_ref.workers:
+            if worker.get('sdi_instance') != None and worker['sdi_instance'].ready:
+                workers.append(worker)
+        return workers
+
+
+    # True once the queue is short enough that how the remaining jobs are split
+    # between fast and slow GPUs determines when the work will be done
+    def in_tail(self, queue):
+        manager = self.control_ref.prompt_manager
+        if manager != None and manager.config.get('mode') == 'random':
+            # the queue is re-filled whenever it runs out
+            return False
+        return len(self.rates) > 0 and len(queue) <= 2 * len(self.ready_workers())
+
+
+    # picks a job for a worker near the end of the queue: the fastest GPU gets the most
+    # expensive remaining job, the slowest GPU gets the cheapest, and the rest in between
+    # returns the job's index in the queue, or None if the job should be held back for
+    # a faster GPU that will be free soon (only w/ tail_hold)
+    def tail_job(self, worker, queue):
+        workers = self.ready_workers()
+        if worker not in workers:
+            workers.append(worker)
+        workers.sort(key=lambda w: self.rate(w), reverse=True)
+        rank = workers.index(worker)
+        order = sorted(range(len(queue)), key=lambda i: self.job_cost(queue[i]), reverse=True)
+        if len(workers) > 1:
+            index = order[round(rank * (len(order) - 1) / (len(workers) - 1))]
+        else:
+            index = order[0]
+
+        if self.tail_hold:
+            cost = self.job_cost(queue[index])
+            finish = self.time_remaining(worker) + cost / self.rate(worker)
+            if self.needs_swap(worker, queue[index]):
+                finish += self.avg_model_load_time()
+            for w in workers[:rank]:
+                if w['idle'] or self.needs_swap(w, queue[index]):
+                    continue
+                if self.time_remaining(w) + cost / self.rate(w) < finish:
+                    return None
+        return index
+
+
+    # estimated seconds until the work queue (and the jobs in progress) are finished,
+    # or -1 if there's no estimate yet
+    def time_to_drain(self):
+        with self.lock:
+            total_rate = 0
+            remaining = 0
+            for worker in self.ready_workers():
+                rate = self.rate(worker)
+                if rate == None:
+                    return -1
+                total_rate += rate
+                remaining = max(remaining, self.time_remaining(worker))
+            if total_rate <= 0:
+                return -1
+            # only a window of the queue is expanded; assume the rest of it
+            # costs the same on average
+            queue = self.control_ref.work_queue
+            jobs = list(queue)
+            if len(jobs) == 0:
+                return remaining
+            cost = 0
+            for job in jobs:
+                cost += self.job_cost(job)
+            cost = cost / len(jobs) * max(len(jobs), len(queue))
+            return max(remaining, cost / total_rate)
+
+
+    # returns the model a job will actually end up using on a worker
+    # (mirrors the model selection logic in Worker.run)
+    def effective_model(self, job):
+        if job.get('mode') == 'process':
+            # process-mode jobs load whatever model the source image needs
+            return None
+        model = job.get('ckpt_file')
+        if model == None or model == '':
+            if self.control_ref.default_model_validated:
+                model = self.control_ref.config.get('ckpt_file')
+        if model == None or model == '':
+            # job will run on whatever model happens to be loaded
+            return None
+        return model
+
+
+    # returns True if sending this job to this worker requires a model load
+    def needs_swap(self, worker, job):
+        model = self.effective_model(job)
+        return model != None and model != worker['sdi_instance'].model_loaded
+
+
+    # how well a job fits a worker; higher is better, < 4 means a model swap is needed
+    def score(self, worker, job):
+        score = 0
+        sdi = worker['sdi_instance']
+        if not self.needs_swap(worker, job):
+            score += 4
+        if job.get('highres_ckpt_file', '') == sdi.highres_model_loaded:
+            score += 2
+        if job.get('vae', '') == sdi.vae_loaded:
+            score += 1
+        return score
+
+
+    # average number of seconds a model load takes across all workers, or 0 if unknown
+    def avg_model_load_time(self):
+        total = 0.0
+        count = 0
+        for worker in self.control_ref.workers:
+            total += worker['sdi_instance'].model_load_time_total
+            count += worker['sdi_instance'].model_load_count
+        if count > 0:
+            return total / count
+        return 0
+
+
+    # estimated seconds saved by avoided model swaps
+    def seconds_saved(self):
+        return self.swaps_avoided * self.avg_model_load_time()
+
+
+    # removes and returns the best (worker, job) pair from the work queue
+    # default_worker is the worker the main loop would have used without scheduling
+    # job is None if the queue's remaining work is being held back for busy GPUs
+    def next_job(self, default_worker):
+        with self.lock:
+            queue = self.control_ref.work_queue
+            idle = self.control_ref.get_idle_gpu_workers()
+            if default_worker not in idle:
+                idle.insert(0, default_worker)
+
+            if self.in_tail(queue):
+                # give the fastest idle worker its share of what's left
+                worker = max(idle, key=lambda w: self.rate(w))
+                index = self.tail_job(worker, queue)
+                if index == None:
+                    return worker, None
+                job = queue[index]
+                del queue[index]
+                self.record(worker, job)
+                return worker, job
+
+            window = min(len(queue), max(1, self.lookahead))
+            if self.lookahead <= 0:
+                # scheduling disabled; plain FIFO
+                job = queue.popleft()
+                self.record(default_worker, job)
+                return default_worker, job
+
+            if len(idle) == 1 and not self.needs_swap(default_worker, queue[0]):
+                # nothing to gain by looking further
+                job = queue.popleft()
+                self.record(default_worker, job)
+                return default_worker, job
+
+            # look for the earliest job that an idle worker can run without a model swap
+            best = None
+            best_key = None
+            for i in range(window):
+                job = queue[i]
+                for worker in idle:
+                    s = self.score(worker, job)
+                    if s < 4:
+                        continue
+                    key = (s, -i)
+                    if best_key == None or key > best_key:
+                        best_key = key
+                        best = (worker, i)
+
+            if best != None:
+                worker, i = best
+                if self.needs_swap(default_worker, queue[0]):
+                    self.swaps_avoided += 1
+                job = queue[i]
+                del queue[i]
+                self.record(worker, job)
+                return worker, job
+
+            # no match; a swap is unavoidable, so pick a job whose model no busy worker
+            # holds (those jobs will be free to run as soon as that worker is done)
+            busy_models = []
+            for worker in self.control_ref.workers:
+                if worker not in idle and worker['sdi_instance'].model_loaded != '':
+                    busy_models.append(worker['sdi_instance'].model_loaded)
+            index = 0
+            for i in range(window):
+                if self.effective_model(queue[i]) not in busy_models:
+                    index = i
+                    break
+
+            # and swap out the idle worker whose current model is least wanted by upcoming jobs
+            upcoming = []
+            for i in range(window):
+                upcoming.append(self.effective_model(queue[i]))
+            worker = default_worker
+            fewest = upcoming.count(default_worker['sdi_instance'].model_loaded)
+            for w in idle:
+                c = upcoming.count(w['sdi_instance'].model_loaded)
+                if c < fewest:
+                    fewest = c
+                    worker = w
+
+            self.swaps_forced += 1
+            job = queue[index]
+            del queue[index]
+            self.record(worker, job)
+            return worker, job
+
+
+    # removes and returns the best job from the work queue for a specific (busy) worker
+    # used when prefetching a worker's next job while it's still working on the current one
+    # returns None if the worker shouldn't take any of the remaining jobs
+    def next_job_for(self, worker):
+        with self.lock:
+            queue = self.control_ref.work_queue
+            index = 0
+            if self.in_tail(queue):
+                index = self.tail_job(worker, queue)
+                if index == None:
+                    return None
+            elif self.lookahead > 0:
+                best_key = None
+                for i in range(min(len(queue), self.lookahead)):
+                    s = self.score(worker, queue[i])
+                    if s < 4:
+                        continue
+                    key = (s, -i)
+                    if best_key == None or key > best_key:
+                        best_key = key
+                        index = i
+            job = queue[index]
+            del queue[index]
+            self.record(worker, job)
+            return job
+
+
+    # remember what secondary models a worker was last given
+    def record(self, worker, job):
+        worker['sdi_instance'].highres_model_loaded = job.get('highres_ckpt_file', '')
+        worker['sdi_instance'].vae_loaded = job.get('vae', '')
+
+
+    # one-line summary for the status panel
+    def status(self):
+        text = "Model swaps avoided: " + str(self.swaps_avoided)
+        saved = self.seconds_saved()
+        if saved > 0:
+            text += " (~" + str(round(saved)) + "s saved)"
+        return text
+
+
+    # one-line summary of how long the queue will take, for the status panel
+    def drain_status(self):
+        seconds = self.time_to_drain()
+        if seconds < 0:
+            return ''
+        return "Estimated time to drain queue: " + str(timedelta(seconds = round(seconds)))
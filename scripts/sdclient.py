@@ -0,0 +1,163 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+import json
+import asyncio
+import functools
+import threading
+import aiohttp
+from concurrent.futures import ThreadPoolExecutor
+
+
+# raised for any failed request to an SD instance (connection errors, timeouts, bad status)
+class SDClientError(Exception):
+    pass
+
+
+# response to a request made through SDClient; the body has already been read, so this
+# can be used from any thread (mirrors the parts of requests.Response we use)
+class SDResponse:
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise SDClientError('HTTP ' + str(self.status_code) + ': ' + self.text[:200])
+
+
+# HTTP client for all SD instances
+# requests run as coroutines on a single event loop thread, sharing one pool of
+# keep-alive connections; response callbacks (which do blocking work like image
+# decoding) are handed off to a small thread pool so they never stall the loop
+class SDClient:
+    def __init__(self, connect_timeout = 10, read_timeout = 900, connect_retries = 4, read_retries = 2, backoff = 0.5):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        # connection failures are retried for any request; read errors and 502/503/504
+        # responses only for GETs, since re-sending a POST could repeat work
+        self.connect_retries = connect_retries
+        self.read_retries = read_retries
+        self.backoff = backoff
+        self.session = None
+        self.lock = threading.Lock()
+        self.connections_opened = {}
+        self.connections_reused = {}
+        self.callback_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='sd-callback')
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='sd-client', daemon=True)
+        self.thread.start()
+
+
+    # schedules a coroutine on the client's loop; returns a concurrent.futures.Future
+    def submit(self, coro):
+        if self.loop.is_closed():
+            coro.close()
+            raise RuntimeError('SD client has been shut down')
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+
+    # runs a coroutine on the client's loop and blocks until it's done
+    # (never call this from the loop thread itself)
+    def call(self, coro, timeout = None):
+        return self.submit(coro).result(timeout)
+
+
+    # runs a blocking function on the callback pool, from a coroutine
+    async def run_sync(self, function, *args):
+        return await self.loop.run_in_executor(self.callback_pool, functools.partial(function, *args))
+
+
+    # the shared session is created on first use, since it must belong to the loop
+    def get_session(self):
+        if self.session == None:
+            trace = aiohttp.TraceConfig()
+            trace.on_connection_create_end.append(self.connection_created)
+            trace.on_connection_reuseconn.append(self.connection_reused)
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=8, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+        return self.session
+
+
+    async def connection_created(self, session, context, params):
+        self.count_connection(self.connections_opened, context.trace_request_ctx)
+
+
+    async def connection_reused(self, session, context, params):
+        self.count_connection(self.connections_reused, context.trace_request_ctx)
+
+
+    def count_connection(self, counts, key):
+        if key != None:
+            with self.lock:
+                counts[key] = counts.get(key, 0) + 1
+
+
+    # returns the number of connections opened to an SD instance, and the number of
+    # requests that re-used an already-open connection instead
+    def connection_stats(self, base_url):
+        with self.lock:
+            return self.connections_opened.get(base_url, 0), self.connections_reused.get(base_url, 0)
+
+
+    # returns the aiohttp timeout for a request
+    # a read timeout of 0 means wait indefinitely
+    def timeout(self, read = None):
+        if read == None:
+            read = self.read_timeout
+        if read == None or read <= 0:
+            read = None
+        return aiohttp.ClientTimeout(total=None, sock_connect=self.connect_timeout, sock_read=read)
+
+
+    # makes a request to an SD instance; returns an SDResponse or raises SDClientError
+    # set retry = False for requests that are already being repeated by the caller
+    # auth is an optional (user, password) tuple for instances behind basic auth
+    async def request(self, method, base_url, endpoint, payload = None, timeout = None, retry = True, auth = None):
+        if auth != None:
+            auth = aiohttp.BasicAuth(auth[0], auth[1])
+        attempt = 0
+        while True:
+            try:
+                async with self.get_session().request(method, base_url + endpoint, json=payload, auth=auth, \
+                        timeout=self.timeout(timeout), trace_request_ctx=base_url) as response:
+                    content = await response.read()
+                    if method == 'GET' and response.status in (502, 503, 504) and attempt < self.read_retries:
+                        raise aiohttp.ServerDisconnectedError('HTTP ' + str(response.status))
+                    return SDResponse(response.status, content)
+            except aiohttp.ClientConnectorError as e:
+                # couldn't connect, so the request was never sent
+                if not retry or attempt >= self.connect_retries:
+                    raise SDClientError(str(e))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if not retry or method != 'GET' or attempt >= self.read_retries:
+                    raise SDClientError(str(e) or type(e).__name__)
+            attempt += 1
+            await asyncio.sleep(self.backoff * (2 ** (attempt - 1)))
+
+
+    # shuts down the client; anything still in flight is cancelled
+    def close(self):
+        if self.loop.is_closed():
+            return
+        async def shutdown():
+            for task in asyncio.all_tasks():
+                if task is not asyncio.current_task():
+                    task.cancel()
+            if self.session != None:
+                await self.session.close()
+        try:
+            self.call(shutdown(), 10)
+        except Exception:
+            pass
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+        self.loop.close()
+        self.callback_pool.shutdown(wait=False)
@@ -2,7 +2,6 @@
 # SPDX-License-Identifier: MIT
 
 import json
-import requests
 import io
 import base64
 import os
@@ -16,262 +15,119 @@ import platform
 import shutil
 import atexit
 import psutil
+import asyncio
 from os.path import exists
+from scripts.sdclient import SDClientError
 from PIL import Image, PngImagePlugin
 from pprint import pprint
 
 
-# for making txt2img requests
-class Txt2ImgRequest(threading.Thread):
-    def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
+# an image returned by an SD instance, kept in memory (still PNG-encoded, as
+# the API returned it) until it's been processed and saved as a .jpg
+class OutputImage:
+    def __init__(self, encoded, filename, seed, infotext):
+        self.encoded = encoded      # base64 PNG data
+        self.filename = filename    # seed_<seed>.png, or seed_<seed>_u.png if upscaled
+        self.seed = seed
+        self.infotext = infotext
+
+    # returns the decoded PIL image
+    def decode(self):
+        return Image.open(io.BytesIO(base64.b64decode(self.encoded)))
+
+    # returns the image in the form SD expects for img2img/upscale requests
+    def payload(self):
+        return 'data:image/png;base64,' + self.encoded
+
+    # writes the image to disk as a .png w/ its SD parameters
+    def save_png(self, filename):
+        image = self.decode()
+        pnginfo = PngImagePlugin.PngInfo()
+        pnginfo.add_text("parameters", self.infotext)
+        image.save(filename, pnginfo=pnginfo)
+
+
+# a request made to an SD instance through the shared SDClient
+# runs as a coroutine on the client's event loop; the response (plus any extra
+# callback_args) is passed to callback on one of the client's callback threads
+class SDIRequest:
+    def __init__(self, sdi_ref, method, endpoint, payload = None, callback = None, callback_args = (), timeout = None):
         self.sdi_ref = sdi_ref
-        self.callback = callback
+        self.method = method
+        self.endpoint = endpoint
         self.payload = payload
-
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/txt2img', json=self.payload)
-        self.callback(response)
-
-
-# for making img2img requests
-class Img2ImgRequest(threading.Thread):
-    def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
         self.callback = callback
-        self.payload = payload
+        self.callback_args = callback_args
+        self.timeout = timeout
 
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/img2img', json=self.payload)
-        self.callback(response)
+    # queues the request; returns a Future (or None if the instance has been shut down)
+    def start(self):
+        return self.sdi_ref.submit(self.run())
 
+    async def run(self):
+        response = await self.fetch()
+        if self.callback != None:
+            await self.sdi_ref.client.run_sync(self.callback, response, *self.callback_args)
 
-# for making ControlNet txt2img requests
-class ControlNet_Txt2ImgRequest(threading.Thread):
-    def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-        self.payload = payload
+    async def fetch(self):
+        return await self.sdi_ref.fetch(self.method, self.endpoint, self.payload, self.timeout)
 
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/controlnet/txt2img', json=self.payload)
-        self.callback(response)
 
+# for making image generation requests (txt2img/img2img, including ControlNet)
+# these are interrupted if they run past their deadline (see SDI.generate)
+class GenerationRequest(SDIRequest):
+    async def fetch(self):
+        return await self.sdi_ref.generate(self.endpoint, self.payload)
 
-# for making ControlNet img2img requests
-class ControlNet_Img2ImgRequest(threading.Thread):
-    def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-        self.payload = payload
-
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/controlnet/img2img', json=self.payload)
-        self.callback(response)
-
-
-# for making upscale requests
-class UpscaleRequest(threading.Thread):
-    def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-        self.payload = payload
-
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/extra-single-image', json=self.payload)
-        self.callback(response)
-
-
-# for fetching valid samplers
-class GetSamplersRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/samplers')
-        self.callback(response)
-
-
-# for fetching valid schedulers
-class GetSchedulersRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/schedulers')
-        self.callback(response)
-
-
-# for fetching valid model checkpoints
-class GetModelsRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/sd-models')
-        self.callback(response)
 
+# for polling generation progress
+class ProgressRequest(SDIRequest):
+    def __init__(self, sdi_ref, callback):
+        SDIRequest.__init__(self, sdi_ref, 'GET', '/sdapi/v1/progress?skip_current_image=true', callback=callback, timeout=5)
 
-# for fetching hypernetworks
-class GetHyperNetworksRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/hypernetworks')
-        self.callback(response)
-
-
-# for fetching styles
-class GetStylesRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/prompt-styles')
-        self.callback(response)
-
-
-# for fetching VAEs
-class GetVAEsRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/sd-vae')
-        self.callback(response)
-
-
-# for fetching loras
-class GetLorasRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/loras')
-        self.callback(response)
-
-
-# for updating loras
-class LoraRefreshRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/refresh-loras')
-        self.callback(response)
-
-
-# for fetching scripts
-class GetScriptsRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/scripts')
-        self.callback(response)
-
-
-# for fetching upscalers
-class GetUpscalersRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/sdapi/v1/upscalers')
-        self.callback(response)
-
-
-# for fetching ControlNet models
-class ControlNet_GetModelsRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/controlnet/model_list')
-        self.callback(response)
-
-
-# for fetching ControlNet modules
-class ControlNet_GetModulesRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-
-    def run(self):
-        response = requests.get(url=f'{self.sdi_ref.url}/controlnet/module_list')
-        self.callback(response)
-
-
-# for changing server options, including model swaps
-class SetOptionsRequest(threading.Thread):
-    def __init__(self, sdi_ref, payload, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
-        self.payload = payload
-
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/options', json=self.payload)
-        self.callback(response, self.payload)
-
-
-# for fetching valid model checkpoints
-class InterruptRequest(threading.Thread):
-    def __init__(self, sdi_ref, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-
-    def run(self):
-        response = requests.post(url=f'{self.sdi_ref.url}/sdapi/v1/interrupt', json={})
+    async def fetch(self):
+        # a failed poll shouldn't count as a failed request (see SDI.request_done)
+        try:
+            return await SDIRequest.fetch(self)
+        except SDClientError:
+            return None
 
 
-# for checking if the server is alive / ready for requests
-class AliveRequest(threading.Thread):
-    def __init__(self, sdi_ref, callback=lambda: None, *args):
-        threading.Thread.__init__(self)
-        self.sdi_ref = sdi_ref
-        self.callback = callback
+# polls every generating SD instance for its progress on one shared, low-frequency timer
+# also keeps a rolling count of sampling steps done across all instances
+class ProgressMonitor(threading.Thread):
+    def __init__(self, control_ref, interval = 1, window = 60):
+        threading.Thread.__init__(self, daemon=True)
+        self.control_ref = control_ref
+        self.interval = interval
+        self.window = window            # seconds of history for farm throughput
+        self.lock = threading.Lock()
+        self.steps = []                 # (time, steps) samples reported by instances
 
     def run(self):
-        response_code = self.check_alive()
-        self.callback(response_code)
-
-    def check_alive(self):
-        code = -1
-        try:
-            response = requests.get(self.sdi_ref.url + '/docs', timeout = 300)
-            code = response.status_code
-        except:
-            code = 999
-        return code
+        while not self.control_ref.shutting_down:
+            for worker in self.control_ref.workers:
+                if 'sdi_instance' in worker:
+                    worker['sdi_instance'].poll_progress()
+            time.sleep(self.interval)
+
+    # called by instances as they report newly-completed sampling steps
+    def add_steps(self, steps):
+        now = time.time()
+        with self.lock:
+            self.steps.append((now, steps))
+            while len(self.steps) > 0 and self.steps[0][0] < now - self.window:
+                self.steps.pop(0)
+
+    # sampling steps per second across all GPUs over the last window
+    def farm_its(self):
+        now = time.time()
+        with self.lock:
+            total = 0
+            for t, steps in self.steps:
+                if t >= now - self.window:
+                    total += steps
+        return total / self.window
 
 
 # for monitoring SD server status
@@ -285,31 +141,20 @@ class Monitor(threading.Thread):
     def run(self):
         #print("Monitor for GPU " + str(self.sdi_ref.gpu_id) + " starting!")
         self.sdi_ref.log("waiting for SD instance to be ready...", True)
-        alive_check = AliveRequest(self.sdi_ref, self.alive_check_callback)
-        alive_check.start()
 
-        while self.sdi_ref.isRunning:
+        # (stops if the instance is restarted w/ a new process)
+        while self.sdi_ref.isRunning and self.sdi_ref.monitor is self:
             # monitor progress here
             time.sleep(1)
         self.callback()
 
-    # callback for alive check; whether or not server is ready for requests
-    def alive_check_callback(self, response_code):
-        #self.sdi_ref.log(str(response_code))
-        if response_code == 200:
-            self.sdi_ref.ready = True
-            self.sdi_ref.log("SD instance finished initialization; ready for work!")
-        else:
-            # not ready yet; check again
-            time.sleep(0.25)
-            alive_check = AliveRequest(self.sdi_ref, self.alive_check_callback)
-            alive_check.start()
-
 
 # Stable Diffusion Interface
 # manages the relationship between a GPU and an SD instance
 class SDI:
-    def __init__(self, gpu_id, port, path_to_sd, control_ref, worker_name):
+    # attach_url is the address of an already-running SD instance to use instead of starting one
+    # remote instances (on other machines) are always attached to, never started locally
+    def __init__(self, gpu_id, port, path_to_sd, control_ref, worker_name, attach_url = '', remote = False, auth = None):
         os.makedirs('logs', exist_ok=True)
 
         self.control_ref = control_ref
@@ -321,6 +166,12 @@ class SDI:
         self.target_command = 'df-start-gpu-' + str(gpu_id) + '.bat'
         self.sd_port = port
         self.url = 'http://localhost:' + str(self.sd_port)
+        self.attached = False       # are we using an existing SD instance (that we mustn't shut down)?
+        if attach_url != '':
+            self.url = attach_url
+            self.attached = True
+        self.remote = remote        # is our SD instance on another machine?
+        self.auth = auth            # (user, password) if our SD instance requires basic auth
         self.isRunning = True
         self.logfilename = os.path.join('logs', 'gpu-' + str(self.gpu_id) + '-log.txt')
         self.errorfilename = os.path.join('logs', 'gpu-' + str(self.gpu_id) + '-errors.txt')
@@ -328,29 +179,134 @@ class SDI:
         self.errorfile = open(self.errorfilename, 'w')
         self.monitor = None
         self.process = None
+        self.exit_handler_registered = False
         self.init = False           # has init() been run?
         self.ready = False          # is our associated server ready (e.g. has init() finished)?
+        self.boot_failed = False    # did our server fail to come up?
+        self.boot_start = 0
+        self.boot_time = 0          # seconds our server took to come up
+        self.ready_future = None    # resolves once our server is ready (or has failed to start)
         self.busy = False           # is this instance in the process of making a request?
-        self.status = ''            # TODO fill in % done here
+        self.status = ''            # progress of the current generation request, for display
         self.request_count = 0
         self.output_dir = ''
+        self.samples_dirs = set()   # every dir debug samples have been written to, for cleanup
+        self.upscale_seed = None
+        self.output_images = []     # OutputImages received since the last take_output_images()
+        # requests to this instance go through the controller's shared async client
+        self.client = control_ref.sd_client
+        self.requests_in_flight = set()
+        self.closed = False         # set once cleanup() has run; no new requests after that
         self.options_change_in_progress = False
         self.model_loaded = ''
         self.model_loading_now = ''
+        # last highres/VAE models this instance was given; used by the scheduler
+        self.highres_model_loaded = ''
+        self.vae_loaded = ''
+        # for measuring how long the GPU sits idle between generation requests
+        self.last_generation_end = 0
+        self.idle_gap_total = 0.0
+        self.idle_gap_count = 0
+        # for measuring how long model loads take
+        self.model_load_start = 0
+        self.model_load_time_total = 0.0
+        self.model_load_count = 0
+        # generation progress, from polling the progress API
+        self.generating = False
+        self.progress_request_pending = False
+        self.progress_step = 0          # sampling steps done so far in the current request
+        self.progress_steps = 0         # total sampling steps expected in the current request
+        self.progress_last = None       # (time, steps done) as of the last poll
+        self.its = 0.0                  # rolling average sampling speed (it/s) of this GPU
+        self.eta = -1
         self.last_job_success = True
+        # health, as tracked by the supervisor
+        self.ping_failures = 0
+        self.restarts = 0               # restarts since this instance last finished a job
+        self.backoff_until = 0          # if failing repeatedly, when we'll next try to restart
+        self.state_change = threading.Condition()   # signalled whenever busy/options_change_in_progress clear
 
         if self.platform == 'linux':
             self.command = 'webui-user.sh'
             self.target_command = 'df-start-gpu-' + str(gpu_id) + '.sh'
 
-    #waits for SD APIs to be ready and returning expected information
-    def wait_for_server(self, url, api_endpoint, timeout=300):
+    # queues a request coroutine on the SD client
+    # returns a Future (or None if this instance has been shut down)
+    def submit(self, coro):
+        if self.closed:
+            coro.close()
+            return None
+        try:
+            future = self.client.submit(coro)
+        except RuntimeError:
+            return None
+        with self.state_change:
+            self.requests_in_flight.add(future)
+        future.add_done_callback(self.request_done)
+        return future
+
+
+    # makes a request to this instance w/ an optional callback for the response
+    def request(self, method, endpoint, callback = None, payload = None):
+        return SDIRequest(self, method, endpoint, payload, callback).start()
+
+
+    # makes a request to this instance's API (a coroutine, for use on the client's loop)
+    async def fetch(self, method, endpoint, payload = None, timeout = None, retry = True):
+        return await self.client.request(method, self.url, endpoint, payload, timeout, retry, self.auth)
+
+
+    # makes a generation request; if it's still running after SD_READ_TIMEOUT seconds,
+    # SD is told to interrupt it (freeing up the GPU) and the request fails
+    async def generate(self, endpoint, payload):
+        task = asyncio.ensure_future(self.fetch('POST', endpoint, payload, 0))
+        deadline = self.client.read_timeout
+        if deadline == None or deadline <= 0:
+            return await task
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), deadline)
+        except asyncio.TimeoutError:
+            pass
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+
+        self.log('request still running after ' + str(deadline) + ' seconds; interrupting it...', True)
+        try:
+            await self.fetch('POST', '/sdapi/v1/interrupt', {}, 30)
+            # SD responds once it's stopped; discard whatever it had finished
+            await asyncio.wait_for(task, 60)
+        except (SDClientError, asyncio.TimeoutError):
+            task.cancel()
+        raise SDClientError('request exceeded its ' + str(deadline) + ' second deadline')
+
+
+    # makes a GET request to this instance's API and blocks until it's done
+    def get(self, endpoint, timeout = None):
+        return self.client.call(self.fetch('GET', endpoint, None, timeout))
+
+
+    # makes a POST request to this instance's API and blocks until it's done
+    def post(self, endpoint, json = None, timeout = None):
+        return self.client.call(self.fetch('POST', endpoint, json, timeout))
+
+
+    # returns the number of HTTP connections opened to this instance, and the
+    # number of requests that re-used an already-open connection instead
+    def connection_stats(self):
+        return self.client.connection_stats(self.url)
+
+
+    # waits for SD APIs to be ready and returning expected information
+    # probes quickly at first, backing off to every few seconds (runs on the SD client's loop)
+    async def wait_for_server(self, api_endpoint, timeout = 300):
         start_time = time.time()
+        delay = 0.25
 
-        while True:
+        while self.isRunning:
             try:
-                response = requests.get(url + api_endpoint)
-                response.raise_for_status()  # Raises stored HTTPError, if one occurred.
+                response = await self.fetch('GET', api_endpoint, None, 10, False)
+                response.raise_for_status()
 
                 data = response.json()
                 if 'detail' in data and data['detail'] == 'Not Found':
@@ -358,19 +314,95 @@ class SDI:
                     pass
                 else:
                     # If we don't get 'detail': 'Not Found', the API is ready.
-                    break
+                    return True
 
-            except (requests.exceptions.HTTPError, requests.exceptions.ConnectionError, KeyError):
+            except (SDClientError, KeyError, ValueError, TypeError):
                 pass
 
+            if self.process != None and self.process.poll() != None:
+                raise RuntimeError('SD process exited during startup (see ' + self.errorfilename + ')')
+
             if time.time() - start_time > timeout:
-                raise TimeoutError(f'Server at {url} not responding after {timeout} seconds')
+                raise TimeoutError(f'Server at {self.url} not responding after {timeout} seconds')
+
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 5)
+        return False
 
-            time.sleep(5)  # Wait before trying again
 
-    # starts up a new SD instance
+    # waits for our newly-started server to come up, then marks this instance ready
+    async def boot(self):
+        try:
+            if not await self.wait_for_server("/sdapi/v1/samplers"):
+                return False
+        except Exception as e:
+            self.boot_failed = True
+            self.log('*** SD instance failed to initialize: ' + str(e) + ' ***', True)
+            self.control_ref.notify_dispatcher()
+            return False
+
+        self.boot_time = time.time() - self.boot_start
+        self.ready = True
+        self.log("SD instance finished initialization in " + str(round(self.boot_time, 1)) + " seconds; ready for work!", True)
+        self.control_ref.notify_dispatcher()
+        return True
+
+
+    # checks that the existing SD instance we've been given is healthy, and picks up
+    # whatever model it currently has loaded; if it isn't, we start our own instead
+    async def attach(self):
+        try:
+            if not await self.wait_for_server("/sdapi/v1/samplers", 15):
+                return False
+            response = await self.fetch('GET', '/sdapi/v1/options')
+            response.raise_for_status()
+            model = response.json().get('sd_model_checkpoint')
+        except Exception as e:
+            self.log('unable to attach to SD instance at ' + self.url + ' (' + str(e) + ')', True)
+            if self.remote:
+                # nothing we can start in its place
+                self.boot_failed = True
+                self.control_ref.notify_dispatcher()
+                return False
+            self.attached = False
+            self.url = 'http://localhost:' + str(self.sd_port)
+            if self.path_to_sd == '':
+                self.boot_failed = True
+                self.log('*** no SD_LOCATION set, so a new SD instance can\'t be started for this GPU! ***', True)
+                self.control_ref.notify_dispatcher()
+                return False
+            self.log('starting a new SD instance instead...', True)
+            await self.client.run_sync(self.start_process)
+            return await self.boot()
+
+        if model != None:
+            self.model_loaded = model
+        self.boot_time = time.time() - self.boot_start
+        self.ready = True
+        self.log("attached to running SD instance at " + self.url + " (current model: " + str(model) + "); ready for work!", True)
+        self.control_ref.notify_dispatcher()
+        return True
+
+
+    # starts up a new SD instance (or attaches to an existing one)
+    # returns right away; ready_future resolves (to True if successful) once it's up
     def initialize(self):
         self.init = True
+        self.ready = False
+        self.boot_failed = False
+        self.boot_start = time.time()
+
+        if self.attached:
+            self.log('attaching to existing SD instance at ' + self.url + '...', True)
+            self.ready_future = self.submit(self.attach())
+        else:
+            self.start_process()
+            # wait for server to be ready in the background
+            self.ready_future = self.submit(self.boot())
+
+
+    # launches a new SD process for this GPU
+    def start_process(self):
         full_target = os.path.join(self.path_to_sd, self.target_command)
 
         # we don't have a startup script for this gpu; make one
@@ -388,15 +420,15 @@ class SDI:
             universal_newlines=True
         )
 
-        atexit.register(self.kill_sd_process)
+        # kill_sd_process always goes after the current process, so once is enough
+        if not self.exit_handler_registered:
+            atexit.register(self.kill_sd_process)
+            self.exit_handler_registered = True
 
         # start monitoring the SD subprocess's piped output
         self.monitor = Monitor(self, self.monitor_done_callback)
         self.monitor.start()
 
-        # Wait for server to be ready
-        self.wait_for_server(self.url, "/sdapi/v1/samplers")
-
 
     # creates a suitable startup .bat/.sh for this gpu
     def create_startup_batch_file(self):
@@ -520,64 +552,64 @@ class SDI:
     # make a txt2img request
     def do_txt2img(self, payload, output_dir = ''):
         self.busy = True
+        self.generation_started()
         self.output_dir = output_dir
         #self.log('Making a txt2img request!')
-        txt2img = Txt2ImgRequest(self, payload, self.handle_response)
-        txt2img.start()
+        GenerationRequest(self, 'POST', '/sdapi/v1/txt2img', payload, self.handle_response).start()
 
 
     # make a img2img request
     def do_img2img(self, payload, output_dir = ''):
         self.busy = True
+        self.generation_started()
         self.output_dir = output_dir
         #self.log('Making a img2img request!')
-        img2img = Img2ImgRequest(self, payload, self.handle_response)
-        img2img.start()
+        GenerationRequest(self, 'POST', '/sdapi/v1/img2img', payload, self.handle_response).start()
 
 
     # make a controlnet txt2img request
     def do_controlnet_txt2img(self, payload, output_dir = ''):
         self.busy = True
+        self.generation_started()
         self.output_dir = output_dir
-        txt2img = ControlNet_Txt2ImgRequest(self, payload, self.handle_response)
-        txt2img.start()
+        GenerationRequest(self, 'POST', '/controlnet/txt2img', payload, self.handle_response).start()
 
 
     # make a controlnet img2img request
     def do_controlnet_img2img(self, payload, output_dir = ''):
         self.busy = True
+        self.generation_started()
         self.output_dir = output_dir
-        img2img = ControlNet_Img2ImgRequest(self, payload, self.handle_response)
-        img2img.start()
+        GenerationRequest(self, 'POST', '/controlnet/img2img', payload, self.handle_response).start()
 
 
     # make an upscale request
-    def do_upscale(self, payload, output_dir = ''):
+    # seed is the seed of the image being upscaled, if known
+    def do_upscale(self, payload, output_dir = '', seed = None):
         self.busy = True
         self.output_dir = output_dir
+        self.upscale_seed = seed
         #self.log('Making an upscale request!')
-        upscale = UpscaleRequest(self, payload, self.handle_upscale_response)
-        upscale.start()
+        self.request('POST', '/sdapi/v1/extra-single-image', self.handle_upscale_response, payload)
 
 
     # gets valid samplers from server
     def get_server_samplers(self):
         self.busy = True
         self.log('querying SD for available samplers...', True)
-        query = GetSamplersRequest(self, self.sampler_response)
-        query.start()
+        self.request('GET', '/sdapi/v1/samplers', self.sampler_response)
 
 
     # gets valid schedulers from server
     def get_server_schedulers(self):
         self.busy = True
         self.log('querying SD for available schedulers...', True)
-        query = GetSchedulersRequest(self, self.scheduler_response)
-        query.start()
+        self.request('GET', '/sdapi/v1/schedulers', self.scheduler_response)
 
 
     # handle server sampler response
-    def sampler_response(self, response):
+    # (idle = False when called for a background capability query; see Capabilities)
+    def sampler_response(self, response, idle = True):
         r = response.json()
 
         samplers = []
@@ -592,14 +624,16 @@ class SDI:
         self.control_ref.sdi_samplers = samplers
 
         # reload prompt file if we have one to validate it against samplers
-        if self.control_ref.prompt_file != '':
+        # (capability queries leave this to Capabilities.query_done)
+        if idle and self.control_ref.prompt_file != '':
             self.control_ref.new_prompt_file(self.control_ref.prompt_file)
 
-        self.busy = False
+        if idle:
+            self.set_idle()
 
 
     # handle server scheduler response
-    def scheduler_response(self, response):
+    def scheduler_response(self, response, idle = True):
         r = response.json()
         schedulers = {}
         for i in r:
@@ -609,9 +643,11 @@ class SDI:
         #schedulers.sort()
         self.control_ref.sdi_schedulers = schedulers
         # reload prompt file if we have one to validate it against schedulers
-        if self.control_ref.prompt_file != '':
+        # (capability queries leave this to Capabilities.query_done)
+        if idle and self.control_ref.prompt_file != '':
             self.control_ref.new_prompt_file(self.control_ref.prompt_file)
-        self.busy = False
+        if idle:
+            self.set_idle()
 
 
     # gets valid controlnet models from server
@@ -619,12 +655,11 @@ class SDI:
         self.busy = True
         #self.log('Fetching models from server...')
         self.log('querying SD for available ControlNet models...', True)
-        query = ControlNet_GetModelsRequest(self, self.controlnet_model_response)
-        query.start()
+        self.request('GET', '/controlnet/model_list', self.controlnet_model_response)
 
 
     # handle server controlnet model response
-    def controlnet_model_response(self, response):
+    def controlnet_model_response(self, response, idle = True):
         try:
             r = response.json()
             models = []
@@ -641,7 +676,8 @@ class SDI:
             self.log('*** Error: received invalid ControlNet model response (is your ControlNet extension installed properly?); disabling ControlNet functionality!', True)
             self.control_ref.sdi_controlnet_available = False
 
-        self.busy = False
+        if idle:
+            self.set_idle()
 
 
     # gets valid controlnet modules from server
@@ -649,12 +685,11 @@ class SDI:
         self.busy = True
         #self.log('Fetching modules from server...')
         self.log('querying SD for available ControlNet preprocessors...', True)
-        query = ControlNet_GetModulesRequest(self, self.controlnet_module_response)
-        query.start()
+        self.request('GET', '/controlnet/module_list', self.controlnet_module_response)
 
 
     # handle server controlnet module response
-    def controlnet_module_response(self, response):
+    def controlnet_module_response(self, response, idle = True):
         try:
             r = response.json()
             modules = []
@@ -670,67 +705,61 @@ class SDI:
         except:
             self.log('*** Error: received invalid ControlNet preprocessor response (is your ControlNet extension up to date?)!', True)
 
-        self.busy = False
+        if idle:
+            self.set_idle()
 
 
     # gets valid hypernetworks from server
     def get_server_hypernetworks(self):
         self.busy = True
         self.log('querying SD for available hypernetworks...', True)
-        query = GetHyperNetworksRequest(self, self.hypernetwork_response)
-        query.start()
+        self.request('GET', '/sdapi/v1/hypernetworks', self.hypernetwork_response)
 
 
     # gets valid styles from server
     def get_server_styles(self):
         self.busy = True
         self.log('querying SD for available styles...', True)
-        query = GetStylesRequest(self, self.style_response)
-        query.start()
+        self.request('GET', '/sdapi/v1/prompt-styles', self.style_response)
 
 
     # gets valid VAEs from server
     def get_server_VAEs(self):
         self.busy = True
         self.log('querying SD for available VAEs...', True)
-        query = GetVAEsRequest(self, self.VAE_response)
-        query.start()
+        self.request('GET', '/sdapi/v1/sd-vae', self.VAE_response)
 
 
     # gets valid loras from server
     def get_server_loras(self):
         self.busy = True
         self.log('querying SD for available LoRAs...', True)
-        query = GetLorasRequest(self, self.lora_response)
-        query.start()
+        self.request('GET', '/sdapi/v1/loras', self.lora_response)
 
 
     # update loras on server
     def update_server_loras(self):
         #self.busy = True       # don't wait for response before starting work
         #self.log('asking SD to refresh LoRAs...', True)
-        query = LoraRefreshRequest(self, self.lora_refresh_response)
-        query.start()
+        self.request('POST', '/sdapi/v1/refresh-loras', self.lora_refresh_response)
 
 
     # gets valid scripts from server
     def get_server_scripts(self):
         self.busy = True
         self.log('querying SD for available scripts...', True)
-        query = GetScriptsRequest(self, self.script_response)
-        query.start()
+        self.request('GET', '/sdapi/v1/scripts', self.script_response)
 
 
     # gets valid upscalers from server
     def get_server_upscalers(self):
         self.busy = True
         self.log('querying SD for available upscalers...', True)
-        query = GetUpscalersRequest(self, self.upscaler_response)
-        query.start()
+        self.request('GET', '/sdapi/v1/upscalers', self.upscaler_response)
 
 
     # handle server hypernetwork response
-    def hypernetwork_response(self, response):
+    def hypernetwork_response(self, response, idle = True):
         r = response.json()
         networks = []
         for i in r:
@@ -744,11 +773,12 @@ class SDI:
         self.log('received hypernetwork query response: SD indicates ' + str(len(networks)) + ' hypernetworks available for use...', True)
         networks = sorted(networks, key=lambda d: d['name'].lower())
         self.control_ref.sdi_hypernetworks = networks
-        self.busy = False
+        if idle:
+            self.set_idle()
 
 
     # handle server style response
-    def style_response(self, response):
+    def style_response(self, response, idle = True):
         r = response.json()
         styles = []
         for i in r:
@@ -765,11 +795,12 @@ class SDI:
         self.log('received style query response: SD indicates ' + str(len(styles)) + ' styles available for use...', True)
         styles = sorted(styles, key=lambda d: d['name'].lower())
         self.control_ref.sdi_styles = styles
-        self.busy = False
+        if idle:
+            self.set_idle()
 
 
     # handle server VAE response
-    def VAE_response(self, response):
+    def VAE_response(self, response, idle = True):
         r = response.json()
         vaes = []
         for i in r:
@@ -783,11 +814,12 @@ class SDI:
         self.log('received VAE query response: SD indicates ' + str(len(vaes)) + ' VAEs available for use...', True)
         vaes = sorted(vaes, key=lambda d: d['name'].lower())
         self.control_ref.sdi_VAEs = vaes
-        self.busy = False
+        if idle:
+            self.set_idle()
 
 
     # handle server lora response
-    def lora_response(self, response):
+    def lora_response(self, response, idle = True):
         r = response.json()
         loras = []
         for i in r:
@@ -801,7 +833,8 @@ class SDI:
         self.log('received LoRA query response: SD indicates ' + str(len(loras)) + ' LoRAs available for use...', True)
         loras = sorted(loras, key=lambda d: d['name'].lower())
         self.control_ref.sdi_loras = loras
-        self.busy = False
+        if idle:
+            self.set_idle()
 
 
     # handle server lora response
@@ -812,7 +845,7 @@ class SDI:
 
 
     # handle server script response
-    def script_response(self, response):
+    def script_response(self, response, idle = True):
         r = response.json()
         txt2img_scripts = []
         img2img_scripts = []
@@ -836,11 +869,12 @@ class SDI:
 
         self.control_ref.sdi_txt2img_scripts = txt2img_scripts
         self.control_ref.sdi_img2img_scripts = img2img_scripts
-        self.busy = False
+        if idle:
+            self.set_idle()
 
 
     # handle server upscaler response
-    def upscaler_response(self, response):
+    def upscaler_response(self, response, idle = True):
         r = response.json()
         upscalers = []
         for i in r:
@@ -849,7 +883,8 @@ class SDI:
         self.log('received upscaler query response: SD indicates ' + str(len(upscalers)) + ' upscalers available for use...', True)
         self.control_ref.sdi_upscalers = upscalers
         self.control_ref.check_default_upscaler()
-        self.busy = False
+        if idle:
+            self.set_idle()
 
 
     # gets valid models from server
@@ -857,12 +892,11 @@ class SDI:
         self.busy = True
         #self.log('Fetching models from server...')
         self.log('querying SD for available models...', True)
-        query = GetModelsRequest(self, self.model_response)
-        query.start()
+        self.request('GET', '/sdapi/v1/sd-models', self.model_response)
 
 
     # handle server model response
-    def model_response(self, response):
+    def model_response(self, response, idle = True):
         r = response.json()
         models = []
         for i in r:
@@ -881,10 +915,71 @@ class SDI:
         self.control_ref.update_models(models)
 
         # reload prompt file if we have one to validate it against models
-        if self.control_ref.prompt_file != '':
+        # (capability queries leave this to Capabilities.query_done)
+        if idle and self.control_ref.prompt_file != '':
             self.control_ref.new_prompt_file(self.control_ref.prompt_file)
 
-        self.busy = False
+        if idle:
+            self.set_idle()
+
+
+    # returns the (parameters infotext, seed) for a generated image
+    # these come from the generation response's info when possible, then from the
+    # image's own embedded parameters; SD's png-info API is only a last resort,
+    # since it means re-uploading the whole image
+    def image_info(self, encoded, info, index, seed = None):
+        infotext = None
+        if info != None:
+            infotexts = info.get('infotexts', [])
+            if index < len(infotexts):
+                infotext = infotexts[index]
+        if infotext == None:
+            # only reads as far as the image's header/text chunks
+            with Image.open(io.BytesIO(base64.b64decode(encoded))) as image:
+                infotext = image.info.get('parameters')
+        if infotext == None and seed == None:
+            png_payload = {
+                "image": "data:image/png;base64," + encoded
+            }
+            response = self.post('/sdapi/v1/png-info', json=png_payload)
+            infotext = response.json().get("info")
+        if infotext == None:
+            infotext = ''
+
+        if seed == None:
+            # get the actual seed used
+            if 'Seed:' in infotext:
+                temp = infotext.split('Seed:', 1)
+                temp = temp[1].split(',', 1)
+                seed = temp[0].strip()
+            elif info != None:
+                # all_seeds doesn't include any grid image at the start of the results
+                seeds = info.get('all_seeds', [])
+                seed_index = index - info.get('index_of_first_image', 0)
+                if seed_index >= 0 and seed_index < len(seeds):
+                    seed = seeds[seed_index]
+        if seed == None:
+            seed = '0'
+        return infotext, str(seed)
+
+
+    # keeps a received image for the worker to pick up, and writes it to this
+    # GPU's samples dir as well if that's been enabled for debugging
+    def add_output_image(self, image):
+        if self.control_ref.config.get('debug_save_samples') and self.output_dir != '':
+            os.makedirs(self.output_dir, exist_ok=True)
+            self.samples_dirs.add(self.output_dir)
+            image.save_png(os.path.join(self.output_dir, image.filename))
+        with self.state_change:
+            self.output_images.append(image)
+
+
+    # returns (and forgets) all images received since the last call
+    def take_output_images(self):
+        with self.state_change:
+            images = self.output_images
+            self.output_images = []
+        return images
 
 
     # handle upscale responses
@@ -894,28 +989,12 @@ class SDI:
             #self.log('Handling response from server...')
             try:
                 r = response.json()
-                os.makedirs(self.output_dir, exist_ok=True)
 
                 i = r['image']
-                image = Image.open(io.BytesIO(base64.b64decode(i)))
-
-                png_payload = {
-                    "image": "data:image/png;base64," + i
-                }
-                response2 = requests.post(url=f'{self.url}/sdapi/v1/png-info', json=png_payload)
-
-                pnginfo = PngImagePlugin.PngInfo()
-                pnginfo.add_text("parameters", response2.json().get("info"))
-
-                seed = '0'
-                # get the actual seed used
-                if 'Seed:' in response2.json().get("info"):
-                    temp = response2.json().get("info").split('Seed:', 1)
-                    temp = temp[1].split(',', 1)
-                    seed = temp[0].strip()
-
+                # extras responses carry no generation info, but the source image's is usually still embedded
+                infotext, seed = self.image_info(i, None, 0, self.upscale_seed)
                 filename = 'seed_' + seed + '_u.png'
-                image.save(os.path.join(self.output_dir, filename), pnginfo=pnginfo)
+                self.add_output_image(OutputImage(i, filename, seed, infotext))
                 #self.log(filename + ' created!')
             except KeyError:
                 self.log('*** Error response received during upscaling! *** : ' + str(r['detail']), True)
@@ -927,39 +1006,32 @@ class SDI:
                 time.sleep(1)
 
             self.request_count += 1
-            self.busy = False
+            self.set_idle()
 
 
     # handle SD responses, callback for server requests
     def handle_response(self, response):
+        self.last_generation_end = time.time()
+        self.generation_finished()
         # only handle if we're not already shutting down
         if self.isRunning:
             #self.log('Handling response from server...')
             self.last_job_success = True
             try:
                 r = response.json()
-                os.makedirs(self.output_dir, exist_ok=True)
-
-                for i in r['images']:
-                    image = Image.open(io.BytesIO(base64.b64decode(i.split(",",1)[0])))
 
-                    png_payload = {
-                        "image": "data:image/png;base64," + i
-                    }
-                    response2 = requests.post(url=f'{self.url}/sdapi/v1/png-info', json=png_payload)
-
-                    pnginfo = PngImagePlugin.PngInfo()
-                    pnginfo.add_text("parameters", response2.json().get("info"))
-
-                    seed = '0'
-                    # get the actual seed used
-                    if 'Seed:' in response2.json().get("info"):
-                        temp = response2.json().get("info").split('Seed:', 1)
-                        temp = temp[1].split(',', 1)
-                        seed = temp[0].strip()
+                # per-image parameters and seeds are already in the response
+                info = None
+                try:
+                    info = json.loads(r.get('info'))
+                except (TypeError, ValueError):
+                    pass
 
+                for index, i in enumerate(r['images']):
+                    i = i.split(",",1)[0]
+                    infotext, seed = self.image_info(i, info, index)
                     filename = 'seed_' + seed + '.png'
-                    image.save(os.path.join(self.output_dir, filename), pnginfo=pnginfo)
+                    self.add_output_image(OutputImage(i, filename, seed, infotext))
                     #self.log(filename + ' created!')
             except KeyError:
                 self.log('*** Error response received! *** : ' + str(r['detail']), True)
@@ -973,19 +1045,19 @@ class SDI:
                 self.last_job_success = False
 
             self.request_count += 1
-            self.busy = False
+            self.set_idle()
 
 
     # tells the SD instance to load the indicated model
     def load_model(self, new_model):
         self.options_change_in_progress = True
         self.model_loading_now = new_model
+        self.model_load_start = time.time()
         self.log("requesting a new model load: " + new_model, True)
         payload = {
             "sd_model_checkpoint": new_model
         }
-        model_req = SetOptionsRequest(self, payload, self.handle_options_response)
-        model_req.start()
+        SDIRequest(self, 'POST', '/sdapi/v1/options', payload, self.handle_options_response, (payload,)).start()
 
 
     # tells the SD instance to use the legacy highres_fix behavior or current new method
@@ -1000,8 +1072,7 @@ class SDI:
             payload = {
                 "use_old_hires_fix_width_height": True
             }
-        model_req = SetOptionsRequest(self, payload, self.handle_options_response)
-        model_req.start()
+        SDIRequest(self, 'POST', '/sdapi/v1/options', payload, self.handle_options_response, (payload,)).start()
 
 
     # handle option change responses
@@ -1011,6 +1082,10 @@ class SDI:
             if "sd_model_checkpoint" in str(payload):
                 self.model_loaded = self.model_loading_now
                 self.model_loading_now = ''
+                if self.model_load_start > 0:
+                    self.model_load_time_total += time.time() - self.model_load_start
+                    self.model_load_count += 1
+                    self.model_load_start = 0
                 self.log('new model successfully loaded!', True)
             else:
                 pass
@@ -1022,17 +1097,214 @@ class SDI:
             #print('unexpected handle_options_response: ' + str(response.status_code))
             pass
 
-        self.options_change_in_progress = False
+        with self.state_change:
+            self.options_change_in_progress = False
+            self.state_change.notify_all()
+        self.control_ref.notify_dispatcher()
+
+
+    # marks this instance as finished with its current request;
+    # wakes up anything waiting on it (worker threads, the controller's dispatch loop)
+    def set_idle(self):
+        with self.state_change:
+            self.busy = False
+            self.state_change.notify_all()
+        self.control_ref.notify_dispatcher()
+
+
+    # blocks the calling thread until the current request finishes
+    def wait_until_idle(self):
+        with self.state_change:
+            while self.busy and self.isRunning:
+                self.state_change.wait(1)
+
+
+    # blocks the calling thread until a pending options change (e.g. model load) finishes
+    def wait_for_options_change(self):
+        with self.state_change:
+            while self.options_change_in_progress and self.isRunning:
+                self.state_change.wait(1)
+
+
+    # records the idle time since the previous generation request finished
+    def generation_started(self):
+        self.generating = True
+        self.progress_step = 0
+        self.progress_steps = 0
+        self.progress_last = None
+        self.eta = -1
+        self.status = ''
+        if self.last_generation_end > 0:
+            self.idle_gap_total += time.time() - self.last_generation_end
+            self.idle_gap_count += 1
+            self.last_generation_end = 0
+
+
+    # called when a generation request finishes (successfully or not)
+    def generation_finished(self):
+        self.generating = False
+        self.eta = -1
+        self.status = ''
+
+
+    # asks SD for the progress of the current generation request, unless a previous
+    # poll is still outstanding; called by the controller's ProgressMonitor
+    def poll_progress(self):
+        if self.generating and self.isRunning and not self.progress_request_pending:
+            self.progress_request_pending = True
+            if ProgressRequest(self, self.handle_progress).start() == None:
+                self.progress_request_pending = False
+
+
+    # handles progress API responses
+    # SD reports progress per batch (job_no of job_count), each sampling_steps long
+    def handle_progress(self, response):
+        self.progress_request_pending = False
+        if response == None or not self.generating:
+            return
+        try:
+            r = response.json()
+            state = r['state']
+            steps = int(state.get('sampling_steps', 0))
+            done = int(state.get('job_no', 0)) * steps + int(state.get('sampling_step', 0))
+            total = int(state.get('job_count', 0)) * steps
+        except:
+            return
+
+        now = time.time()
+        if self.progress_last != None and done > self.progress_last[1]:
+            rate = (done - self.progress_last[1]) / (now - self.progress_last[0])
+            if self.its == 0:
+                self.its = rate
+            else:
+                self.its = (0.7 * self.its) + (0.3 * rate)
+            self.control_ref.progress_monitor.add_steps(done - self.progress_last[1])
+        if self.progress_last == None or done != self.progress_last[1]:
+            self.progress_last = (now, done)
+
+        self.progress_step = done
+        self.progress_steps = max(total, done)
+        if self.its > 0 and total > 0:
+            self.eta = max(0, total - done) / self.its
+        else:
+            self.eta = r.get('eta_relative', -1)
+
+        status = str(self.progress_step) + '/' + str(self.progress_steps) + ' steps'
+        if self.its > 0:
+            status += ' @ ' + str(round(self.its, 2)) + ' it/s'
+        if self.eta != None and self.eta >= 0:
+            status += ' | ETA ' + time.strftime("%M:%S", time.gmtime(self.eta))
+        self.status = status
+
+
+    # average seconds the GPU sat idle between generation requests, or -1 if unknown
+    def avg_idle_gap(self):
+        if self.idle_gap_count > 0:
+            return self.idle_gap_total / self.idle_gap_count
+        return -1
+
+
+    # called when a request finishes; reports errors that would otherwise be
+    # silently swallowed by the client and frees up the instance so that
+    # anything waiting on it isn't stuck forever
+    def request_done(self, future):
+        with self.state_change:
+            self.requests_in_flight.discard(future)
+        if not future.cancelled() and future.exception() != None:
+            if self.isRunning:
+                self.log("request failed: " + str(future.exception()), True)
+            self.last_job_success = False
+            self.generation_finished()
+            with self.state_change:
+                self.options_change_in_progress = False
+            self.set_idle()
+
+
+    # False if we started an SD process and it has since exited
+    def process_alive(self):
+        if self.process == None:
+            return True
+        if self.process.poll() != None:
+            return False
+        try:
+            process = psutil.Process(self.process.pid)
+            return process.is_running() and process.status() != psutil.STATUS_ZOMBIE
+        except psutil.Error:
+            return False
+
+
+    # returns True if the API answers within timeout seconds
+    # (the progress endpoint answers even while a generation request is running)
+    def ping(self, timeout = 30):
+        try:
+            response = self.client.call(self.fetch('GET', '/sdapi/v1/progress?skip_current_image=true', None, timeout, False), timeout + 5)
+            response.raise_for_status()
+            return True
+        except Exception:
+            return False
+
+
+    # takes this instance out of service after it has crashed or hung: kills our SD process
+    # and fails whatever is in flight, so that anything waiting on the instance is released
+    def stop(self):
+        self.ready = False
+        self.log("stopping SD instance...", True)
+        if self.process != None:
+            self.kill_sd_process()
+            try:
+                self.process.wait(30)
+            except Exception:
+                pass
+            self.process = None
+            self.monitor = None
+            self.model_loaded = ''
+        elif self.busy:
+            # not ours to kill; stop whatever it's working on if it'll still listen
+            try:
+                self.client.call(self.fetch('POST', '/sdapi/v1/interrupt', {}, 5, False), 10)
+            except Exception:
+                pass
+        with self.state_change:
+            in_flight = list(self.requests_in_flight)
+        for future in in_flight:
+            future.cancel()
+        self.progress_request_pending = False
+        self.generation_finished()
+        self.last_job_success = False
+        with self.state_change:
+            self.options_change_in_progress = False
+        self.set_idle()
+
+
+    # brings this instance back after stop()
+    # hands it back to the main loop to initialize, so restarts go through GPU_INIT_STAGGER too
+    def restart(self):
+        self.ping_failures = 0
+        self.ready = False
+        self.boot_failed = False
+        self.init = False
+        self.control_ref.notify_dispatcher()
 
 
     # shutdown and clean up
     def cleanup(self):
         self.isRunning = False
+        with self.state_change:
+            # release anything still waiting on this instance
+            self.state_change.notify_all()
         if self.busy:
             # if we're busy, send an interrupt request
             self.log("terminating current task...", True)
-            int = InterruptRequest(self)
-            int.start()
+            try:
+                self.client.call(self.fetch('POST', '/sdapi/v1/interrupt', {}, 5), 10)
+            except:
+                pass
+        # cancel anything still in flight
+        self.closed = True
+        with self.state_change:
+            in_flight = list(self.requests_in_flight)
+        for future in in_flight:
+            future.cancel()
 
         self.logfile.close()
         self.errorfile.close()
@@ -1040,13 +1312,14 @@ class SDI:
         # the atexit call should get this, but will check here also
         self.kill_sd_process()
 
-        # cleanup gpu working dir
-        if self.output_dir != '':
-            if os.path.exists(self.output_dir):
-                shutil.rmtree(self.output_dir)
+        # cleanup gpu working dirs
+        for dir in self.samples_dirs:
+            if os.path.exists(dir):
+                shutil.rmtree(dir, ignore_errors=True)
 
 
     # kill the SD child process
+    # (attached instances have no child process, so they're always left running)
     def kill_sd_process(self):
         if self.process != None:
             #print("attempting to kill SD")
@@ -1071,3 +1344,4 @@ class SDI:
         print(pre + line)
         if webserver:
             self.control_ref.output_buffer.append(pre + line + '\n')
+            self.control_ref.publish('log', pre + line + '\n')
@@ -2,11 +2,15 @@
 # SPDX-License-Identifier: MIT
 
 import os, os.path
+import json
 import random
 import string
 import time
 import scripts.utils as utils
+import scripts.gallery as gallery
+from scripts.events import sse
 from datetime import datetime, timedelta
+from urllib.parse import quote
 import cherrypy
 from cherrypy.lib import auth_basic, static
 from cherrypy.process.plugins import SimplePlugin
@@ -47,7 +51,8 @@ def build_prompt_editor_text(prompt_file):
     return buffer
 
 
-def build_gallery(control):
+# returns the paths of the images currently shown in the gallery, newest first
+def gallery_images(control):
     images = []
     if control.config['gallery_current'] == 'recent':
         images = utils.get_recent_images(control.config['output_location'], control.config['gallery_max_images'])
@@ -56,212 +61,92 @@ def build_gallery(control):
             images = utils.get_images_from_dir(control.config['gallery_user_folder'], control.config['gallery_max_images'])
         else:
             images = utils.get_images_from_dir(control.config['gallery_current'], control.config['gallery_max_images'])
+    return images
 
-    buffer = "<ul id=\"images\" class=\"image-gallery\">\n"
 
-    for img in images:
-        exif = utils.read_exif_from_image(img)
-        details = ""
-        upscale_info = ""
-        if exif != None:
-            try:
-                details = exif[0x9c9c].decode('utf16')
-                upscale_info = exif[0x9c9d].decode('utf16')
-            except KeyError as e:
-                pass
-
-        params = utils.extract_params_from_command(details)
-        param_string = ''
-
-        neg_prompt = params['neg_prompt']
-        if neg_prompt != "":
-            neg_prompt = neg_prompt.replace('<', '&lt;').replace('>', '&gt;')
-            neg_prompt = "negative prompt: " + neg_prompt
-
-        short_prompt = params['prompt']
-        if len(params['prompt']) > 302:
-            short_prompt = params['prompt'][:300] + '...'
-
-        prompt = ''
-        if params['prompt'] != '' or params['steps'] != '':
-            if params['prompt'] == '':
-                prompt = '(no prompt)'
-            else:
-                prompt = params['prompt'].replace('<', '&lt;').replace('>', '&gt;')
+# returns the gallery display strings for each image (see gallery.describe_image)
+def gallery_entries(control, images):
+    if control.gallery_index != None:
+        return control.gallery_index.entries(images)
+    return [gallery.read_image_entry(img) for img in images]
 
-            if params['width'] != '':
-                if 'highres_scale_factor' in params and params['highres_scale_factor'] != '':
-                    calc_width = round(float(params['highres_scale_factor']) * float(params['width']))
-                    calc_height = round(float(params['highres_scale_factor']) * float(params['height']))
-                    param_string += 'size: ' + str(calc_width) + 'x' + str(calc_height)
-                else:
-                    param_string += 'size: ' + str(params['width']) + 'x' + str(params['height'])
-
-            if params['input_image'] != "":
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'init image: ' + params['input_image'] + '  |  strength: ' + str(params['strength'])
-
-            if params['ckpt_file'] != '':
-                if param_string != '':
-                    param_string += '  |  '
-                # remove the hash from the string
-                model = str(params['ckpt_file'])
-                model = model.split('[', 1)[0].strip()
-                param_string += 'model: ' + model
-
-            if params['tiling'] == 'yes':
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'seamless tiling enabled'
-
-            if params['controlnet_input_image'] != '' and (params['controlnet_model'] != '' or 'reference' in params['controlnet_pre']):
-                if param_string != '':
-                    param_string += '  |  '
-                # remove the hash from the model string
-                model = str(params['controlnet_model'])
-                model = model.split('[', 1)[0].strip()
-                param_string += 'ControlNet enabled: ' + params['controlnet_input_image'] + ' (' + model + ')'
-                if params['controlnet_controlmode'] == 'prompt':
-                    param_string += ' (favor prompt)'
-                elif params['controlnet_controlmode'] == 'controlnet':
-                    param_string += ' (favor ControlNet)'
-                if params['controlnet_pixelperfect'] == 'yes':
-                    param_string += ' (pixel perfect)'
-
-            if params['adetailer_model'] != '':
-                if param_string != '':
-                    param_string += '  |  '
-                # remove the hash from the model string
-                model = str(params['adetailer_model'])
-                model = model.split('[', 1)[0].strip()
-                param_string += 'ADetailer enabled ' + ' (' + model + ')'
-
-            if params['sampler'] != '':
-                sampler_full_name = str(params['sampler'])
-                if 'scheduler' in params and params['scheduler'] != '' and params['scheduler'].lower() != 'automatic':
-                    sampler_full_name += ' ' + str(params['scheduler'])
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'sampler: ' + sampler_full_name
-
-            if params['steps'] != '':
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'steps: ' + str(params['steps'])
-
-            if params['scale'] != '':
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'scale: ' + str(params['scale'])
-
-            if params['clip_skip'] != '':
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'CLIP skip: ' + str(params['clip_skip'])
-
-            if params['vae'] != '':
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'VAE: ' + str(params['vae'])
-
-            if 'refiner_ckpt_file' in params and params['refiner_ckpt_file'] != '':
-                if param_string != '':
-                    param_string += '  |  '
-                model = str(params['refiner_ckpt_file'])
-                model = model.split('[', 1)[0].strip()
-                param_string += 'refiner: ' + model
-                if 'refiner_switch' in params and params['refiner_switch'] != '':
-                    param_string += ' (switch at ' + str(params['refiner_switch']) + ')'
-
-            if params['styles'] != '':
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'style(s): ' + str(params['styles'].replace('Style: ', ''))
-
-            show_denoise = False
-            if 'highres_scale_factor' in params and params['highres_scale_factor'] != '' and params['width'] != '':
-                show_denoise = True
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'highres fix applied: ' + str(params['highres_scale_factor']) + 'x scaling on ' + str(params['width']) + 'x' + str(params['height'])
-
-            if 'highres_ckpt_file' in params and params['highres_ckpt_file'] != '':
-                show_denoise = True
-                if param_string != '':
-                    param_string += '  |  '
-                model = str(params['highres_ckpt_file'])
-                model = model.split('[', 1)[0].strip()
-                param_string += 'HR fix model: ' + model
-
-            if 'highres_upscaler' in params and params['highres_upscaler'] != '':
-                show_denoise = True
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'HR fix upscaler: ' + str(params['highres_upscaler'])
-
-            if 'highres_sampler' in params and params['highres_sampler'] != '':
-                show_denoise = True
-                hr_sampler_full_name = str(params['highres_sampler'])
-                if 'highres_scheduler' in params and params['highres_scheduler'] != '' and params['highres_scheduler'].lower() != 'automatic':
-                    hr_sampler_full_name += ' ' + str(params['highres_scheduler'])
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'HR fix sampler: ' + hr_sampler_full_name
-
-            if 'highres_steps' in params and params['highres_steps'] != '':
-                show_denoise = True
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'HR fix steps: ' + str(params['highres_steps'])
-
-            if show_denoise and params['strength'] != '':
-                param_string += '  |  '
-                param_string += 'HR fix denoising: ' + str(params['strength'])
-
-            if params['seed'] != '':
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += 'seed: ' + str(params['seed'])
-
-            ad_info = upscale_info
-            if '(upscaled' in upscale_info:
-                upscale_info = upscale_info.split('(upscaled', 1)[1]
-                if '(ADetailer' in upscale_info:
-                    upscale_info = upscale_info.split('(ADetailer', 1)[0]
-                upscale_info = upscale_info.replace(')', '').strip()
-                upscale_info = "upscaled " + upscale_info
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += upscale_info
-
-            if '(ADetailer' in ad_info:
-                ad_info = ad_info.split('(ADetailer', 1)[1]
-                ad_info = ad_info.replace(')', '').strip()
-                ad_info = "ADetailer " + ad_info
-                if param_string != '':
-                    param_string += '  |  '
-                param_string += ad_info
-
-        #img_identifier = utils.filename_from_abspath(img)
-        img_identifier = utils.slugify(img)
-
-        buffer += "\t<li id=\"" + img_identifier + "\" onclick=\"img_modal('i_" + img_identifier + "', 'd_" + img_identifier + "', 'p_" + img_identifier + "')\">\n"
-        if control.config['gallery_current'] == 'user_gallery':
-            #buffer += "\t\t<img src=\"/user_gallery/" + img_identifier + "\" id=\"i_" + img_identifier + "\"/>\n"
-            buffer += "\t\t<img src=\"/user_gallery/" + utils.filename_from_abspath(img) + "\" id=\"i_" + img_identifier + "\"/>\n"
-        else:
-            buffer += "\t\t<img src=\"/" + img + "\" id=\"i_" + img_identifier + "\"/>\n"
-        buffer += "\t\t<div class=\"overlay\"><span id=\"c_" + img_identifier + "\">" + short_prompt + "</span></div>\n"
-        buffer += "\t\t<div class=\"hidden\" id=\"d_" + img_identifier + "\">" + prompt + "</div>\n"
-        buffer += "\t\t<div class=\"hidden\" id=\"n_" + img_identifier + "\">" + neg_prompt + "</div>\n"
-        buffer += "\t\t<div class=\"hidden\" id=\"p_" + img_identifier + "\">" + param_string + "</div>\n"
-        buffer += "\t</li>\n"
 
+def build_gallery_item(control, img, entry):
+    short_prompt = entry['short_prompt']
+    prompt = entry['prompt']
+    neg_prompt = entry['neg_prompt']
+    param_string = entry['param_string']
+
+    #img_identifier = utils.filename_from_abspath(img)
+    img_identifier = utils.slugify(img)
+
+    buffer = "\t<li id=\"" + img_identifier + "\" onclick=\"img_modal('i_" + img_identifier + "', 'd_" + img_identifier + "', 'p_" + img_identifier + "')\">\n"
+    if control.config['gallery_current'] == 'user_gallery':
+        #src = "/user_gallery/" + img_identifier
+        src = "/user_gallery/" + utils.filename_from_abspath(img)
+    else:
+        src = "/" + img
+    if control.thumbnails != None:
+        # show a thumbnail; the full-size image is only loaded when it's opened
+        # (v changes when the image does, so browsers can cache thumbnails forever)
+        try:
+            version = str(os.stat(img).st_mtime_ns)
+        except OSError:
+            version = '0'
+        buffer += "\t\t<img src=\"/thumb?img=" + quote(src) + "&v=" + version + "\" data-full=\"" + src + "\" loading=\"lazy\" id=\"i_" + img_identifier + "\"/>\n"
+    else:
+        buffer += "\t\t<img src=\"" + src + "\" id=\"i_" + img_identifier + "\"/>\n"
+    buffer += "\t\t<div class=\"overlay\"><span id=\"c_" + img_identifier + "\">" + short_prompt + "</span></div>\n"
+    buffer += "\t\t<div class=\"hidden\" id=\"d_" + img_identifier + "\">" + prompt + "</div>\n"
+    buffer += "\t\t<div class=\"hidden\" id=\"n_" + img_identifier + "\">" + neg_prompt + "</div>\n"
+    buffer += "\t\t<div class=\"hidden\" id=\"p_" + img_identifier + "\">" + param_string + "</div>\n"
+    buffer += "\t</li>\n"
+    return buffer
+
+
+def build_gallery(control, images = None):
+    if images == None:
+        images = gallery_images(control)
+
+    buffer = "<ul id=\"images\" class=\"image-gallery\">\n"
+    for img, entry in zip(images, gallery_entries(control, images)):
+        buffer += build_gallery_item(control, img, entry)
     buffer += "</ul>\n"
     return buffer
 
 
+# returns what has changed in the gallery since the version (cursor) a browser last saw, as
+# JSON: {"etag", "remove": [ids], "add": [{"id", "after", "html"}]}, or {"etag", "full": html}
+# if we can't tell what the browser has; returns None if nothing has changed
+def build_gallery_delta(control, history, cursor):
+    images = gallery_images(control)
+    paths = {}
+    items = []
+    for img in images:
+        id = utils.slugify(img)
+        paths[id] = img
+        try:
+            mtime = os.path.getmtime(img)
+        except OSError:
+            mtime = 0
+        items.append((id, mtime))
+    location = control.config['gallery_current']
+    etag = history.record(location, items)
+    if cursor == etag:
+        return etag, None
+
+    changes = history.changes(cursor, location, items)
+    if changes == None:
+        return etag, json.dumps({'etag' : etag, 'full' : build_gallery(control, images)})
+
+    removed, added = changes
+    added_images = [paths[id] for id, after in added]
+    add = []
+    for (id, after), img, entry in zip(added, added_images, gallery_entries(control, added_images)):
+        add.append({'id' : id, 'after' : after, 'html' : build_gallery_item(control, img, entry)})
+    return etag, json.dumps({'etag' : etag, 'remove' : removed, 'add' : add})
+
+
 def build_prompt_panel(control):
     buffer = ""
     if not control.prompt_file == "":
@@ -281,13 +166,13 @@ def build_prompt_panel(control):
             else:
                 buffer += "\t\tmode: random prompts\n"
         elif control.get_mode() == 'standard':
-            buffer += "\t\t" + str(control.jobs_done) + " of " + str(control.orig_work_queue_size) + " prompt combinations completed"
+            buffer += "\t\t" + str(control.jobs_done) + " of " + str(control.work_queue_total()) + " prompt combinations completed"
             if control.repeat_jobs:
                 buffer += " | loops done: " + str(control.loops) + " | repeat: on\n"
             else:
                 buffer += " | repeat: off\n"
         elif control.get_mode() == 'process':
-            buffer += "\t\t" + str(control.jobs_done) + " of " + str(control.orig_work_queue_size) + " work items completed"
+            buffer += "\t\t" + str(control.jobs_done) + " of " + str(control.work_queue_total()) + " work items completed"
             buffer += "\t\t | mode: process\n"
 
         buffer += "\t</div>\n"
@@ -872,6 +757,7 @@ def build_worker_panel(workers):
 
         working_text = "dreaming"
         clock_text = "0:00"
+        progress_text = ""
         prompt_text = ""
         prompt_options_text = ""
 
@@ -883,7 +769,13 @@ def build_worker_panel(workers):
             if not worker['sdi_instance'].init:
                 prompt_text = "<div style=\"color: yellow; padding-top: 6px;\">" + "waiting to be initialized...</div>"
             if worker['sdi_instance'].init and not worker['sdi_instance'].ready:
-                prompt_text = "<div style=\"padding-top: 6px;\">" + "currently being initialized on port " + str(worker['sdi_instance'].sd_port) + "...</div>"
+                boot_clock = time.strftime("%M:%S", time.gmtime(time.time() - worker['sdi_instance'].boot_start))
+                prompt_text = "<div style=\"padding-top: 6px;\">" + "currently being initialized on port " + str(worker['sdi_instance'].sd_port) + "... (" + boot_clock + ")</div>"
+            if worker['sdi_instance'].boot_failed:
+                prompt_text = "<div style=\"color: yellow; padding-top: 6px;\">" + "failed to initialize; check the logs for this GPU!</div>"
+            if worker['sdi_instance'].backoff_until > 0:
+                wait_clock = time.strftime("%H:%M:%S", time.gmtime(max(0, worker['sdi_instance'].backoff_until - time.time())))
+                prompt_text = "<div style=\"color: yellow; padding-top: 6px;\">" + "failed repeatedly; will try restarting it again in " + wait_clock + "</div>"
             if worker['sdi_instance'].ready and worker['sdi_instance'].busy:
                 # this should only happen in this case
                 prompt_text = "<div style=\"padding-top: 6px;\">" + "performing initial data exchange queries with SD instance...</div>"
@@ -939,6 +831,7 @@ def build_worker_panel(workers):
 
                 exec_time = time.time() - worker["job_start_time"]
                 clock_text = time.strftime("%M:%S", time.gmtime(exec_time))
+                progress_text = worker['sdi_instance'].status
             else:
                 # this should only happen during options change/model load
                 if worker['sdi_instance'].model_loading_now != '':
@@ -959,6 +852,8 @@ def build_worker_panel(workers):
         else:
             buffer += "\t\t\t<div>[" + working_text + "]</div>\n"
         buffer += "\t\t\t<div class=\"clock\">" + clock_text + "</div>\n"
+        if progress_text != "":
+            buffer += "\t\t\t<div class=\"small\">" + progress_text + "</div>\n"
         buffer += "\t\t</div>\n"
         buffer += "\t\t<div class=\"right\">\n"
         buffer += "\t\t\t<div class=\"right-top\">" + prompt_text + "</div>\n"
@@ -988,8 +883,8 @@ class ArtGenerator(object):
         zip_path = utils.create_zip(dir)
         return static.serve_download(os.path.abspath(zip_path))
 
-    @cherrypy.expose
-    def getimg(self, img):
+    # returns the absolute path on disk of a gallery image's web path
+    def gallery_path(self, img):
         actual_path = ""
         if ('user_gallery/') in img:
             actual_path = img.split('user_gallery/', 1)[1]
@@ -997,18 +892,134 @@ class ArtGenerator(object):
         else:
             actual_path = img.split('output/', 1)[1]
             actual_path = os.path.join(self.control.config['output_location'], actual_path)
+        return os.path.abspath(actual_path)
+
+    @cherrypy.expose
+    def getimg(self, img):
+        return static.serve_download(self.gallery_path(img))
+
+    @cherrypy.expose
+    def thumb(self, img, v=''):
+        try:
+            actual_path = self.gallery_path(img)
+        except IndexError:
+            raise cherrypy.NotFound()
+
+        # only serve images from the gallery folders
+        allowed = False
+        for dir in [self.control.config['output_location'], self.control.config['gallery_user_folder']]:
+            if dir != '' and actual_path.startswith(os.path.abspath(dir) + os.path.sep):
+                allowed = True
+        if not allowed or not os.path.isfile(actual_path):
+            raise cherrypy.NotFound()
+
+        thumb = None
+        if self.control.thumbnails != None:
+            thumb = self.control.thumbnails.get(actual_path)
+        if thumb == None:
+            # couldn't make one; fall back to the full-size image
+            return static.serve_file(actual_path)
+
+        # the URL changes whenever the image does, so this never needs re-checking
+        cherrypy.response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return static.serve_file(os.path.abspath(thumb))
+
+# returns True if something on the worker panel is counting up/down (jobs running,
+# SD instances booting or backing off), so it needs re-drawing even w/o any events
+def workers_active(control):
+    for worker in control.workers:
+        if not worker['idle']:
+            return True
+        sdi = worker['sdi_instance']
+        if (sdi.init and not sdi.ready and not sdi.boot_failed) or sdi.backoff_until > 0:
+            return True
+    return False
 
-        return static.serve_download(os.path.abspath(actual_path))
 
 @cherrypy.expose
 class ArtGeneratorWebService(object):
+    # which panels need re-drawing after each type of event
+    EVENT_PANELS = {
+        'job_started' : ['workers', 'status'],
+        'job_finished' : ['status', 'prompts'],
+        'worker' : ['workers'],
+        'queue' : ['status', 'prompts'],
+        'pause' : ['status'],
+        'buffer' : ['buffer']
+    }
+
     def __init__(self, control_ref):
         self.control = control_ref
+        self.gallery_history = gallery.GalleryHistory()
 
 
-    @cherrypy.tools.accept(media='text/plain')
+    # streams changes to the web UI as server-sent events, so pages don't have to poll:
+    # log (a new log line), buffer (the whole log, w/ its max length), status, workers and
+    # prompts (re-drawn panels, only sent when something on them has changed), and
+    # job_started, job_finished, worker, queue and pause (JSON details)
+    @cherrypy.tools.accept(media=['text/plain', 'text/event-stream'])
     def GET(self):
-        pass
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        last_id = cherrypy.request.headers.get('Last-Event-ID', '')
+        return self.event_stream(last_id)
+    # don't hold the session lock for as long as the stream is open
+    GET._cp_config.update({'response.stream': True, 'tools.sessions.on': False})
+
+    def event_stream(self, last_id):
+        events = self.control.events
+        if not events.subscribe():
+            # too many pages open; tell this one to poll
+            yield sse('busy').encode('utf-8')
+            return
+        try:
+            since = events.last_id
+            panels = set()
+            # a reconnecting browser that hasn't missed anything only needs what's new
+            if last_id.isdigit() and events.has(int(last_id)):
+                since = int(last_id)
+            else:
+                panels.update(['buffer', 'status', 'workers', 'prompts'])
+            yield ('retry: 3000\n\n' + self.render_panels(panels, since)).encode('utf-8')
+
+            was_active = False
+            while not events.closed:
+                active = workers_active(self.control)
+                # re-draw every second while a clock is running, and once more when it stops
+                new = events.wait(since, 1 if active or was_active else 15)
+                panels = set()
+                if active or was_active:
+                    panels.update(['workers', 'status'])
+                was_active = active
+
+                buffer = ''
+                for id, type, data in new:
+                    since = id
+                    if type == 'log':
+                        buffer += sse(type, data, id)
+                    else:
+                        panels.update(self.EVENT_PANELS.get(type, []))
+                        if type != 'buffer':
+                            buffer += sse(type, data, id)
+                buffer += self.render_panels(panels, since)
+                if buffer == '':
+                    # keep-alive; also how we find out the browser has gone away
+                    buffer = ': \n\n'
+                yield buffer.encode('utf-8')
+        finally:
+            events.unsubscribe()
+
+    def render_panels(self, panels, id):
+        buffer = ''
+        if 'buffer' in panels:
+            buffer += sse('buffer', {'length' : self.control.output_buffer.maxlen, 'text' : self.BUFFER_REFRESH()}, id)
+        if 'status' in panels:
+            buffer += sse('status', self.STATUS_REFRESH(), id)
+        if 'workers' in panels:
+            buffer += sse('workers', self.WORKER_REFRESH(), id)
+        if 'prompts' in panels:
+            buffer += sse('prompts', self.PROMPT_REFRESH(), id)
+        return buffer
 
     def POST(self, type, arg):
         if type.lower().strip() == 'gallery_delete':
@@ -1121,6 +1132,21 @@ class ArtGeneratorWebService(object):
         buffer_text = build_gallery(self.control)
         return buffer_text
 
+    # cursor is the ETag of the last version of the gallery the browser has
+    # responds w/ 304 if nothing has changed since then
+    def GALLERY_DELTA(self, cursor = ''):
+        match = cherrypy.request.headers.get('If-None-Match', '').strip('"')
+        if cursor == '':
+            cursor = match
+        etag, buffer_text = build_gallery_delta(self.control, self.gallery_history, cursor)
+        cherrypy.response.headers['ETag'] = '"' + etag + '"'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        if buffer_text == None:
+            cherrypy.response.status = 304
+            return ''
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return buffer_text
+
     def GALLERY_REFRESH_RATE(self):
         return str(self.control.config['gallery_refresh'])
 
@@ -1136,10 +1162,33 @@ class ArtGeneratorWebService(object):
                 buffer_text = "y<div style=\"color: yellow;\">Pause requested; waiting for " + str(self.control.num_workers_working()) + " worker(s) to finish...</div>"
             else:
                 buffer_text = "y<div style=\"color: yellow;\">Server is paused</div>"
-        buffer_text += "<div>Server uptime: "
+        # the page keeps the uptime counting between refreshes
         diff = time.time() - self.control.server_startup_time
+        buffer_text += "<div>Server uptime: <span id=\"server-uptime\" data-uptime=\"" + str(round(diff)) + "\">"
         buffer_text += "{}".format(str(timedelta(seconds = round(diff, 0))))
-        buffer_text += "</div><div>Total jobs done: " + jobs_done + "</div>"
+        buffer_text += "</span></div><div>Total jobs done: " + jobs_done + "</div>"
+        if self.control.scheduler.swaps_avoided > 0:
+            buffer_text += "<div>" + self.control.scheduler.status() + "</div>"
+        if len(self.control.work_queue) > 0:
+            drain = self.control.scheduler.drain_status()
+            if drain != '':
+                buffer_text += "<div>" + drain + "</div>"
+        idle_gap = self.control.avg_idle_gap()
+        if idle_gap >= 0:
+            buffer_text += "<div>Avg GPU idle time between jobs: " + str(round(idle_gap, 2)) + "s</div>"
+        if self.control.supervisor.restarts_done > 0:
+            buffer_text += "<div>" + self.control.supervisor.status() + "</div>"
+        if self.control.finalize_peak > 0:
+            buffer_text += "<div>" + self.control.finalize_status() + "</div>"
+        boot_times = self.control.boot_time_status()
+        if boot_times != '':
+            buffer_text += "<div>" + boot_times + "</div>"
+        farm_its = self.control.progress_monitor.farm_its()
+        if farm_its > 0:
+            buffer_text += "<div>Farm throughput: " + str(round(farm_its, 2)) + " it/s (last " + str(self.control.progress_monitor.window) + "s)</div>"
+        opened, reused = self.control.connection_stats()
+        if opened > 0:
+            buffer_text += "<div>SD connections opened: " + str(opened) + " (" + str(reused) + " requests re-used an open connection)</div>"
         if self.control.config['debug_test_mode']:
             buffer_text += "<div style=\"color: yellow;\">*** TEST/DEBUG MODE ENABLED - NO ACTUAL IMAGES ARE BEING CREATED! ***</div>"
         return buffer_text
@@ -1150,6 +1199,7 @@ class ArtGeneratorWebService(object):
 
     def BUFFER_CLEAR(self):
         self.control.output_buffer.clear()
+        self.control.publish('buffer')
 
     def SERVER_PAUSE(self):
         self.control.pause()
@@ -1246,6 +1296,8 @@ class ArtServer:
             cherrypy.config.update({'server.socket_host': '0.0.0.0'})
 
         cherrypy.config.update({'server.socket_port': self.control_ref.config['webserver_port']})
+        # each open page's event stream holds a thread
+        cherrypy.config.update({'server.thread_pool': 10 + self.control_ref.events.max_listeners})
         webapp = ArtGenerator(self.control_ref)
         webapp.generator = ArtGeneratorWebService(self.control_ref)
 
@@ -0,0 +1,112 @@
+# Copyright 2021 - 2023, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+import time
+import threading
+
+
+# watches every SD instance for crashes and hangs, and brings failed ones back
+# an instance is considered failed if its process has exited, its API stops answering,
+# its current job runs past job_timeout, or it failed to start; failed instances are
+# killed and restarted (the job they were running goes back on the queue), and after
+# max_restarts failures in a row w/o finishing a job, a worker is rested for a while
+class Supervisor(threading.Thread):
+    def __init__(self, control_ref, interval = 15, job_timeout = 1800, max_restarts = 3, backoff = 600, ping_failures = 3, job_retries = 2):
+        threading.Thread.__init__(self, daemon=True)
+        self.control_ref = control_ref
+        self.interval = interval
+        self.job_timeout = job_timeout
+        self.max_restarts = max_restarts
+        self.backoff = backoff
+        # consecutive failed API pings before an instance is considered hung
+        self.ping_failures = ping_failures
+        # how many times a job is re-queued before we give up on it
+        self.job_retries = job_retries
+        self.restarts_done = 0
+        self.jobs_requeued = 0
+
+
+    def run(self):
+        while not self.control_ref.shutting_down:
+            time.sleep(self.interval)
+            for worker in list(self.control_ref.workers):
+                if self.control_ref.shutting_down:
+                    break
+                if worker.get('sdi_instance') == None:
+                    continue
+                try:
+                    self.check(worker)
+                except Exception as e:
+                    worker['sdi_instance'].log('*** health check failed unexpectedly: ' + str(e) + ' ***', True)
+
+
+    # checks on a worker's SD instance, and recovers it if it has failed
+    def check(self, worker):
+        sdi = worker['sdi_instance']
+        if not sdi.init or not sdi.isRunning:
+            # not started yet, or shutting down
+            return
+
+        if sdi.backoff_until > 0:
+            if time.time() >= sdi.backoff_until:
+                sdi.backoff_until = 0
+                sdi.log('back-off period over; restarting SD instance...', True)
+                self.restart(worker)
+            return
+
+        if sdi.boot_failed:
+            self.recover(worker, 'SD instance failed to start')
+            return
+        if not sdi.ready:
+            # still starting up (which has its own timeout)
+            return
+
+        if not sdi.process_alive():
+            self.recover(worker, 'SD process has exited')
+        elif self.job_timeout > 0 and not worker['idle'] and worker['job_start_time'] > 0 \
+                and time.time() - worker['job_start_time'] > self.job_timeout:
+            self.recover(worker, 'job #' + str(worker['jobs_done']+1) + ' has been running for over ' + str(self.job_timeout) + ' seconds')
+        elif not sdi.ping():
+            sdi.ping_failures += 1
+            if sdi.ping_failures >= self.ping_failures:
+                self.recover(worker, 'SD API has stopped responding')
+        else:
+            sdi.ping_failures = 0
+
+
+    # takes a failed instance out of service, then restarts it (or schedules
+    # a restart for later if it keeps failing)
+    def recover(self, worker, reason):
+        sdi = worker['sdi_instance']
+        sdi.log('*** ' + reason + '! ***', True)
+        self.control_ref.release_worker(worker)
+        sdi.restarts += 1
+        if self.max_restarts > 0 and sdi.restarts > self.max_restarts:
+            # back off for longer each time it fails again (up to 6 hours)
+            delay = min(self.backoff * (2 ** (sdi.restarts - self.max_restarts - 1)), 6 * 3600)
+            sdi.backoff_until = time.time() + delay
+            sdi.log('*** SD instance has failed ' + str(sdi.restarts) + ' times in a row; waiting ' + str(round(delay)) + ' seconds before trying again! ***', True)
+            return
+        self.restart(worker)
+
+
+    def restart(self, worker):
+        self.restarts_done += 1
+        # re-apply the options Dream Factory needs once it's back up
+        worker['sdi_setup_request_made'] = False
+        worker['sdi_instance'].restart()
+
+
+    # returns True if a failed job should go back on the queue; records the attempt
+    def retry_job(self, job):
+        retries = job.get('retries', 0) + 1
+        if retries > self.job_retries:
+            return False
+        job['retries'] = retries
+        self.jobs_requeued += 1
+        return True
+
+
+    # one-line summary for the status panel
+    def status(self):
+        return "SD instance restarts: " + str(self.restarts_done) + " (" + str(self.jobs_requeued) + " job(s) re-queued)"
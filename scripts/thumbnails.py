@@ -0,0 +1,167 @@
+# Copyright 2021 - 2024, Bill Kennedy (https://github.com/rbbrdckybk/dream-factory)
+# SPDX-License-Identifier: MIT
+
+import os
+import hashlib
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, features
+
+
+# creates a thumbnail of src at dst, no larger than size x size
+# runs on the thumbnail pool; PIL releases the GIL while decoding and resizing, so
+# threads are enough (and w/o the cost of spawning processes that re-import everything)
+def make_thumbnail(src, dst, size, quality = 80):
+    with Image.open(src) as im:
+        # lets JPEGs decode at a fraction of their full size, which is much faster
+        im.draft('RGB', (size * 2, size * 2))
+        im = im.convert('RGB')
+        im.thumbnail((size, size))
+        tmp = dst + '.tmp'
+        if dst.endswith('.webp'):
+            im.save(tmp, 'WEBP', quality=quality, method=4)
+        else:
+            im.save(tmp, 'JPEG', quality=quality, optimize=True)
+    # never leave a half-written thumbnail in the cache
+    os.replace(tmp, dst)
+    return dst
+
+
+# small versions of gallery images, so the gallery doesn't have to load full-size images
+# thumbnails are named for the image's path, mtime and size (so a changed image gets a new
+# one), made on a small thread pool, and the least recently used are removed once
+# the cache grows past max_mb
+class ThumbnailCache:
+    def __init__(self, dir = os.path.join('cache', 'thumbs'), size = 384, max_mb = 500, workers = 2):
+        self.dir = dir
+        self.size = size
+        self.max_bytes = max_mb * 1024 * 1024
+        self.workers = workers
+        self.ext = '.jpg'
+        if features.check('webp'):
+            self.ext = '.webp'
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pending = {}           # thumbnail filename: future, for thumbnails being made
+        self.total_bytes = -1       # current size of the cache; -1 until it's been measured
+        self.evicting = False
+        Path(self.dir).mkdir(parents=True, exist_ok=True)
+
+
+    # the pool is only started once it's needed
+    def get_pool(self):
+        if self.pool == None:
+            self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='thumbnail')
+        return self.pool
+
+
+    # returns the thumbnail filename for an image
+    def filename(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path) + '|' + str(stat.st_mtime_ns) + '|' + str(stat.st_size) + '|' + str(self.size)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.dir, key[:2], key + self.ext)
+
+
+    # starts making a thumbnail for an image if there isn't one already
+    # returns a Future that resolves to the thumbnail filename, or None if it already exists
+    def submit(self, path):
+        try:
+            thumb = self.filename(path)
+        except OSError:
+            return None
+        if os.path.exists(thumb):
+            return None
+        with self.lock:
+            future = self.pending.get(thumb)
+            if future == None:
+                Path(os.path.dirname(thumb)).mkdir(parents=True, exist_ok=True)
+                try:
+                    future = self.get_pool().submit(make_thumbnail, path, thumb, self.size)
+                except RuntimeError:
+                    # pool has been shut down
+                    return None
+                self.pending[thumb] = future
+                future.add_done_callback(lambda f: self.thumbnail_done(thumb, f))
+        return future
+
+
+    def thumbnail_done(self, thumb, future):
+        with self.lock:
+            self.pending.pop(thumb, None)
+            if future.cancelled() or future.exception() != None:
+                return
+            if self.total_bytes >= 0:
+                try:
+                    self.total_bytes += os.path.getsize(thumb)
+                except OSError:
+                    pass
+            evict = not self.evicting and (self.total_bytes < 0 or self.total_bytes > self.max_bytes)
+            if evict:
+                self.evicting = True
+        if evict:
+            threading.Thread(target=self.evict, name='thumbnail-evict', daemon=True).start()
+
+
+    # returns the thumbnail filename for an image, making it first if necessary
+    # (or None if one can't be made in time; the caller should use the full image)
+    def get(self, path, timeout = 10):
+        try:
+            thumb = self.filename(path)
+        except OSError:
+            return None
+        if os.path.exists(thumb):
+            # keep track of use, for eviction
+            try:
+                os.utime(thumb)
+            except OSError:
+                pass
+            return thumb
+        future = self.submit(path)
+        try:
+            if future != None:
+                future.result(timeout)
+        except Exception:
+            return None
+        if os.path.exists(thumb):
+            return thumb
+        return None
+
+
+    # removes the least recently used thumbnails until the cache is back under 90% of its limit
+    def evict(self):
+        try:
+            files = []
+            total = 0
+            for root, dirs, names in os.walk(self.dir):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+
+            if total > self.max_bytes:
+                files.sort()
+                target = self.max_bytes * 0.9
+                for mtime, size, path in files:
+                    if total <= target:
+                        break
+                    try:
+                        os.remove(path)
+                        total -= size
+                    except OSError:
+                        pass
+            with self.lock:
+                self.total_bytes = total
+        finally:
+            with self.lock:
+                self.evicting = False
+
+
+    def shutdown(self):
+        if self.pool != None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
@@ -13,6 +13,7 @@ import random
 import glob
 import os
 import itertools
+import heapq
 import copy
 import scripts.metadata as metadata
 from zipfile import ZipFile
@@ -20,7 +21,9 @@ from os.path import exists, isdir, basename
 from datetime import datetime as dt
 from datetime import date
 from pathlib import Path
-from collections import deque
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
+from types import MappingProxyType
 from PIL import Image
 from PIL.PngImagePlugin import PngImageFile, PngInfo
 
@@ -87,6 +90,9 @@ class PromptManager():
 
         # dictionary of config info w/ initial defaults
         self.config = {}
+        # read-only copy of config shared by queued work items; see config_snapshot()
+        self.snapshot = None
+        self.snapshot_version = 0
         self.reset_config_defaults()
 
         # list for config info
@@ -205,9 +211,30 @@ class PromptManager():
                     which_list.append(line)
 
 
+    # returns an immutable copy of the current config for work items to share
+    # a new copy is only made after the config has changed
+    def config_snapshot(self):
+        if self.snapshot == None:
+            self.snapshot_version += 1
+            self.snapshot = MappingProxyType(copy.deepcopy(self.config))
+        return self.snapshot
+
+
+    # must be called whenever self.config is modified so that
+    # work items created afterwards see the change
+    def config_changed(self):
+        self.snapshot = None
+
+
+    # returns a new work item based on the current config
+    def new_work_item(self):
+        return WorkItem(self.config_snapshot(), self.snapshot_version)
+
+
     # resets config options back to defaults
     def reset_config_defaults(self):
         self.control.repeat_jobs = False
+        self.config_changed()
         self.config = {
             'mode' : "standard",
             'seed' : -1,
@@ -349,6 +376,7 @@ class PromptManager():
 
     # handle prompt file config directives
     def handle_directive(self, command, value):
+        self.config_changed()
         if command == 'width':
             if value != '':
                 try:
@@ -1266,10 +1294,31 @@ class PromptManager():
                     self.handle_directive(command, value)
 
 
-    # return a list of all possible PromptSection combinations
+    # return all possible PromptSection combinations as a WorkQueue
+    # that expands them on demand
     def build_combinations(self):
-        prompt_work_queue = deque()
-
+        # every combination containing a directive is skipped, so the job count is
+        # the product of the non-directive token counts in each section
+        total = 1
+        for ps in self.prompts:
+            count = 0
+            for token in ps.tokens:
+                if not re.search('!(.+?)=', token):
+                    count += 1
+            total *= count
+        if len(self.prompts) == 0:
+            total = 0
+
+        work_queue = WorkQueue(total = total)
+        work_queue.set_source(self.iter_combinations(work_queue.add_to_total))
+        return work_queue
+
+
+    # generator for standard mode work items; embedded directives are applied
+    # in order as combinations are reached
+    # on_expand is called with the number of extra jobs when a directory input
+    # image expands into multiple work items
+    def iter_combinations(self, on_expand=lambda n: None):
         # convert PromptSections to simple lists so they're iterable
         all_prompts = list()
         for ps in self.prompts:
@@ -1282,9 +1331,9 @@ class PromptManager():
 
         # associate a copy of config info with each prompt
         for prompt in prompt_combos:
-            #work = self.config.copy()
-            # switched to deep copy here to handle IPTC metadata history stuff
-            work = copy.deepcopy(self.config)
+            # work items share a deep copy of the config (needed for IPTC metadata
+            # history stuff) and only store the values that differ from it
+            work = self.new_work_item()
 
             work['prompt_file'] = self.control.prompt_file
             str_prompt = ""
@@ -1322,11 +1371,12 @@ class PromptManager():
                     controlnet_files = get_images_in_dir(work['controlnet_input_image'])
                     if len(input_files) > 0 and len(controlnet_files) > 0:
                         subdir_processed = True
+                        on_expand(len(input_files) * len(controlnet_files) - 1)
                         for i in input_files:
                             for c in controlnet_files:
                                 work['input_image'] = i
                                 work['controlnet_input_image'] = c
-                                prompt_work_queue.append(work.copy())
+                                yield work.copy()
                     #else:
                         # one or both directories are empty, fall through to below and handle
 
@@ -1335,10 +1385,11 @@ class PromptManager():
                     files = get_images_in_dir(work['input_image'])
                     if len(files) > 0:
                         subdir_processed = True
+                        on_expand(len(files) - 1)
                         for f in files:
                             # queue each image in the input dir
                             work['input_image'] = f
-                            prompt_work_queue.append(work.copy())
+                            yield work.copy()
                     else:
                         self.control.print("*** WARNING: prompt file command INPUT_IMAGE refers to an empty directory (" + work['input_image'] + "); ignoring it! ***")
                         work['input_image'] = ''
@@ -1348,18 +1399,17 @@ class PromptManager():
                     files = get_images_in_dir(work['controlnet_input_image'])
                     if len(files) > 0:
                         subdir_processed = True
+                        on_expand(len(files) - 1)
                         for f in files:
                             # queue each image in the input dir
                             work['controlnet_input_image'] = f
-                            prompt_work_queue.append(work.copy())
+                            yield work.copy()
                     else:
                         self.control.print("*** WARNING: prompt file command CONTROLNET_INPUT_IMAGE refers to an empty directory (" + work['controlnet_input_image'] + "); ignoring it! ***")
                         work['controlnet_input_image'] = ''
 
                 if not subdir_processed:
-                    prompt_work_queue.append(work.copy())
-
-        return prompt_work_queue
+                    yield work.copy()
 
 
     # for !MODE = process
@@ -1386,7 +1436,7 @@ class PromptManager():
 
         # associate a copy of config info with each prompt
         for prompt in prompt_combos:
-            work = self.config.copy()
+            work = self.new_work_item()
             work['prompt_file'] = self.control.prompt_file
             str_prompt = ""
             fragments = 0
@@ -1524,6 +1574,206 @@ class PromptManager():
         return full_prompt
 
 
+# a queued job: a shared read-only config snapshot plus the values that differ for this job
+# behaves like the config dict it replaces; mutable values (lists/dicts) are copied into
+# the overrides the first time they're accessed, so changes never leak into the snapshot
+class WorkItem(MutableMapping):
+    __slots__ = ('base', 'version', 'overrides')
+    DELETED = object()
+
+    def __init__(self, base, version=0, overrides=None):
+        self.base = base
+        self.version = version
+        self.overrides = {}
+        if overrides != None:
+            self.overrides = overrides
+
+    def __getitem__(self, key):
+        if key in self.overrides:
+            value = self.overrides[key]
+            if value is WorkItem.DELETED:
+                raise KeyError(key)
+            return value
+        value = self.base[key]
+        if isinstance(value, (list, dict, set)):
+            value = copy.deepcopy(value)
+            self.overrides[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.overrides[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.base:
+            self.overrides[key] = WorkItem.DELETED
+        else:
+            del self.overrides[key]
+
+    def __contains__(self, key):
+        if key in self.overrides:
+            return self.overrides[key] is not WorkItem.DELETED
+        return key in self.base
+
+    def __iter__(self):
+        for key in self.base:
+            if key in self:
+                yield key
+        for key in self.overrides:
+            if key not in self.base and key in self:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    # True if both items come from the same snapshot and hold the same values,
+    # apart from the keys in ignore
+    def same_as(self, other, ignore=()):
+        if not isinstance(other, WorkItem) or other.base is not self.base:
+            return False
+        for key in set(self.overrides) | set(other.overrides):
+            if key in ignore:
+                continue
+            if (key in self) != (key in other):
+                return False
+            if key in self and self[key] != other[key]:
+                return False
+        return True
+
+    # shallow copy, like dict.copy(); the snapshot is shared
+    def copy(self):
+        return WorkItem(self.base, self.version, dict(self.overrides))
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        memo[id(WorkItem.DELETED)] = WorkItem.DELETED
+        return WorkItem(self.base, self.version, copy.deepcopy(self.overrides, memo))
+
+
+# thread-safe work queue that pulls items from a (possibly lazy) source as needed
+# only a small window of upcoming items is kept in memory; supports the subset of
+# deque operations the controller and scheduler use
+class WorkQueue():
+    def __init__(self, items=None, total=0, prefetch=32):
+        self.lock = threading.RLock()
+        self.buffer = deque()
+        self.source = None
+        self.produced = 0
+        # estimated total number of items this queue will produce
+        self.total = total
+        # number of items to keep expanded ahead of the consumer
+        self.prefetch = prefetch
+        # sequence numbers of items to drop as they're produced (e.g. already done before a restart)
+        self.skip = set()
+        self.skip_remaining = 0
+        if items != None:
+            if total == 0:
+                try:
+                    self.total = len(items)
+                except TypeError:
+                    pass
+            self.set_source(items)
+
+    def set_source(self, source):
+        with self.lock:
+            self.source = iter(source)
+
+    # drop these not-yet-produced sequence numbers from the stream
+    def set_skip(self, skip):
+        with self.lock:
+            self.skip = set(skip)
+            self.skip_remaining = 0
+            for seq in self.skip:
+                if seq >= self.produced:
+                    self.skip_remaining += 1
+
+    # adjusts the total estimate (e.g. when a directory expands into multiple jobs)
+    def add_to_total(self, amount):
+        with self.lock:
+            self.total += amount
+
+    # pull items from the source until the buffer holds at least count items
+    def fill(self, count):
+        with self.lock:
+            while self.source != None and len(self.buffer) < count:
+                try:
+                    item = next(self.source)
+                except StopIteration:
+                    self.source = None
+                    break
+                seq = self.produced
+                self.produced += 1
+                if seq in self.skip:
+                    self.skip_remaining -= 1
+                else:
+                    # position in the stream; used by the journal to track finished jobs
+                    item['job_seq'] = seq
+                    self.buffer.append(item)
+
+    def append(self, item):
+        with self.lock:
+            item['job_seq'] = self.produced
+            self.buffer.append(item)
+            self.produced += 1
+            if self.produced > self.total:
+                self.total = self.produced
+
+    # sequence numbers of the items that have been taken from the queue (or skipped)
+    def taken(self):
+        with self.lock:
+            taken = set(range(self.produced))
+            for item in self.buffer:
+                taken.discard(item.get('job_seq'))
+            return taken
+
+    # puts an item that was already taken from the queue back at the front (e.g. a job
+    # whose worker failed); it keeps its job_seq, and doesn't count as newly produced
+    def appendleft(self, item):
+        with self.lock:
+            self.buffer.appendleft(item)
+
+    def popleft(self):
+        with self.lock:
+            self.fill(self.prefetch)
+            return self.buffer.popleft()
+
+    def clear(self):
+        with self.lock:
+            self.buffer.clear()
+            self.source = None
+            self.produced = 0
+            self.total = 0
+
+    # number of remaining items; exact once the source is exhausted, otherwise
+    # based on the total estimate (always > 0 if there's something left to pop)
+    def __len__(self):
+        with self.lock:
+            self.fill(self.prefetch)
+            if self.source == None:
+                return len(self.buffer)
+            return max(len(self.buffer), len(self.buffer) + self.total - self.produced - self.skip_remaining)
+
+    def __getitem__(self, index):
+        with self.lock:
+            self.fill(index + 1)
+            return self.buffer[index]
+
+    def __delitem__(self, index):
+        with self.lock:
+            del self.buffer[index]
+
+    # iterates over the currently expanded items only
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.buffer))
+
+
 # for easy reading of prompt/config files
 class TextFile():
     def __init__(self, filename):
@@ -2179,40 +2429,79 @@ def read_exif_from_image(abs_path_to_img):
     return exif
 
 
+# cached .jpg listings of the most recent images in directories, for the gallery
+# dir path: (dir mtime_ns, limit, [(image mtime, image path)]), least recently used first
+image_listing_cache = OrderedDict()
+image_listing_cache_size = 64
+image_listing_lock = threading.Lock()
+
+
+# returns up to limit of the .jpg images in dir as a list of (mtime, path), most recently
+# modified first; only the newest limit images are ever ordered, not the whole folder
+# a directory is only re-read when its own mtime changes (i.e. images were added,
+# removed or renamed), so unchanged folders cost a single stat
+def get_image_listing(dir, limit):
+    try:
+        dir_mtime = os.stat(dir).st_mtime_ns
+    except OSError:
+        return []
+    with image_listing_lock:
+        cached = image_listing_cache.get(dir)
+        if cached != None and cached[0] == dir_mtime and (cached[1] >= limit or len(cached[2]) < cached[1]):
+            # same folder contents, and the listing holds at least as many as asked for (or all of them)
+            image_listing_cache.move_to_end(dir)
+            return cached[2][:limit]
+
+    def images():
+        for f in os.scandir(dir):
+            if f.name.lower().endswith(".jpg"):
+                try:
+                    yield (f.stat().st_mtime, f.path)
+                except OSError:
+                    # deleted since the scan started
+                    pass
+
+    try:
+        listing = heapq.nlargest(limit, images())
+    except OSError:
+        return []
+
+    # don't trust a listing taken in the same instant the dir changed; a file written
+    # right after the scan could leave the dir mtime unchanged on coarse filesystems
+    if time.time_ns() - dir_mtime > 2 * 1000000000:
+        with image_listing_lock:
+            image_listing_cache[dir] = (dir_mtime, limit, listing)
+            image_listing_cache.move_to_end(dir)
+            while len(image_listing_cache) > image_listing_cache_size:
+                image_listing_cache.popitem(last=False)
+    return listing
+
+
 # gets the most recently modified images found within the SUBDIRs of dir
 # will return up to max_files images
 def get_recent_images(dir, max_files):
-    count = 0
     images = []
     subdirs = []
 
-    # first get a list of directories in most-recently-modified order
-    for f in os.scandir(dir):
-        if f.is_dir():
-            # 2023-06-07 don't include upscaled dir
-            if f.name != 'upscaled':
-                subdirs.append(f.path)
-
-    # contains a list of subdirs in most-recently-modified order
-    subdirs.sort(key=os.path.getmtime, reverse=True)
-
-    # iterate through sorted subdirs, sorting images within each by
-    # most-recently-modified, then adding images until we have max_files
-    for d in subdirs:
-        tmp_images = []
-        for f in os.scandir(d):
-            if f.path.lower().endswith(".jpg"):
-                tmp_images.append(f.path)
-        tmp_images.sort(key=os.path.getmtime, reverse=True)
-
-        for img in tmp_images:
+    # first get the subdirs with their last-modified times
+    try:
+        for f in os.scandir(dir):
+            try:
+                # 2023-06-07 don't include upscaled dir
+                if f.is_dir() and f.name != 'upscaled':
+                    subdirs.append((-f.stat().st_mtime, f.path))
+            except OSError:
+                pass
+    except OSError:
+        return images
+
+    # take subdirs in most-recently-modified order (off a heap, so we only
+    # order as many as we need), adding their newest images until we have max_files
+    heapq.heapify(subdirs)
+    while len(subdirs) > 0 and len(images) < max_files:
+        mtime, d = heapq.heappop(subdirs)
+        for mtime, img in get_image_listing(d, max_files - len(images)):
             images.append(img)
-            count += 1
-            if count >= max_files:
-                break
-
-        if count >= max_files:
-            break
 
     return images
 
@@ -2220,21 +2509,9 @@ def get_recent_images(dir, max_files):
 # gets the most recently modified images found within specified dir
 # will return up to max_files images
 def get_images_from_dir(dir, max_files):
-    count = 0
     images = []
-    tmp_images = []
-
-    for f in os.scandir(dir):
-        if f.path.lower().endswith(".jpg"):
-            tmp_images.append(f.path)
-    tmp_images.sort(key=os.path.getmtime, reverse=True)
-
-    for img in tmp_images:
+    for mtime, img in get_image_listing(dir, max_files):
         images.append(img)
-        count += 1
-        if count >= max_files:
-            break
-
     return images
 
 
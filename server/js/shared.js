@@ -56,3 +56,69 @@ function niceAlertQuick(titleText, descText, confirmFunction) {
     }
   });
 }
+
+// listens for changes pushed by the server (see ArtGeneratorWebService.GET in scripts/server.py)
+// handlers maps event types to functions that take the event's data; if the browser or the
+// server can't stream events, fallback() is called instead so the page can poll
+function listenForEvents(handlers, fallback) {
+  if (typeof(EventSource) == "undefined") {
+    fallback();
+    return;
+  }
+  var source = new EventSource("/generator");
+  var connected = false;
+  source.onopen = function() {
+    connected = true;
+  };
+  source.onerror = function() {
+    // once connected, the browser will reconnect on its own
+    if (!connected) {
+      source.close();
+      fallback();
+    }
+  };
+  // the server has too many pages open already
+  source.addEventListener("busy", function() {
+    source.close();
+    fallback();
+  });
+  $.each(handlers, function(type, handler) {
+    source.addEventListener(type, function(e) {
+      handler(e.data);
+    });
+  });
+}
+
+// keeps the server uptime on the status panel counting between status updates
+var uptime_start = 0;
+var uptime_timer = null;
+
+function trackUptime() {
+  var node = document.getElementById("server-uptime");
+  if (node == null) {
+    return;
+  }
+  uptime_start = Date.now() / 1000 - parseInt(node.dataset.uptime);
+  if (uptime_timer == null) {
+    uptime_timer = setInterval(function() {
+      var node = document.getElementById("server-uptime");
+      if (node != null) {
+        node.innerHTML = formatUptime(Math.round(Date.now() / 1000 - uptime_start));
+      }
+    }, 1000);
+  }
+}
+
+// same format as the server's (e.g. '1 day, 2:03:04')
+function formatUptime(seconds) {
+  var days = Math.floor(seconds / 86400);
+  seconds = seconds % 86400;
+  var hours = Math.floor(seconds / 3600);
+  var minutes = Math.floor(seconds % 3600 / 60);
+  seconds = seconds % 60;
+  var text = hours + ":" + (minutes < 10 ? "0" : "") + minutes + ":" + (seconds < 10 ? "0" : "") + seconds;
+  if (days > 0) {
+    text = days + (days == 1 ? " day, " : " days, ") + text;
+  }
+  return text;
+}
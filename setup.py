@@ -59,6 +59,7 @@ def install_dependencies(verbose = False, shell = False):
     print('\nChecking for required dependencies:')
     base = 'pip install --no-input '
     packages = [ \
+        'aiohttp', \
         #'transformers', \
         #'diffusers', \
         'cherrypy', \